@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate, pre_migrate
 
 
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        from . import permissions
+        from .search import initialize_search, uninstall_search
+        pre_migrate.connect(uninstall_search, sender=self)
+        post_migrate.connect(initialize_search, sender=self)
@@ -1,29 +1,31 @@
+from functools import cache
 from .models import *
+from .permissions import can
 
-def nav_urls(request):
-    if not isinstance(request.user, Employee):
-        return {}
-
-    user_position = request.user.position
-    position_permissions = {k: user_position in [Employee.Position.Administrator, *v] for k, v in {
-        "can_view_orders": RepairOrder.edit_allowed_to,
-        "can_view_services": Service.edit_allowed_to,
-        "can_view_clients": Client.edit_allowed_to,
-        "can_view_vehicles": Vehicle.edit_allowed_to,
-        "can_view_items": WarehouseItem.edit_allowed_to,
-        "can_view_providers": WarehouseItem.edit_allowed_to,
-        "can_view_employees": Employee.edit_allowed_to,
-    }.items()}
+@cache
+def get_nav(user_position):
+    """Navigation of a position, built once from the permission matrix."""
+    position_permissions = {k: can(user_position, v, "edit") for k, v in {
+        "can_view_orders": RepairOrder,
+        "can_view_services": Service,
+        "can_view_clients": Client,
+        "can_view_vehicles": Vehicle,
+        "can_view_items": WarehouseItem,
+        "can_view_providers": WarehouseItem,
+        "can_view_employees": Employee,
+    }.items()} | {"can_view_margin": can(user_position, RepairOrder, "margin")}
 
     repair_entries = {k:v for k, v in {
         "Заявки": "orders" if position_permissions["can_view_orders"] else None,
         "Услуги": "services" if position_permissions["can_view_services"] else None,
         "Клиенты": "clients" if position_permissions["can_view_clients"] else None,
         "Автомобили": "vehicles" if position_permissions["can_view_vehicles"] else None,
+        "Маржа": "order_margin" if position_permissions["can_view_margin"] else None,
     }.items() if v is not None}
     warehouse_entries = {k:v for k, v in {
         "Расходники": "items" if position_permissions["can_view_items"] else None,
-        "Поставщики": "providers" if position_permissions["can_view_providers"] else None
+        "Поставщики": "providers" if position_permissions["can_view_providers"] else None,
+        "Остатки": "warehouse_report" if position_permissions["can_view_items"] else None
     }.items() if v is not None}
     extra_entries = {k:v for k, v in {
         "Сотрудники": "employees" if position_permissions["can_view_employees"] else None
@@ -42,5 +44,14 @@ def nav_urls(request):
 
     return {
         "nav_urls": nav_urls,
-        "first_visible_entry": first_visible_entry
+        "first_visible_entry": first_visible_entry,
+    }
+
+def nav_urls(request):
+    if not isinstance(request.user, Employee):
+        return {}
+
+    return get_nav(request.user.position) | {
+        "low_stock_count": WarehouseItem.objects.filter(is_low_stock=True).count()
+            if can(request.user.position, WarehouseItem, "edit") else 0
     }
@@ -1,9 +1,15 @@
+import csv
+import io
+from functools import cache
+from decimal import Decimal, InvalidOperation
 from typing import Any
 from django.forms import *
 from django.contrib.auth.forms import *
 from .models import *
+from .permissions import can
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Fieldset, Column, Submit, HTML
+from django.urls import reverse
 
 
 class Column(Column):
@@ -17,35 +23,72 @@ delete_button = HTML("""
 print_receipt_button = HTML("""
     <a class="btn btn-secondary mt-2" href="receipt/" target="_blank">Печать квитанции</a>
 """)
+import_invoice_button = HTML("""
+    <a class="btn btn-secondary mt-2" href="import/">Импорт накладной</a>
+""")
 
 def button_column(form: ModelForm, kwargs: dict):
     position = kwargs["initial"]["position"]
-    return Column(submit_button, delete_button) if form.instance.pk is not None and position in [Employee.Position.Administrator, *form.instance.create_allowed_to] \
-        else submit_button if position in [Employee.Position.Administrator, *form.instance.edit_allowed_to] \
+    return Column(submit_button, delete_button) if form.instance.pk is not None and can(position, form._meta.model, "create") \
+        else submit_button if can(position, form._meta.model, "edit") \
         else None
 
-def restrict_form_fields(form: ModelForm, kwargs: dict, fields_by_permission: list[list[str]]):
-    position = kwargs["initial"]["position"]
-
-    if position not in [Employee.Position.Administrator, *form.instance.edit_allowed_to]:
-        for field in form.fields.values():
-            field.disabled = True
-        return
-
-    for allowed_positions, fields in fields_by_permission:
-        for field in fields:
-            form.fields[field].disabled = True
-
-    for allowed_positions, fields in fields_by_permission:
-        if position in [Employee.Position.Administrator, *allowed_positions]:
-            for field in fields:
-                form.fields[field].disabled = False
+@cache
+def get_disabled_fields(form_class, position):
+    """Fields of the form the position can't change, from its fields_by_permission groups."""
+    if not can(position, form_class._meta.model, "edit"):
+        return frozenset(form_class.base_fields)
+    restricted = {field for allowed_positions, fields in form_class.fields_by_permission for field in fields}
+    return frozenset(restricted - {field for allowed_positions, fields in form_class.fields_by_permission
+                                   if position in [Employee.Position.Administrator, *allowed_positions] for field in fields})
+
+def restrict_form_fields(form: ModelForm, kwargs: dict):
+    for field in get_disabled_fields(type(form), kwargs["initial"]["position"]):
+        form.fields[field].disabled = True
+
+class AutocompleteSelect(Select):
+    """Select of a foreign key whose options are loaded by AutocompleteView as the user types."""
+    def __init__(self, field, attrs=None):
+        super().__init__(attrs)
+        self.field = field
+
+    def build_attrs(self, base_attrs, extra_attrs=None):
+        return super().build_attrs(base_attrs, extra_attrs) | {
+            "data-autocomplete-url": reverse("autocomplete", kwargs={"model": self.field.model._meta.model_name,
+                                                                     "field": self.field.name})
+        }
+
+    def optgroups(self, name, value, attrs=None):
+        # Only the chosen row is fetched, instead of the whole table, and submitted values that can't be keys
+        # are left out, while the field reports them as invalid
+        field = self.choices.field
+        key = field.queryset.model._meta.get_field(field.to_field_name) if field.to_field_name else field.queryset.model._meta.pk
+        selected = []
+        for id in value:
+            try:
+                id = key.to_python(id)
+            except ValidationError:
+                continue
+            if id is not None and id != "":
+                selected.append(id)
+        options = [self.create_option(name, "", field.empty_label, not selected, 0)] if field.empty_label is not None else []
+        for obj in field.queryset.filter(**{f"{key.attname}__in": selected}) if selected else []:
+            options.append(self.create_option(name, field.prepare_value(obj), field.label_from_instance(obj), True, len(options)))
+        return [(None, options, 0)]
+
+def use_autocomplete(form: ModelForm, fields: list[str]):
+    for name in fields:
+        widget = AutocompleteSelect(form._meta.model._meta.get_field(name), form.fields[name].widget.attrs)
+        widget.choices = form.fields[name].choices
+        form.fields[name].widget = widget
 
 class BaseForm(ModelForm):
+    fields_by_permission = []
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        restrict_form_fields(self, kwargs, [])
+        restrict_form_fields(self, kwargs)
 
         self.helper = FormHelper(self)
         self.helper.layout.fields.append(button_column(self, kwargs))
@@ -81,13 +124,13 @@ class ServiceHistoryForm(BaseForm):
         model = ServiceHistory
         exclude = ["repair_order"]
 
+    fields_by_permission = [
+        [[Employee.Position.ServiceManager], ['service']]
+    ]
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        restrict_form_fields(self, kwargs, [
-            [[Employee.Position.ServiceManager], ['service']]
-        ])
-
         self.helper = FormHelper()
         self.helper.layout = Layout(
             'service',
@@ -107,6 +150,11 @@ class WarehouseUseForm(BaseForm):
     class Meta:
         model = WarehouseUse
         exclude = ["repair_order"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        use_autocomplete(self, ["item"])
+
     def clean(self) -> dict[str, Any]:
         self.instance.repair_order_id = self.initial["order"]
         return super().clean()
@@ -116,6 +164,10 @@ class WarehouseRestockForm(BaseForm):
         model = WarehouseRestock
         exclude = ["item"]
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        use_autocomplete(self, ["provider"])
+
     def clean(self) -> dict[str, Any]:
         self.instance.item_id = self.initial["item"]
         return super().clean()
@@ -130,6 +182,102 @@ class WarehouseProviderForm(BaseForm):
         model = WarehouseProvider
         exclude = []
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if kwargs["instance"] and can(kwargs["initial"]["position"], WarehouseRestock, "create"):
+            self.helper.layout.fields.append(import_invoice_button)
+
+class WarehouseRestockImportForm(Form):
+    """Restocks from a supplier invoice, with items matched by their codes or types and names."""
+    file = FileField(label="Накладная (CSV)",
+                     help_text="Первая строка — заголовки столбцов: Код, Штрихкод или Тип и Наименование, Количество, "
+                               "необязательно Цена закупки.")
+
+    columns = {"код": "code", "штрихкод": "sku", "тип": "type", "наименование": "name", "количество": "amount",
+               "цена": "unit_cost", "цена закупки": "unit_cost"}
+    max_errors = 20
+
+    def __init__(self, *args, provider=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.provider = provider
+        self.helper = FormHelper(self)
+        self.helper.layout.fields.append(Submit("submit", "Импортировать", css_class="btn-primary ml-2"))
+
+    def read_rows(self, file):
+        content = file.read()
+        try:
+            text = content.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            # Excel saves CSV in the ANSI code page of the system
+            text = content.decode("cp1251")
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=";,\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = csv.reader(io.StringIO(text), dialect)
+        header = [self.columns.get(column.strip().lower()) for column in next(rows, [])]
+        if "amount" not in header or not {"code", "sku"} & set(header) and not {"type", "name"} <= set(header):
+            raise ValidationError("В первой строке должны быть столбцы Количество и Код, Штрихкод или Тип и Наименование.")
+        return ({key: value.strip() for key, value in zip(header, row) if key} for row in rows if any(row))
+
+    def clean_file(self):
+        rows = self.read_rows(self.cleaned_data["file"])
+
+        # The catalogue is matched in memory, so that any number of lines takes a single query
+        ids = set()
+        skus = {}
+        items = {}
+        for [id, type, name, sku] in WarehouseItem.objects.values_list("id", "type", "name", "sku"):
+            ids.add(id)
+            if sku:
+                skus[sku] = id
+            key = (type.strip().lower(), name.strip().lower())
+            items[key] = None if key in items else id
+
+        self.restocks = []
+        errors = []
+        for line, row in enumerate(rows, 2):
+            code = row.get("code", "")
+            sku = row.get("sku", "")
+            if code:
+                item_id = int(code) if code.isdigit() and int(code) in ids else None
+                if item_id is None:
+                    errors.append(f"Строка {line}: нет расходника с кодом {code}.")
+            elif sku:
+                item_id = skus.get(sku)
+                if item_id is None:
+                    errors.append(f"Строка {line}: нет расходника со штрихкодом {sku}.")
+            else:
+                key = (row.get("type", "").lower(), row.get("name", "").lower())
+                item_id = items.get(key, 0)
+                if not item_id:
+                    errors.append(f"Строка {line}: " + ("несколько расходников с таким типом и наименованием, укажите код."
+                                                        if item_id is None else "расходник не найден."))
+            amount = row.get("amount", "")
+            if not amount.isdigit() or int(amount) < 1:
+                errors.append(f"Строка {line}: количество должно быть целым положительным числом.")
+                item_id = None
+            unit_cost = row.get("unit_cost", "").replace(" ", "").replace(",", ".") or None
+            if unit_cost is not None:
+                try:
+                    unit_cost = Decimal(unit_cost)
+                except InvalidOperation:
+                    unit_cost = Decimal(-1)
+                if not unit_cost.is_finite() or unit_cost < 0 or unit_cost >= 100000:
+                    errors.append(f"Строка {line}: цена закупки должна быть неотрицательным числом меньше 100000.")
+                    item_id = None
+            if item_id:
+                self.restocks.append(WarehouseRestock(item_id=item_id, provider=self.provider, amount=int(amount),
+                                                      unit_cost=unit_cost if unit_cost is None else round(unit_cost, 2)))
+
+        if len(errors) > self.max_errors:
+            errors = errors[:self.max_errors] + [f"И еще ошибок: {len(errors) - self.max_errors}."]
+        if errors:
+            raise ValidationError(errors)
+        if not self.restocks:
+            raise ValidationError("В накладной нет строк.")
+        return self.cleaned_data["file"]
+
 class BaseEmployeeForm():
     class Meta:
         model = Employee
@@ -188,9 +336,22 @@ class RepairOrderForm(ModelForm):
         required=False,
         widget=NumberInput(attrs={"readonly": "", "step": "0.01"}))
 
+    fields_by_permission = [
+        [[Employee.Position.ServiceManager],
+            ['master',
+            'client', 'vehicle', 'vehicle_mileage',
+            'complaints',
+            'start_date', 'finish_until', 'is_cancelled',
+            'is_warranty']],
+        [[Employee.Position.ServiceManager,
+          Employee.Position.Mechanic], ["finish_date"]],
+        [[Employee.Position.Mechanic], ["diagnostic_results"]],
+        [[Employee.Position.Cashier], ["is_paid"]]
+    ]
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **(kwargs | {"initial": {
-            "total_cost": '{0:.2f}'.format(kwargs["instance"].get_total_cost() if kwargs["instance"] else 0),
+            "total_cost": '{0:.2f}'.format(kwargs["instance"].total if kwargs["instance"] else 0),
             **({
                 "is_paid": False
             } if kwargs["instance"] and kwargs["instance"].is_warranty else {})
@@ -203,19 +364,9 @@ class RepairOrderForm(ModelForm):
             self.fields['diagnostic_results'].widget.attrs = \
             self.fields['comments'].widget.attrs = \
                 {'rows': 2}
+        use_autocomplete(self, ['master', 'client', 'vehicle'])
 
-        restrict_form_fields(self, kwargs, [
-            [[Employee.Position.ServiceManager],
-                ['master',
-                'client', 'vehicle', 'vehicle_mileage',
-                'complaints',
-                'start_date', 'finish_until', 'is_cancelled',
-                'is_warranty']],
-            [[Employee.Position.ServiceManager,
-              Employee.Position.Mechanic], ["finish_date"]],
-            [[Employee.Position.Mechanic], ["diagnostic_results"]],
-            [[Employee.Position.Cashier], ["is_paid"]]
-        ])
+        restrict_form_fields(self, kwargs)
 
         self.helper = FormHelper()
         self.helper.layout = Layout(
@@ -243,5 +394,5 @@ class RepairOrderForm(ModelForm):
                 'is_paid'
             )] if kwargs["instance"] else []),
             button_column(self, kwargs),
-            print_receipt_button if kwargs["instance"] and kwargs["initial"]["position"] in [Employee.Position.Administrator, Employee.Position.ServiceManager] else None
+            print_receipt_button if kwargs["instance"] and can(kwargs["initial"]["position"], RepairOrder, "print") else None
         )
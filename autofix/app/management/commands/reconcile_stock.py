@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F
+from app.models import WarehouseItem, WarehouseMovement
+
+
+class Command(BaseCommand):
+    help = "Verifies stored stocks of warehouse items against their restocks and uses."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Replace wrong stocks with the ones computed from the ledger.")
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        items = WarehouseItem._base_manager.using(options["database"])
+        wrong = list(items.annotate(ledger_stock=WarehouseItem.get_ledger_stock()).exclude(stock=F("ledger_stock")).order_by("id"))
+        for item in wrong:
+            self.stdout.write(f"{item.id} {item.type} {item.name}: stored {item.stock} шт., ledger {item.ledger_stock} шт.")
+
+        if not wrong:
+            self.stdout.write(self.style.SUCCESS("All stocks match the ledger."))
+        elif options["fix"]:
+            fixed = 0
+            for item in wrong:
+                # Items changed meanwhile are left for the next run
+                with transaction.atomic(using=options["database"]):
+                    if items.filter(id=item.id, stock=item.stock).update(
+                            stock=item.ledger_stock, is_low_stock=WarehouseItem.get_low_stock(item.ledger_stock - item.stock)
+                    ):
+                        WarehouseMovement.objects.using(options["database"]).create(item=item, change=item.ledger_stock - item.stock)
+                        fixed += 1
+            self.stdout.write(self.style.SUCCESS(f"Fixed stocks of {fixed} items."))
+        else:
+            raise CommandError(f"Stocks of {len(wrong)} items don't match the ledger, run with --fix to correct them.")
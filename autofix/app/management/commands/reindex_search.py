@@ -0,0 +1,57 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from app.search import FullTextSearchMixin, get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuilds search indexes of the given models, or of all searched models, in bounded transactions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("models", nargs="*", help="Names of the models to reindex, like client or repairorder.")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Rows indexed per transaction.")
+        parser.add_argument("--jobs", type=int, default=1, help="Models reindexed in parallel, where the database benefits from it.")
+        parser.add_argument("--shadow", action="store_true",
+                            help="Build aside and swap in at the end, so that search stays complete meanwhile.")
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        models = {cls._meta.model_name: cls for cls in FullTextSearchMixin.search_models}
+        names = [name.lower() for name in options["models"]] or list(models)
+        unknown = [name for name in names if name not in models]
+        if unknown:
+            raise CommandError(f"Unknown searched models: {', '.join(unknown)}. Available: {', '.join(models)}.")
+        if options["chunk_size"] < 1 or options["jobs"] < 1:
+            raise CommandError("--chunk-size and --jobs must be positive.")
+
+        if options["jobs"] > 1 and not get_search_backend(options["database"]).parallel_reindex:
+            self.stderr.write("The database has a single writer, reindexing models one by one.")
+            options["jobs"] = 1
+
+        if options["jobs"] == 1:
+            for name in names:
+                self.reindex(models[name], options)
+        else:
+            with ThreadPoolExecutor(options["jobs"]) as executor:
+                list(executor.map(lambda name: self.reindex_in_thread(models[name], options), names))
+
+    def reindex_in_thread(self, cls, options):
+        try:
+            self.reindex(cls, options)
+        finally:
+            connections[options["database"]].close()
+
+    def reindex(self, cls, options):
+        name = cls._meta.model_name
+        started = time.monotonic()
+
+        def progress(rows):
+            if options["verbosity"] >= 2:
+                self.stdout.write(f"{name}: {rows} rows, {rows / max(time.monotonic() - started, 1e-6):.0f} rows/s")
+
+        rows = get_search_backend(options["database"]).reindex(cls, options["chunk_size"], options["shadow"], progress)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{name}: reindexed {rows} rows in {elapsed:.2f} s, {rows / max(elapsed, 1e-6):.0f} rows/s"
+        ))
@@ -0,0 +1,29 @@
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Exists
+from django.utils import timezone
+from app.models import WarehouseItem, WarehouseMovement, WarehouseStockSnapshot, get_day_end
+
+
+class Command(BaseCommand):
+    help = "Takes snapshots of stocks of warehouse items that changed since their latest ones. Meant to run daily."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--date", type=date.fromisoformat, help="Day whose end the stocks are taken at, yesterday by default.")
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        day = options["date"] or timezone.localdate() - timedelta(days=1)
+        taken_at = get_day_end(day)
+        # Movements of the current day may still be written
+        if taken_at > timezone.now():
+            raise CommandError("Stocks can only be taken at the end of past days.")
+
+        items = (WarehouseItem._base_manager.using(options["database"])
+                 .filter(Exists(WarehouseMovement.get_since_snapshot(taken_at)))
+                 .annotate(stock_at=WarehouseItem.get_stock_at(taken_at)))
+        snapshots = WarehouseStockSnapshot.objects.using(options["database"]).bulk_create([
+            WarehouseStockSnapshot(item_id=id, taken_at=taken_at, stock=stock) for [id, stock] in items.values_list("id", "stock_at")
+        ], batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(f"Took {len(snapshots)} stock snapshots at the end of {day:%d.%m.%Y}."))
@@ -1,6 +1,7 @@
 # Generated by Django 4.2.5 on 2023-11-30 09:49
 
 from django.db import migrations
+from app.search import SqliteRunSQL
 
 
 class Migration(migrations.Migration):
@@ -10,7 +11,7 @@ class Migration(migrations.Migration):
     ]
 
     operations = [
-        migrations.RunSQL(
+        SqliteRunSQL(
             f"""
             DROP TABLE IF EXISTS app_{model_name}_search;
             CREATE VIRTUAL TABLE app_{model_name}_search USING FTS5({fields});
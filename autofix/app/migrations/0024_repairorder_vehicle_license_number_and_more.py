@@ -1,6 +1,7 @@
 # Generated by Django 4.2.5 on 2023-12-04 10:33
 
 from django.db import migrations, models
+from app.search import SqliteRunSQL
 
 
 class Migration(migrations.Migration):
@@ -38,7 +39,7 @@ class Migration(migrations.Migration):
             name='is_warranty',
             field=models.BooleanField(default=False, verbose_name='Гарантийный ремонт'),
         ),
-        *[migrations.RunSQL(
+        *[SqliteRunSQL(
             f"""
             DROP TABLE IF EXISTS app_{model_name}_search;
             CREATE VIRTUAL TABLE app_{model_name}_search USING FTS5({fields});
@@ -2,6 +2,7 @@
 
 import django.core.validators
 from django.db import migrations, models
+from app.search import SqliteRunSQL
 
 
 class Migration(migrations.Migration):
@@ -26,7 +27,7 @@ class Migration(migrations.Migration):
             name='vehicle_vin',
             field=models.CharField(max_length=17, validators=[django.core.validators.MinLengthValidator(17)], verbose_name='VIN автомобиля'),
         ),
-        *[migrations.RunSQL(
+        *[SqliteRunSQL(
             f"""
             DROP TABLE IF EXISTS app_{model_name}_search;
             CREATE VIRTUAL TABLE app_{model_name}_search USING FTS5({fields});
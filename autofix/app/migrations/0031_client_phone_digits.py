@@ -0,0 +1,36 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+import re
+from django.db import migrations, models
+
+
+def fill_phone_digits(apps, schema_editor):
+    Client = apps.get_model("app", "Client")
+    clients = list(Client.objects.only("id", "phone_number"))
+    for client in clients:
+        client.phone_digits = re.sub(r"\D", "", str(client.phone_number or ""))
+        client.phone_digits_reversed = client.phone_digits[::-1]
+    Client.objects.bulk_update(clients, ["phone_digits", "phone_digits_reversed"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0030_alter_repairorder_finish_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='phone_digits',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=20),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='phone_digits_reversed',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=20),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_phone_digits, migrations.RunPython.noop),
+    ]
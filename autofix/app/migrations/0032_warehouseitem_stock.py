@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_stock(apps, schema_editor):
+    WarehouseItem = apps.get_model("app", "WarehouseItem")
+
+    def total(model_name):
+        rows = apps.get_model("app", model_name).objects.filter(item=OuterRef("pk")).order_by()
+        return Coalesce(Subquery(rows.values("item").annotate(total=Sum("amount")).values("total")), 0)
+
+    WarehouseItem._base_manager.update(stock=total("WarehouseRestock") - total("WarehouseUse"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0031_client_phone_digits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='warehouseitem',
+            name='stock',
+            field=models.IntegerField(default=0, editable=False, verbose_name='В наличии'),
+        ),
+        migrations.RunPython(fill_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_opening_movements(apps, schema_editor):
+    # Earlier stock changes are undated, so the current stocks are taken as their sum
+    WarehouseItem = apps.get_model("app", "WarehouseItem")
+    WarehouseMovement = apps.get_model("app", "WarehouseMovement")
+    WarehouseMovement.objects.bulk_create([
+        WarehouseMovement(item_id=id, change=stock)
+        for [id, stock] in WarehouseItem._base_manager.exclude(stock=0).values_list("id", "stock")
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0032_warehouseitem_stock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarehouseMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('change', models.IntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='app.warehouseitem')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['item', 'created_at'], name='app_warehou_item_id_ed9f52_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='WarehouseStockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField()),
+                ('stock', models.IntegerField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='app.warehouseitem')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('item', 'taken_at'), name='app_warehousestocksnapshot_item_taken_at')],
+            },
+        ),
+        migrations.RunPython(fill_opening_movements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0033_warehousemovement_warehousestocksnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='warehouseitem',
+            name='is_low_stock',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='warehouseitem',
+            name='reorder_threshold',
+            field=models.IntegerField(default=0, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Минимальный остаток'),
+        ),
+        migrations.AddIndex(
+            model_name='warehouseitem',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('is_low_stock', True)), fields=['name'], name='app_warehouseitem_low_stock'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_cost_layers(apps, schema_editor):
+    # Purchase prices weren't recorded, so the history is replayed once at the current prices of the items
+    WarehouseItem = apps.get_model("app", "WarehouseItem")
+    WarehouseRestock = apps.get_model("app", "WarehouseRestock")
+    WarehouseUse = apps.get_model("app", "WarehouseUse")
+    WarehouseConsumption = apps.get_model("app", "WarehouseConsumption")
+
+    prices = dict(WarehouseItem._base_manager.values_list("id", "price"))
+    restocks = {}
+    for restock in WarehouseRestock.objects.order_by("id"):
+        restock.unit_cost = prices[restock.item_id]
+        restock.remaining = restock.amount
+        restocks.setdefault(restock.item_id, []).append(restock)
+
+    uses = list(WarehouseUse.objects.order_by("id"))
+    consumptions = []
+    for use in uses:
+        layers = [restock for restock in restocks.get(use.item_id, []) if restock.remaining]
+        amount = use.amount
+        use.cost = 0
+        for restock in layers:
+            taken = min(amount, restock.remaining)
+            if not taken:
+                break
+            restock.remaining -= taken
+            amount -= taken
+            use.cost += taken * restock.unit_cost
+            consumptions.append(WarehouseConsumption(use=use, restock=restock, amount=taken))
+        use.cost += amount * prices[use.item_id]
+
+    WarehouseRestock.objects.bulk_update([restock for layers in restocks.values() for restock in layers],
+                                         ["unit_cost", "remaining"], batch_size=1000)
+    WarehouseUse.objects.bulk_update(uses, ["cost"], batch_size=1000)
+    WarehouseConsumption.objects.bulk_create(consumptions, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0034_warehouseitem_reorder_threshold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='warehouserestock',
+            name='remaining',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='warehouserestock',
+            name='unit_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, default=0, help_text='Если не указана, берется текущая цена расходника.', max_digits=7, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Цена закупки'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='warehouseuse',
+            name='cost',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='Себестоимость'),
+        ),
+        migrations.CreateModel(
+            name='WarehouseConsumption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField()),
+                ('restock', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='app.warehouserestock')),
+                ('use', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='app.warehouseuse')),
+            ],
+        ),
+        migrations.RunPython(fill_cost_layers, migrations.RunPython.noop),
+    ]
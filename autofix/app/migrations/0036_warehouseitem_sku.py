@@ -0,0 +1,22 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0035_warehouse_cost_layers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='warehouseitem',
+            name='sku',
+            field=models.CharField(blank=True, max_length=50, null=True, verbose_name='Штрихкод'),
+        ),
+        migrations.AddConstraint(
+            model_name='warehouseitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('deleted_at__isnull', True)), fields=('sku',), name='app_warehouseitem_sku', violation_error_message='Расходник с таким штрихкодом уже есть.'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_totals(apps, schema_editor):
+    # Past lines are priced at the current prices, which is what their orders showed until now
+    RepairOrder = apps.get_model("app", "RepairOrder")
+    ServiceHistory = apps.get_model("app", "ServiceHistory")
+    WarehouseUse = apps.get_model("app", "WarehouseUse")
+    Service = apps.get_model("app", "Service")
+    WarehouseItem = apps.get_model("app", "WarehouseItem")
+
+    ServiceHistory.objects.update(price=Subquery(Service._base_manager.filter(pk=OuterRef("service_id")).values("price")))
+    WarehouseUse.objects.update(price=Subquery(WarehouseItem._base_manager.filter(pk=OuterRef("item_id")).values("price")))
+
+    def total(queryset, line_total):
+        return Coalesce(Subquery(
+            queryset.filter(repair_order=OuterRef("pk")).order_by().values("repair_order")
+                .annotate(total=Sum(line_total)).values("total")
+        ), Value(0), output_field=models.DecimalField())
+    RepairOrder._base_manager.update(
+        total=total(ServiceHistory.objects, "price") + total(WarehouseUse.objects, F("price") * F("amount"))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0036_warehouseitem_sku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repairorder',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='Итого'),
+        ),
+        migrations.AddField(
+            model_name='servicehistory',
+            name='price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=7, verbose_name='Цена'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='warehouseuse',
+            name='price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=7, verbose_name='Цена'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
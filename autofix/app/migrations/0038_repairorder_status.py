@@ -0,0 +1,35 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+
+def fill_status(apps, schema_editor):
+    RepairOrder = apps.get_model("app", "RepairOrder")
+    RepairOrder._base_manager.update(status=Case(
+        When(finish_date__isnull=True, then=Value("OP")),
+        When(is_cancelled=True, then=Value("CA")),
+        When(is_warranty=True, then=Value("WA")),
+        When(is_paid=True, then=Value("PA")),
+        default=Value("UN")
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0037_repair_order_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repairorder',
+            name='status',
+            field=models.CharField(choices=[('OP', 'Открыта'), ('OV', 'Просрочена'), ('TD', 'Срок сегодня'), ('UN', 'Не оплачена'), ('PA', 'Оплачена'), ('WA', 'Гарантийная'), ('CA', 'Отменена')], default='OP', editable=False, max_length=2, verbose_name='Статус'),
+        ),
+        migrations.AddIndex(
+            model_name='repairorder',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['status', 'finish_until'], name='app_repairorder_status'),
+        ),
+        migrations.RunPython(fill_status, migrations.RunPython.noop),
+    ]
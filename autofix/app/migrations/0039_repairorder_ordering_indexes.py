@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0038_repairorder_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='repairorder',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['finish_until', 'id'], name='app_repairorder_due'),
+        ),
+        migrations.AddIndex(
+            model_name='repairorder',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['start_date', 'id'], name='app_repairorder_new'),
+        ),
+    ]
@@ -1,16 +1,28 @@
-import sys
-from django.db import connection, models
-from django.db.models import Sum, Q
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.db import connection, models, transaction
+from django.db.models import Case, F, OuterRef, Subquery, Sum, Q, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import *
 from django.core.validators import MaxValueValidator, MinValueValidator, MinLengthValidator
 from django.forms import ValidationError
-from softdelete.models import SoftDeleteObject
+from softdelete.models import SoftDeleteObject, SoftDeleteManager
 from phonenumber_field.modelfields import PhoneNumberField
 from django.utils import timezone
 from django.urls import reverse
+from .search import FullTextSearchMixin
 
 datetime_format = "%d.%m.%Y"
 
+def get_day_end(date):
+    """Beginning of the next day in the current time zone, which ends the day."""
+    return timezone.make_aware(datetime.combine(date + timedelta(days=1), datetime.min.time()))
+
+def get_item_count_error(name, total_quantity, new_total_quantity):
+    return ValidationError(
+        {name: f"Недостаточно единиц расходника. Требуется еще {-new_total_quantity} шт., имеется: {total_quantity} шт."}
+    )
+
 def validate_item_count(current, item, name, is_negative = False):
     # Calculate the total quantity of the item based on WarehouseRestock and WarehouseUse objects
     total_quantity = item.get_count(current)
@@ -21,105 +33,7 @@ def validate_item_count(current, item, name, is_negative = False):
 
     # Check if the new total quantity is less than 0
     if new_total_quantity < 0:
-        raise ValidationError(
-            {name: f"Недостаточно единиц расходника. Требуется еще {-new_total_quantity} шт., имеется: {total_quantity} шт."}
-        )
-
-class FullTextSearchMixin:
-    search_initialized = False
-
-    @staticmethod
-    def initialize_search(cls):
-        if cls.search_initialized:
-            return
-
-        model_name = cls.__name__.lower()
-        field_defs = cls.get_search_field_defs()
-
-        def make_insert_stmt():
-            return f"""
-                INSERT INTO app_{model_name}_search
-                    SELECT {", ".join(
-                        [f"app_{model_name}.{field}" for field in field_defs[0][1]] +
-                        [", ".join([f"{fk_name}.{field} AS {fk_name}_{field}" for field in fields]) for [jcls, fields, fk_name] in field_defs[1:]]
-                    )}
-                    FROM app_{model_name}
-                    {" ".join([f"JOIN app_{jcls.__name__.lower()} {fk_name} ON {jcls.__name__.lower()}.id = app_{model_name}.{fk_name}_id" for [jcls, fields, fk_name] in field_defs[1:]])}
-                    WHERE 1
-                        {f"AND app_{model_name}.deleted_at IS NULL" if hasattr(cls, "deleted_at") else ""}
-            """
-        def make_delete_stmt():
-            return f"DELETE FROM app_{model_name}_search WHERE id = old.id;"
-
-        with connection.cursor() as cursor:
-            cursor.execute(f"DROP TABLE IF EXISTS app_{model_name}_search;")
-            if not ('makemigrations' in sys.argv or 'migrate' in sys.argv):
-                cursor.execute(f"""
-                    CREATE VIRTUAL TABLE app_{model_name}_search USING FTS5({",".join(field_defs[0][1] + [",".join([f"{fk_name}_{field}" for field in fields]) for [jcls, fields, fk_name] in field_defs[1:]])});
-                """)
-                cursor.execute(make_insert_stmt() + ";")
-
-            cursor.execute(f"DROP TRIGGER IF EXISTS app_{model_name}_search_insert;")
-            if not ('makemigrations' in sys.argv or 'migrate' in sys.argv):
-                cursor.execute(f"""
-                    CREATE TRIGGER app_{model_name}_search_insert AFTER INSERT ON app_{model_name} BEGIN
-                        {make_insert_stmt()} AND app_{model_name}.id = new.id;
-                    END;
-                """)
-
-            cursor.execute(f"DROP TRIGGER IF EXISTS app_{model_name}_search_update;")
-            if not ('makemigrations' in sys.argv or 'migrate' in sys.argv):
-                cursor.execute(f"""
-                    CREATE TRIGGER app_{model_name}_search_update AFTER UPDATE ON app_{model_name} BEGIN
-                        {make_delete_stmt()}
-                        {make_insert_stmt()} AND app_{model_name}.id = new.id;
-                    END;
-                """)
-
-            for [jcls, fields, fk_name] in field_defs[1:]:
-                cursor.execute(f"DROP TRIGGER IF EXISTS app_{model_name}_search_update_by_{fk_name};")
-                if not ('makemigrations' in sys.argv or 'migrate' in sys.argv):
-                    cursor.execute(f"""
-                        CREATE TRIGGER app_{model_name}_search_update_by_{fk_name} AFTER UPDATE ON app_{jcls.__name__.lower()} BEGIN
-                            DELETE FROM app_{model_name}_search
-                                WHERE id IN (SELECT id FROM app_{model_name} WHERE {fk_name}_id = old.id);
-                            {make_insert_stmt()} AND app_{model_name}.{fk_name}_id = new.id;
-                        END;
-                    """)
-
-            cursor.execute(f"DROP TRIGGER IF EXISTS app_{model_name}_search_delete;")
-            if not ('makemigrations' in sys.argv or 'migrate' in sys.argv):
-                cursor.execute(f"""
-                    CREATE TRIGGER app_{model_name}_search_delete AFTER DELETE ON app_{model_name} BEGIN
-                        {make_delete_stmt()}
-                    END;
-                """)
-
-        cls.search_initialized = True
-
-    @classmethod
-    def get_search_field_defs_with_key(cls, fk_name: str | None):
-        return (
-            cls,
-            (["id"] if not fk_name else []) +
-                [key for [key, value] in cls.__dict__.items()
-                 if hasattr(value, "field") and isinstance(value.field, (models.CharField, PhoneNumberField))],
-            fk_name
-        )
-
-    @classmethod
-    def get_search_field_defs(cls):
-        return [cls.get_search_field_defs_with_key(None)]
-
-    @classmethod
-    def search(cls, search: str):
-        with connection.cursor() as cursor:
-            cursor.execute(f"""
-                SELECT id FROM app_{cls.__name__.lower()}_search (%s);
-            """, [" ".join([f"\"{s}\"" for s in search.split()])])
-            results = cursor.fetchall()
-        return Q(id__in=[result[0] for result in results])
-
+        raise get_item_count_error(name, total_quantity, new_total_quantity)
 
 class Employee(FullTextSearchMixin, AbstractUser):
     morphed_name = "сотрудника"
@@ -141,6 +55,9 @@ class Employee(FullTextSearchMixin, AbstractUser):
     end_date = models.DateField("Дата увольнения", blank=True, null=True)
     end_reason = models.CharField("Причина увольнения", max_length=150, blank=True)
 
+    # Choosing a mechanic doesn't reveal their passport
+    autocomplete_fields = ["last_name", "first_name", "patronymic"]
+
     create_allowed_to = []
     edit_allowed_to = []
 
@@ -177,7 +94,7 @@ class Employee(FullTextSearchMixin, AbstractUser):
 
     def __str__(self) -> str:
         return self.full_name() + self.end_date_reason(True)
-FullTextSearchMixin.initialize_search(Employee)
+FullTextSearchMixin.register_search(Employee)
 
 
 class Service(FullTextSearchMixin, SoftDeleteObject, models.Model):
@@ -199,9 +116,20 @@ class Service(FullTextSearchMixin, SoftDeleteObject, models.Model):
 
     def __str__(self):
         return f"{self.name} ({self.price} руб.)"
-FullTextSearchMixin.initialize_search(Service)
+FullTextSearchMixin.register_search(Service)
 
 
+def digits_prefix_filter(field, prefix):
+    # Prefixes are looked up as ranges, since LIKE escaped by Django can't use indexes on SQLite
+    upper = str(int(prefix) + 1).zfill(len(prefix))
+    return Q(**{f"{field}__gte": prefix}) & (Q(**{f"{field}__lt": upper}) if len(upper) == len(prefix) else Q())
+
+class ClientManager(SoftDeleteManager):
+    def bulk_create(self, objs, *args, **kwargs):
+        for obj in objs:
+            obj.update_phone_digits()
+        return super().bulk_create(objs, *args, **kwargs)
+
 class Client(FullTextSearchMixin, SoftDeleteObject, models.Model):
     morphed_name = "клиента"
 
@@ -210,6 +138,41 @@ class Client(FullTextSearchMixin, SoftDeleteObject, models.Model):
 
     full_name = models.CharField("ФИО", max_length=100)
     phone_number = PhoneNumberField("Номер телефона", region="RU")
+    # Digits of the phone number, and reversed ones for lookups by the last digits
+    phone_digits = models.CharField(max_length=20, db_index=True, editable=False)
+    phone_digits_reversed = models.CharField(max_length=20, db_index=True, editable=False)
+
+    objects = ClientManager()
+
+    def update_phone_digits(self):
+        self.phone_digits = re.sub(r"\D", "", str(self.phone_number or ""))
+        self.phone_digits_reversed = self.phone_digits[::-1]
+
+    def save(self, *args, **kwargs):
+        self.update_phone_digits()
+        if kwargs.get("update_fields") is not None and "phone_number" in kwargs["update_fields"]:
+            kwargs["update_fields"] = [*kwargs["update_fields"], "phone_digits", "phone_digits_reversed"]
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def get_phone_filter(search: str):
+        """
+        Filter of clients by the whole phone number, its beginning or its last digits
+        when the search looks like a phone number, None otherwise.
+        """
+        if not re.fullmatch(r"[\d\s()+\-]+", search):
+            return None
+        digits = re.sub(r"\D", "", search)
+        if len(digits) < 4:
+            return None
+
+        filter = digits_prefix_filter("phone_digits", digits) | digits_prefix_filter("phone_digits_reversed", digits[::-1])
+        # Russian numbers are also written with the 8 trunk prefix or without the country code
+        if digits[0] == "8" and not search.lstrip().startswith("+"):
+            filter |= digits_prefix_filter("phone_digits", "7" + digits[1:])
+        elif digits[0] == "9":
+            filter |= digits_prefix_filter("phone_digits", "7" + digits)
+        return filter
 
     create_allowed_to = [Employee.Position.ServiceManager]
     edit_allowed_to = [Employee.Position.ServiceManager]
@@ -222,7 +185,7 @@ class Client(FullTextSearchMixin, SoftDeleteObject, models.Model):
 
     def __str__(self) -> str:
         return f"{self.full_name} ({self.phone_number})"
-FullTextSearchMixin.initialize_search(Client)
+FullTextSearchMixin.register_search(Client)
 
 
 class Vehicle(FullTextSearchMixin, SoftDeleteObject, models.Model):
@@ -237,6 +200,8 @@ class Vehicle(FullTextSearchMixin, SoftDeleteObject, models.Model):
     license_number = models.CharField("Гос. номер", max_length=15)
     vin = models.CharField("VIN автомобиля", max_length=17, validators=[MinLengthValidator(17)])
 
+    search_identifiers = ["license_number", "vin"]
+
     create_allowed_to = [Employee.Position.ServiceManager]
     edit_allowed_to = [Employee.Position.ServiceManager]
 
@@ -250,7 +215,7 @@ class Vehicle(FullTextSearchMixin, SoftDeleteObject, models.Model):
 
     def __str__(self) -> str:
         return f"{self.vin} {self.license_number} {self.manufacturer} {self.model} {self.year} г."
-FullTextSearchMixin.initialize_search(Vehicle)
+FullTextSearchMixin.register_search(Vehicle)
 
 
 class RepairOrder(FullTextSearchMixin, SoftDeleteObject, models.Model):
@@ -258,6 +223,16 @@ class RepairOrder(FullTextSearchMixin, SoftDeleteObject, models.Model):
     def get_absolute_url(self):
         return reverse("order", kwargs={"pk": self.pk})
 
+    class Status(models.TextChoices):
+        Open = "OP", "Открыта"
+        # Open orders past or at their due date, which aren't stored since they depend on today's date
+        Overdue = "OV", "Просрочена"
+        DueToday = "TD", "Срок сегодня"
+        Unpaid = "UN", "Не оплачена"
+        Paid = "PA", "Оплачена"
+        Warranty = "WA", "Гарантийная"
+        Cancelled = "CA", "Отменена"
+
     master = models.ForeignKey(Employee, on_delete=models.DO_NOTHING, limit_choices_to={"position": Employee.Position.Mechanic, "end_date__isnull": True}, verbose_name="Мастер")
 
     client = models.ForeignKey(Client, on_delete=models.DO_NOTHING, verbose_name="Клиент")
@@ -275,11 +250,28 @@ class RepairOrder(FullTextSearchMixin, SoftDeleteObject, models.Model):
 
     is_paid = models.BooleanField("Оплачено", default=False)
     is_warranty = models.BooleanField("Гарантийный ремонт", default=False)
+    # Sum of prices of the services and items of the order, kept in sync by RepairOrderLineMixin
+    total = models.DecimalField("Итого", max_digits=10, decimal_places=2, default=0, editable=False)
+    # Derived from the fields above by save
+    status = models.CharField("Статус", max_length=2, choices=Status.choices, default=Status.Open, editable=False)
+
+    class Meta(SoftDeleteObject.Meta):
+        indexes = [models.Index(fields=["status", "finish_until"], condition=Q(deleted_at__isnull=True),
+                                name="app_repairorder_status"),
+                   # Orderings of the list, whose pages are found by seeking to the last row of the previous one
+                   models.Index(fields=["finish_until", "id"], condition=Q(deleted_at__isnull=True),
+                                name="app_repairorder_due"),
+                   models.Index(fields=["start_date", "id"], condition=Q(deleted_at__isnull=True),
+                                name="app_repairorder_new")]
 
     create_allowed_to = [Employee.Position.ServiceManager]
     edit_allowed_to = [Employee.Position.ServiceManager,
                        Employee.Position.Mechanic,
                        Employee.Position.Cashier]
+    print_allowed_to = [Employee.Position.ServiceManager]
+    margin_allowed_to = []
+    # Positions seeing only the orders they are the master of
+    own_rows_only = {Employee.Position.Mechanic: "master_id"}
 
     def clean(self):
         errors = {}
@@ -308,35 +300,76 @@ class RepairOrder(FullTextSearchMixin, SoftDeleteObject, models.Model):
             Vehicle.get_search_field_defs_with_key("vehicle")
         ]
 
-    def get_total_cost(self):
-        return (
-            ServiceHistory.objects
-                .filter(repair_order=self)
-                .aggregate(total_cost=Sum('service__price'))['total_cost'] or 0
+    def get_status(self):
+        if not self.finish_date:
+            return RepairOrder.Status.Open
+        if self.is_cancelled:
+            return RepairOrder.Status.Cancelled
+        if self.is_warranty:
+            return RepairOrder.Status.Warranty
+        return RepairOrder.Status.Paid if self.is_paid else RepairOrder.Status.Unpaid
+
+    @staticmethod
+    def get_current_status(today):
+        """Expression of the status of an order, with open orders due by today being overdue or due today."""
+        return Case(
+            When(status=RepairOrder.Status.Open, finish_until__lt=today, then=Value(RepairOrder.Status.Overdue)),
+            When(status=RepairOrder.Status.Open, finish_until=today, then=Value(RepairOrder.Status.DueToday)),
+            default=F("status")
         )
 
+    @staticmethod
+    def get_current_status_filter(status, today):
+        """Filter of orders with the current status, which can use the index of stored statuses."""
+        if status == RepairOrder.Status.Overdue:
+            return Q(status=RepairOrder.Status.Open, finish_until__lt=today)
+        if status == RepairOrder.Status.DueToday:
+            return Q(status=RepairOrder.Status.Open, finish_until=today)
+        if status == RepairOrder.Status.Open:
+            return Q(status=status) & (Q(finish_until__isnull=True) | Q(finish_until__gt=today))
+        return Q(status=status)
+
+    def save(self, *args, **kwargs):
+        self.status = self.get_status()
+        # Saving an order loaded before its lines changed must not overwrite its total
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != "total"]
+        elif kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "status"}
+        super().save(*args, **kwargs)
+
     card_icon = "car"
+    # Rows, columns and annotations cards need, applied by list views so that cards don't query
+    card_select_related = ["client", "vehicle", "master"]
+    card_defer = ["complaints", "diagnostic_results"]
+    @staticmethod
+    def get_card_annotations():
+        return {"current_status": RepairOrder.get_current_status(timezone.localdate())}
     def card_title(self):
         return f"№{self.id}: {self.vehicle}"
     def card_tags(self):
         result = {}
-        if self.finish_date:
-            if self.is_cancelled:
-                result.update({ "Отменен": "secondary" })
-            else:
-                result.update({ f"Завершен {self.finish_date.strftime(datetime_format)}": "secondary" })
-                if self.finish_until and self.finish_until < self.finish_date:
-                    result.update({ f"Просрочен": "danger" })
-                if not self.is_paid:
-                    result.update({ "Не оплачен": "primary" })
-                elif self.is_warranty:
-                    result.update({ "Гарантийный": "primary" })
+        if self.status == RepairOrder.Status.Cancelled:
+            result.update({ "Отменен": "secondary" })
+        elif self.finish_date:
+            result.update({ f"Завершен {self.finish_date.strftime(datetime_format)}": "secondary" })
+            if self.finish_until and self.finish_until < self.finish_date:
+                result.update({ f"Просрочен": "danger" })
+            if self.status == RepairOrder.Status.Unpaid:
+                result.update({ "Не оплачен": "primary" })
+            elif self.status == RepairOrder.Status.Warranty:
+                result.update({ "Гарантийный": "primary" })
         elif self.finish_until:
+            # Lists annotate the current status, computed by the database
+            status = getattr(self, "current_status", None)
+            if status is None:
+                today = timezone.localdate()
+                status = (RepairOrder.Status.Overdue if self.finish_until < today
+                          else RepairOrder.Status.DueToday if self.finish_until == today else RepairOrder.Status.Open)
             result.update({
                 f"Завершить до: {self.finish_until.strftime(datetime_format)}":
-                    "secondary" if self.finish_until > timezone.now().date()
-                    else "warning" if self.finish_until == timezone.now().date()
-                    else "danger"
+                    {RepairOrder.Status.Overdue: "danger", RepairOrder.Status.DueToday: "warning"}.get(status, "secondary")
             })
         else:
             result.update({ f"Создана: {self.start_date.strftime(datetime_format)}": "secondary" })
@@ -347,8 +380,49 @@ class RepairOrder(FullTextSearchMixin, SoftDeleteObject, models.Model):
     def card_subtitle(self):
         return f"Клиент: {self.client}"
     def card_subtitle_extra(self):
-        return f"Мастер: {self.master}"
-FullTextSearchMixin.initialize_search(RepairOrder)
+        return f"Мастер: {self.master}. Итого: {self.total} руб."
+FullTextSearchMixin.register_search(RepairOrder)
+
+class RepairOrderLineMixin:
+    """
+    Adds the price of the line to the stored total of its repair order.
+
+    The price is copied from the service or the item when the line is created or changed to another one,
+    so that later price changes don't alter totals of past orders.
+    """
+    # Foreign key to the service or the item the price is copied from
+    priced_field = None
+
+    def get_line_total(self):
+        return self.price
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        stored = None if self._state.adding else type(self)._base_manager.filter(pk=self.pk).first()
+        if stored is None or getattr(stored, f"{self.priced_field}_id") != getattr(self, f"{self.priced_field}_id"):
+            self.price = getattr(self, self.priced_field).price
+        super().save(*args, **kwargs)
+
+        changes = {self.repair_order_id: self.get_line_total()}
+        if stored is not None:
+            changes[stored.repair_order_id] = changes.get(stored.repair_order_id, 0) - stored.get_line_total()
+        self.add_to_totals(changes)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        stored = type(self)._base_manager.filter(pk=self.pk).first()
+        result = super().delete(*args, **kwargs)
+        if stored is not None:
+            self.add_to_totals({stored.repair_order_id: -stored.get_line_total()})
+        return result
+
+    def add_to_totals(self, changes):
+        for order_id, change in changes.items():
+            if change:
+                RepairOrder._base_manager.filter(pk=order_id).update(total=F("total") + change)
+                # The order the line was saved with shows the new total too
+                if order_id == self.repair_order_id and self._meta.get_field("repair_order").is_cached(self):
+                    self.repair_order.total += change
 
 
 class WarehouseProvider(FullTextSearchMixin, SoftDeleteObject, models.Model):
@@ -370,7 +444,7 @@ class WarehouseProvider(FullTextSearchMixin, SoftDeleteObject, models.Model):
 
     def __str__(self):
         return f"{self.name} ({self.contact_info})"
-FullTextSearchMixin.initialize_search(WarehouseProvider)
+FullTextSearchMixin.register_search(WarehouseProvider)
 
 
 class WarehouseItem(FullTextSearchMixin, SoftDeleteObject, models.Model):
@@ -381,6 +455,19 @@ class WarehouseItem(FullTextSearchMixin, SoftDeleteObject, models.Model):
     name = models.CharField("Наименование", max_length=50)
     type = models.CharField("Тип", max_length=50)
     price = models.DecimalField("Цена", max_digits=7, decimal_places=2, validators=[MinValueValidator(0)])
+    sku = models.CharField("Штрихкод", max_length=50, blank=True, null=True)
+    # Restocked minus used amount, kept in sync by WarehouseRestock and WarehouseUse
+    stock = models.IntegerField("В наличии", default=0, editable=False)
+    reorder_threshold = models.IntegerField("Минимальный остаток", default=0, validators=[MinValueValidator(0)])
+    # Whether the stock is below the threshold, updated along with the stock
+    is_low_stock = models.BooleanField(default=False, editable=False)
+
+    class Meta(SoftDeleteObject.Meta):
+        indexes = [models.Index(fields=["name"], condition=Q(is_low_stock=True, deleted_at__isnull=True),
+                                name="app_warehouseitem_low_stock")]
+        # Barcodes of deleted items can be given to new ones
+        constraints = [models.UniqueConstraint(fields=["sku"], condition=Q(deleted_at__isnull=True), name="app_warehouseitem_sku",
+                                               violation_error_message="Расходник с таким штрихкодом уже есть.")]
 
     create_allowed_to = [Employee.Position.WarehouseManager]
     edit_allowed_to = [Employee.Position.WarehouseManager]
@@ -389,44 +476,218 @@ class WarehouseItem(FullTextSearchMixin, SoftDeleteObject, models.Model):
     def card_title(self):
         return f"{self.name} ({self.price} руб.)"
     def card_tags(self):
-        return {f"{self.get_count()} шт.": "secondary"}
+        return {f"{self.stock} шт.": "danger" if self.is_low_stock else "secondary"}
     def card_subtitle(self):
         return self.type
 
+    def clean(self):
+        # The constraint isn't validated by forms, which leave out deleted_at from its condition
+        if self.sku and WarehouseItem.objects.filter(sku=self.sku).exclude(pk=self.pk).exists():
+            raise ValidationError({"sku": "Расходник с таким штрихкодом уже есть."})
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.is_low_stock = self.stock < self.reorder_threshold
+            return super().save(*args, **kwargs)
+
+        # Saving an item loaded before a restock or use must not overwrite its stock
+        if kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in ["stock", "is_low_stock"]]
+        super().save(*args, **kwargs)
+        if "reorder_threshold" in kwargs["update_fields"]:
+            WarehouseItem._base_manager.filter(pk=self.pk).update(is_low_stock=WarehouseItem.get_low_stock())
+
+    @staticmethod
+    def get_low_stock(change=0):
+        """Expression of whether the stock of an item with the change applied is below the threshold, for updates applying it."""
+        return Case(When(stock__lt=F("reorder_threshold") - change, then=Value(True)), default=Value(False))
+
+    @staticmethod
+    def get_ledger_stock():
+        """Expression of the stock of an item computed from its restocks and uses."""
+        def total(cls):
+            return Coalesce(Subquery(
+                cls.objects.filter(item=OuterRef("pk")).order_by().values("item").annotate(total=Sum("amount")).values("total")
+            ), 0)
+        return total(WarehouseRestock) - total(WarehouseUse)
+
+    @staticmethod
+    def get_stock_at(moment):
+        """Expression of the stock of an item before the moment, from its latest snapshot and the movements since."""
+        moved = WarehouseMovement.get_since_snapshot(moment).order_by().values("item").annotate(total=Sum("change")).values("total")
+        return Coalesce(Subquery(WarehouseStockSnapshot.get_latest(moment).values("stock")[:1]), 0) + Coalesce(Subquery(moved), 0)
+
     def get_count(self, exclude = None):
-        return (
-            WarehouseRestock.objects
-                .filter(item=self)
-                .exclude(id = exclude.id if isinstance(exclude, WarehouseRestock) else 0)
-                .aggregate(total_quantity=Sum('amount'))['total_quantity'] or 0
-        ) - (
-            WarehouseUse.objects
-                .filter(item=self)
-                .exclude(id = exclude.id if isinstance(exclude, WarehouseUse) else 0)
-                .aggregate(total_quantity=Sum('amount'))['total_quantity'] or 0
-        )
+        """Current stock of the item, without the stored amount of the restock or use being edited."""
+        stock = WarehouseItem._base_manager.filter(pk=self.pk).values_list("stock", flat=True).first() or 0
+        if exclude is not None and exclude.pk is not None:
+            amount = type(exclude).objects.filter(pk=exclude.pk, item=self).values_list("amount", flat=True).first() or 0
+            stock -= amount * exclude.stock_sign
+        return stock
+
+    def get_scan_result(self):
+        return {"id": self.pk, "text": str(self), "stock": self.stock, "is_low_stock": self.is_low_stock}
 
     def __str__(self):
-        return f"{self.type} {self.name}" + (f" ({self.get_count()} шт.)" if not self.deleted_at else "")
-FullTextSearchMixin.initialize_search(WarehouseItem)
+        return f"{self.type} {self.name}" + (f" ({self.stock} шт.)" if not self.deleted_at else "")
+FullTextSearchMixin.register_search(WarehouseItem)
+
+class WarehouseMovement(models.Model):
+    """Change of the stock of an item, written along with it, which dates the stock."""
+    item = models.ForeignKey(WarehouseItem, on_delete=models.DO_NOTHING)
+    change = models.IntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["item", "created_at"])]
+
+    @staticmethod
+    def get_since_snapshot(moment):
+        """Movements of an item before the moment not counted in its latest snapshot."""
+        since = Subquery(WarehouseStockSnapshot.get_latest(moment, OuterRef(OuterRef("pk"))).values("taken_at")[:1])
+        return WarehouseMovement.objects.filter(
+            item=OuterRef("pk"), created_at__lt=moment,
+            created_at__gte=Coalesce(since, Value(datetime.min.replace(tzinfo=dt_timezone.utc)))
+        )
+
+class WarehouseStockSnapshot(models.Model):
+    """
+    Stock of an item before the moment it was taken at, the end of a day.
+
+    Taken periodically by the snapshot_stock command, so that stocks at past dates
+    add up only the movements since the latest snapshot.
+    """
+    item = models.ForeignKey(WarehouseItem, on_delete=models.DO_NOTHING)
+    taken_at = models.DateTimeField()
+    stock = models.IntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["item", "taken_at"], name="app_warehousestocksnapshot_item_taken_at")]
+
+    @staticmethod
+    def get_latest(moment, item=OuterRef("pk")):
+        return WarehouseStockSnapshot.objects.filter(item=item, taken_at__lte=moment).order_by("-taken_at")
+
+
+class WarehouseStockMixin:
+    """
+    Applies the amount to the stock of the item, added for restocks and subtracted for uses.
+
+    Changes that would leave the stock negative raise ValidationError, checked by the database
+    when the stock is updated, so that concurrent uses can't take the same units.
+    """
+    stock_sign = 1
+    # Items whose stocks are changed by a single statement
+    stock_batch_size = 500
+
+    def get_stored_stock_change(self):
+        row = type(self)._base_manager.select_for_update().filter(pk=self.pk).values("item_id", "amount").first()
+        return {row["item_id"]: -row["amount"] * self.stock_sign} if row else {}
 
+    @staticmethod
+    def update_stock(changes):
+        """Applies the changes to the stocks. Returns the id and the stock of an item left unchanged for the lack of it."""
+        changes = sorted((item_id, change) for item_id, change in changes.items() if change)
+        batch_size = WarehouseStockMixin.stock_batch_size
+        items = WarehouseItem._base_manager
+
+        # Items are locked in the same order by every transaction to avoid deadlocks
+        if len(changes) > 1 and connection.features.has_select_for_update:
+            for start in range(0, len(changes), batch_size):
+                list(items.select_for_update().filter(pk__in=[item_id for item_id, change in changes[start:start + batch_size]])
+                     .order_by("pk").values_list("pk"))
+
+        # Additions can't fail, so the same addition to many items is made by a statement per batch
+        additions = {}
+        for item_id, change in changes:
+            if change > 0:
+                additions.setdefault(change, []).append(item_id)
+        for change, item_ids in additions.items():
+            for start in range(0, len(item_ids), batch_size):
+                items.filter(pk__in=item_ids[start:start + batch_size]).update(
+                    stock=F("stock") + change, is_low_stock=WarehouseItem.get_low_stock(change)
+                )
+        for item_id, change in changes:
+            if change < 0 and not items.filter(pk=item_id, stock__gte=-change).update(
+                    stock=F("stock") + change, is_low_stock=WarehouseItem.get_low_stock(change)):
+                return item_id, items.filter(pk=item_id).values_list("stock", flat=True).first() or 0
+
+        WarehouseMovement.objects.bulk_create([WarehouseMovement(item_id=item_id, change=change) for item_id, change in changes])
+        return None
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        stored = self.get_stored_stock_change() if not self._state.adding else {}
+        changes = stored.copy()
+        changes[self.item_id] = changes.get(self.item_id, 0) + self.amount * self.stock_sign
+        lack = self.update_stock(changes)
+        if lack:
+            item_id, stock = lack
+            raise get_item_count_error("amount", stock + stored.get(item_id, 0), stock + changes[item_id])
+        super().save(*args, **kwargs)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        lack = self.update_stock(self.get_stored_stock_change())
+        if lack:
+            raise ValidationError(f"Расходник уже использован, в наличии {lack[1]} шт. из {self.amount} шт. пополнения.")
+        return super().delete(*args, **kwargs)
+
+    @classmethod
+    def before_bulk_create(cls, objs):
+        pass
 
-class WarehouseRestock(models.Model):
+    @classmethod
+    def after_bulk_create(cls, objs):
+        pass
+
+    def get_save_fields(self, kwargs, excluded):
+        """Fields saved by a non-adding save, without the excluded ones kept up to date by updates."""
+        if kwargs.get("update_fields") is not None:
+            return kwargs["update_fields"]
+        return [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name not in excluded]
+
+class WarehouseStockManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        # Stocks are changed as by saving the rows one by one, but in batches
+        objs = list(objs)
+        changes = {}
+        for obj in objs:
+            changes[obj.item_id] = changes.get(obj.item_id, 0) + obj.amount * self.model.stock_sign
+        with transaction.atomic(using=self.db):
+            lack = self.model.update_stock(changes)
+            if lack:
+                item_id, stock = lack
+                raise get_item_count_error("amount", stock, stock + changes[item_id])
+            self.model.before_bulk_create(objs)
+            objs = super().bulk_create(objs, *args, **kwargs)
+            self.model.after_bulk_create(objs)
+            return objs
+
+class WarehouseRestock(WarehouseStockMixin, models.Model):
     morphed_name = "пополнения расходника"
 
     def get_absolute_url(self):
-        return reverse("restock", kwargs={"item": self.item.id, "pk": self.pk})
+        return reverse("restock", kwargs={"item": self.item_id, "pk": self.pk})
 
     item = models.ForeignKey(WarehouseItem, on_delete=models.DO_NOTHING, verbose_name="Расходник")
     provider = models.ForeignKey(WarehouseProvider, on_delete=models.DO_NOTHING, verbose_name="Поставщик")
     amount = models.IntegerField("Количество", validators=[MinValueValidator(1)])
+    unit_cost = models.DecimalField("Цена закупки", max_digits=7, decimal_places=2, blank=True, validators=[MinValueValidator(0)],
+                                    help_text="Если не указана, берется текущая цена расходника.")
+    # Units not taken by uses yet, which are taken from the oldest restocks first
+    remaining = models.IntegerField(default=0, editable=False)
+
+    objects = WarehouseStockManager()
 
     create_allowed_to = [Employee.Position.WarehouseManager]
     edit_allowed_to = [Employee.Position.WarehouseManager]
 
     card_icon = "box"
+    card_select_related = ["provider"]
     def card_title(self):
-        return f"{self.amount} шт."
+        return f"{self.amount} шт. по {self.unit_cost} руб."
     def card_subtitle(self):
         return self.provider.name
     def card_clickable(self):
@@ -435,38 +696,211 @@ class WarehouseRestock(models.Model):
     def clean(self):
         validate_item_count(self, self.item, "amount")
 
-class WarehouseUse(models.Model):
+    @classmethod
+    def before_bulk_create(cls, objs):
+        prices = dict(WarehouseItem._base_manager.filter(pk__in={obj.item_id for obj in objs if obj.unit_cost is None})
+                      .values_list("id", "price"))
+        for obj in objs:
+            if obj.unit_cost is None:
+                obj.unit_cost = prices[obj.item_id]
+            obj.remaining = obj.amount
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        if self.unit_cost is None:
+            self.unit_cost = WarehouseItem._base_manager.filter(pk=self.item_id).values_list("price", flat=True).first()
+        if self._state.adding:
+            self.remaining = self.amount
+            return super().save(*args, **kwargs)
+
+        stored = (WarehouseRestock._base_manager.select_for_update().filter(pk=self.pk)
+                  .values("item_id", "amount", "unit_cost", "remaining").first())
+        kwargs["update_fields"] = self.get_save_fields(kwargs, ["remaining"])
+        super().save(*args, **kwargs)
+        if stored["unit_cost"] != self.unit_cost:
+            WarehouseUse._base_manager.filter(pk__in=WarehouseConsumption.objects.filter(restock=self).values("use")).update(
+                cost=F("cost") + Subquery(
+                    WarehouseConsumption.objects.filter(restock=self, use=OuterRef("pk")).order_by()
+                        .values("use").annotate(total=Sum("amount")).values("total")
+                ) * (self.unit_cost - stored["unit_cost"])
+            )
+
+        if stored["item_id"] != self.item_id:
+            # The restock starts over as a layer of the other item
+            self.remaining = self.amount
+            self.return_taken(stored["item_id"], stored["amount"] - stored["remaining"])
+        else:
+            self.remaining = stored["remaining"] + self.amount - stored["amount"]
+            if self.remaining < 0:
+                self.return_taken(self.item_id, -self.remaining)
+                self.remaining = 0
+        WarehouseRestock._base_manager.filter(pk=self.pk).update(remaining=self.remaining)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        stored = WarehouseRestock._base_manager.select_for_update().filter(pk=self.pk).values("item_id", "amount", "remaining").first()
+        self.return_taken(stored["item_id"], stored["amount"] - stored["remaining"])
+        return super().delete(*args, **kwargs)
+
+    def return_taken(self, item_id, count):
+        """Moves count units taken from the restock, latest uses first, to other restocks of the item."""
+        moved = {}
+        for [id, use_id, amount] in WarehouseConsumption.objects.filter(restock=self).order_by("-use_id", "-id").values_list("id", "use_id", "amount"):
+            if not count:
+                break
+            taken = min(amount, count)
+            if taken == amount:
+                WarehouseConsumption.objects.filter(pk=id).delete()
+            else:
+                WarehouseConsumption.objects.filter(pk=id).update(amount=F("amount") - taken)
+            moved[use_id] = moved.get(use_id, 0) + taken
+            count -= taken
+
+        costs = WarehouseConsumption.take(item_id, moved, exclude=self.pk)
+        for use_id, cost in costs.items():
+            WarehouseUse._base_manager.filter(pk=use_id).update(cost=F("cost") + cost - moved[use_id] * self.unit_cost)
+
+class WarehouseUse(RepairOrderLineMixin, WarehouseStockMixin, models.Model):
     morphed_name = "использованного расходника"
+    stock_sign = -1
 
     def get_absolute_url(self):
-        return reverse("warehouse_use", kwargs={"order": self.repair_order.id, "pk": self.pk})
+        return reverse("warehouse_use", kwargs={"order": self.repair_order_id, "pk": self.pk})
 
     repair_order = models.ForeignKey(RepairOrder, on_delete=models.DO_NOTHING, verbose_name="Заявка на ремонт")
     item = models.ForeignKey(WarehouseItem, on_delete=models.DO_NOTHING, verbose_name="Расходник")
     amount = models.IntegerField("Количество", validators=[MinValueValidator(1)])
+    price = models.DecimalField("Цена", max_digits=7, decimal_places=2, editable=False)
+    # Purchase cost of the used units, from the restocks they are taken from
+    cost = models.DecimalField("Себестоимость", max_digits=10, decimal_places=2, default=0, editable=False)
+
+    objects = WarehouseStockManager()
 
     create_allowed_to = [Employee.Position.Mechanic]
     edit_allowed_to = [Employee.Position.Mechanic]
 
+    priced_field = "item"
+    def get_line_total(self):
+        return self.price * self.amount
+
     card_icon = "toolbox"
+    card_select_related = ["item"]
     def card_title(self):
         return self.item
     def card_subtitle(self):
-        return f"Использовано: {self.amount} шт."
+        return f"Использовано: {self.amount} шт. по {self.price} руб."
     def card_clickable(self):
         return self.item.deleted_at is None
 
     def clean(self):
         validate_item_count(self, self.item, "amount", True)
 
-class ServiceHistory(models.Model):
+    @classmethod
+    def before_bulk_create(cls, objs):
+        prices = dict(WarehouseItem._base_manager.filter(pk__in={obj.item_id for obj in objs}).values_list("id", "price"))
+        for obj in objs:
+            obj.price = prices[obj.item_id]
+
+    @classmethod
+    def after_bulk_create(cls, objs):
+        totals = {}
+        for obj in objs:
+            totals[obj.repair_order_id] = totals.get(obj.repair_order_id, 0) + obj.get_line_total()
+        for order_id, total in totals.items():
+            RepairOrder._base_manager.filter(pk=order_id).update(total=F("total") + total)
+
+        uses = {}
+        for obj in objs:
+            uses.setdefault(obj.item_id, {})[obj.pk] = obj.amount
+        for item_id, amounts in uses.items():
+            costs = WarehouseConsumption.take(item_id, amounts)
+            for obj in objs:
+                if obj.item_id == item_id:
+                    obj.cost = costs[obj.pk]
+        WarehouseUse._base_manager.bulk_update(objs, ["cost"], batch_size=1000)
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        stored = None
+        if not self._state.adding:
+            stored = WarehouseUse._base_manager.filter(pk=self.pk).values("item_id", "amount").first()
+            kwargs["update_fields"] = self.get_save_fields(kwargs, ["cost"])
+        super().save(*args, **kwargs)
+        if stored != {"item_id": self.item_id, "amount": self.amount}:
+            WarehouseConsumption.release(WarehouseConsumption.objects.filter(use=self))
+            self.cost = WarehouseConsumption.take(self.item_id, {self.pk: self.amount})[self.pk]
+            WarehouseUse._base_manager.filter(pk=self.pk).update(cost=self.cost)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        WarehouseConsumption.release(WarehouseConsumption.objects.filter(use=self))
+        return super().delete(*args, **kwargs)
+
+class WarehouseConsumption(models.Model):
+    """
+    Units of a restock taken by a use, which make up the cost of the use.
+
+    Uses take units from the oldest restocks of the item with units left, and only their own
+    consumptions are redone when they are changed, so that costs are never replayed from the start.
+    Changes of the units are serialized by the lock on the stock of the item, taken by WarehouseStockMixin.
+    """
+    use = models.ForeignKey(WarehouseUse, on_delete=models.DO_NOTHING)
+    restock = models.ForeignKey(WarehouseRestock, on_delete=models.DO_NOTHING)
+    amount = models.IntegerField()
+
+    @staticmethod
+    def take(item_id, amounts, exclude=None):
+        """
+        Takes the amounts of uses of the item, by use id, from its oldest restocks with units left.
+        Returns the costs of the taken units by use id, with units missing from the restocks at the current price of the item.
+        """
+        layers = list(WarehouseRestock._base_manager.filter(item_id=item_id, remaining__gt=0).exclude(pk=exclude)
+                      .order_by("id").values_list("id", "remaining", "unit_cost"))
+        costs = {}
+        taken_from = {}
+        consumptions = []
+        for use_id, amount in amounts.items():
+            cost = 0
+            while amount and layers:
+                restock_id, remaining, unit_cost = layers[0]
+                taken = min(amount, remaining)
+                consumptions.append(WarehouseConsumption(use_id=use_id, restock_id=restock_id, amount=taken))
+                taken_from[restock_id] = taken_from.get(restock_id, 0) + taken
+                cost += taken * unit_cost
+                amount -= taken
+                if taken == remaining:
+                    layers.pop(0)
+                else:
+                    layers[0] = (restock_id, remaining - taken, unit_cost)
+            if amount:
+                cost += amount * WarehouseItem._base_manager.filter(pk=item_id).values_list("price", flat=True).first()
+            costs[use_id] = cost
+
+        for restock_id, taken in taken_from.items():
+            WarehouseRestock._base_manager.filter(pk=restock_id).update(remaining=F("remaining") - taken)
+        WarehouseConsumption.objects.bulk_create(consumptions)
+        return costs
+
+    @staticmethod
+    def release(consumptions):
+        """Returns the units taken by the consumptions to their restocks and deletes them."""
+        rows = list(consumptions.values_list("id", "restock_id", "amount"))
+        returned = {}
+        for [id, restock_id, amount] in rows:
+            returned[restock_id] = returned.get(restock_id, 0) + amount
+        for restock_id, amount in returned.items():
+            WarehouseRestock._base_manager.filter(pk=restock_id).update(remaining=F("remaining") + amount)
+        WarehouseConsumption.objects.filter(pk__in=[row[0] for row in rows]).delete()
+
+class ServiceHistory(RepairOrderLineMixin, models.Model):
     morphed_name = "выполненной услуги"
 
     def get_absolute_url(self):
-        return reverse("service_history", kwargs={"order": self.repair_order.id, "pk": self.pk})
+        return reverse("service_history", kwargs={"order": self.repair_order_id, "pk": self.pk})
 
     repair_order = models.ForeignKey(RepairOrder, on_delete=models.DO_NOTHING, verbose_name="Заявка на ремонт")
     service = models.ForeignKey(Service, on_delete=models.DO_NOTHING, verbose_name="Услуга")
+    price = models.DecimalField("Цена", max_digits=7, decimal_places=2, editable=False)
 
     finish_date = models.DateField("Дата выполнения", blank=True, null=True)
     comments = models.CharField("Комментарии", max_length=300, blank=True)
@@ -474,6 +908,8 @@ class ServiceHistory(models.Model):
     create_allowed_to = [Employee.Position.ServiceManager]
     edit_allowed_to = [Employee.Position.ServiceManager, Employee.Position.Mechanic]
 
+    priced_field = "service"
+
     def clean(self):
         if self.finish_date and self.finish_date < self.repair_order.start_date:
             raise ValidationError({
@@ -481,8 +917,9 @@ class ServiceHistory(models.Model):
             })
 
     card_icon = "wrench"
+    card_select_related = ["service"]
     def card_title(self):
-        return self.service
+        return f"{self.service.name} ({self.price} руб.)"
     def card_subtitle(self):
         result = f"Не выполнено" if self.finish_date == None else f"Выполнено {self.finish_date.strftime(datetime_format)}"
         if self.comments:
@@ -0,0 +1,114 @@
+import json
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+
+class KeysetPage:
+    """Page of rows after or before the row of a cursor in the ordering of the queryset, which unlike an offset
+    is found by the index of the ordering and doesn't need counting the rows.
+
+    NULLs keep the placement of the database, which orders them as the largest values on PostgreSQL
+    and as the smallest ones on SQLite, and the primary key is added to the ordering unless it ends with it."""
+    keyset = True
+
+    def __init__(self, queryset, page_size, cursor):
+        self.queryset = queryset
+        self.names = list(queryset.query.order_by or ["pk"])
+        if self.names[-1].lstrip("-") not in ["pk", "id"]:
+            self.names.append("pk")
+        self.keys = [(name.lstrip("-"), name.startswith("-")) for name in self.names]
+        self.fields = [self.get_field(name) for name, descending in self.keys]
+        self.nulls_largest = connections[queryset.db].features.nulls_order_largest
+        backwards, values = self.decode(cursor)
+        rows = self.get_rows(values, backwards, page_size)
+        has_more = len(rows) > page_size
+        if backwards and not has_more:
+            # Going back to the start opens the first page, which is full
+            backwards, values = False, None
+            rows = self.get_rows(values, backwards, page_size)
+            has_more = len(rows) > page_size
+        self.object_list = rows[:page_size][::-1] if backwards else rows[:page_size]
+
+        self.has_next = values is not None if backwards else has_more
+        self.has_previous = has_more if backwards else values is not None
+        self.next_cursor = self.encode(False, self.object_list[-1]) if self.has_next and self.object_list else None
+        self.previous_cursor = self.encode(True, self.object_list[0]) if self.has_previous and self.object_list else None
+
+    @cached_property
+    def count(self):
+        return self.queryset.count()
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def get_field(self, name):
+        if name in self.queryset.query.annotations:
+            return self.queryset.query.annotations[name].output_field
+        return self.queryset.model._meta.pk if name == "pk" else self.queryset.model._meta.get_field(name)
+
+    def get_rows(self, values, backwards, page_size):
+        queryset = self.queryset.order_by(*[f"-{name}" if descending != backwards else name for name, descending in self.keys])
+        [name, descending], field = self.keys[0], self.fields[0]
+        greater = descending == backwards
+        # The cursor value of the first key bounds the rows by itself, which lets the database seek in its index,
+        # and NULLs of it are fetched separately since they are outside of the bounds
+        segments = [Q()] if not field.null else \
+            [Q(**{f"{name}__isnull": False}), Q(**{f"{name}__isnull": True})][::1 if greater == self.nulls_largest else -1]
+        if values is not None:
+            if field.null:
+                segments = segments[segments.index(Q(**{f"{name}__isnull": values[0] is None})):]
+            segments[0] &= self.get_filter(values, backwards)
+            if values[0] is not None:
+                segments[0] &= Q(**{f"{name}__{'gte' if greater else 'lte'}": values[0]})
+
+        rows = []
+        for segment in segments:
+            rows += queryset.filter(segment)[:page_size + 1 - len(rows)]
+            if len(rows) > page_size:
+                break
+        return rows
+
+    def get_filter(self, values, backwards):
+        """Rows past the values in the ordering, or before them when going backwards."""
+        result = None
+        for (name, descending), field, value in reversed(list(zip(self.keys, self.fields, values))):
+            greater = descending == backwards
+            # NULLs come after all values when going towards the end they are placed at, and nothing is past them
+            nulls_last = greater == self.nulls_largest
+            if value is None:
+                past = None if nulls_last else Q(**{f"{name}__isnull": False})
+            else:
+                past = Q(**{f"{name}__{'gt' if greater else 'lt'}": value})
+                if nulls_last and field.null:
+                    past |= Q(**{f"{name}__isnull": True})
+            if result is None:
+                result = past
+            else:
+                equal = Q(**{f"{name}__isnull": True}) if value is None else Q(**{name: value})
+                result = equal & result if past is None else past | (equal & result)
+        return result
+
+    def encode(self, backwards, row):
+        values = [row.serializable_value(name) for name, descending in self.keys]
+        return urlsafe_base64_encode(json.dumps([backwards, self.names, values], cls=DjangoJSONEncoder).encode())
+
+    def decode(self, cursor):
+        # Cursors of another ordering or tampered with open the first page
+        try:
+            backwards, names, values = json.loads(urlsafe_base64_decode(cursor or ""))
+            if names != self.names or len(values) != len(self.fields):
+                return False, None
+            return bool(backwards), [None if value is None else field.to_python(value)
+                                     for field, value in zip(self.fields, values)]
+        except (TypeError, ValueError, ValidationError):
+            return False, None
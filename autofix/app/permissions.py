@@ -0,0 +1,32 @@
+from django.apps import apps
+from .models import Employee
+
+
+# Creating and editing rows of a model, printing its receipts and viewing its margin report
+actions = ["create", "edit", "print", "margin"]
+
+def compile_permissions():
+    """Actions on models every position is allowed, and fields limiting positions to their own rows,
+    compiled from the <action>_allowed_to and own_rows_only of the models."""
+    matrix = {position: set() for position in Employee.Position.values}
+    own_rows = {}
+    for model in apps.get_app_config("app").get_models():
+        for action in actions:
+            allowed_to = getattr(model, f"{action}_allowed_to", None)
+            if allowed_to is not None:
+                for position in [Employee.Position.Administrator, *allowed_to]:
+                    matrix[position].add((model, action))
+        for position, field in getattr(model, "own_rows_only", {}).items():
+            own_rows[position, model] = field
+    return {position: frozenset(allowed) for position, allowed in matrix.items()}, own_rows
+
+# Compiled once when the app is ready, so checks are set lookups
+permissions, own_rows = compile_permissions()
+
+def can(position, model, action):
+    return (model, action) in permissions.get(position, ())
+
+def get_visible_rows(queryset, user):
+    """Rows of the queryset the user can see, which are only their own ones for some positions."""
+    field = own_rows.get((user.position, queryset.model))
+    return queryset.filter(**{field: user.id}) if field else queryset
@@ -0,0 +1,81 @@
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from phonenumber_field.modelfields import PhoneNumberField
+from .base import SearchBackend
+from .cache import SearchCache, search_cache
+from .postgresql import PostgresSearchBackend
+from .sqlite import SqliteRunSQL, SqliteSearchBackend
+
+
+search_backends = {
+    "sqlite": SqliteSearchBackend,
+    "postgresql": PostgresSearchBackend,
+}
+
+def get_search_backend(using=DEFAULT_DB_ALIAS) -> SearchBackend:
+    return search_backends[connections[using].vendor](using)
+
+
+class FullTextSearchMixin:
+    search_models = []
+    search_cache_max_ids = 100
+    # Fields also searched by substrings, like VINs and license plates
+    search_identifiers = []
+    # Fields matched by autocompletion, which are all of the searched ones if empty
+    autocomplete_fields = []
+
+    @staticmethod
+    def register_search(cls):
+        FullTextSearchMixin.search_models.append(cls)
+
+    @classmethod
+    def get_search_field_defs_with_key(cls, fk_name: str | None):
+        return (
+            cls,
+            (["id"] if not fk_name else []) +
+                [key for [key, value] in cls.__dict__.items()
+                 if hasattr(value, "field") and isinstance(value.field, (models.CharField, PhoneNumberField)) and value.field.editable],
+            fk_name
+        )
+
+    @classmethod
+    def get_search_field_defs(cls):
+        return [cls.get_search_field_defs_with_key(None)]
+
+    @classmethod
+    def get_search_generation(cls):
+        return get_search_backend().get_generation(cls)
+
+    @classmethod
+    def get_cached_search_ids(cls, search: str):
+        return get_search_backend().get_cached_ids(cls, search)
+
+    @classmethod
+    def search(cls, search: str):
+        """Filter matching the search string, evaluated by the search backend unless cached."""
+        return get_search_backend().search(cls, search)
+
+    @classmethod
+    def search_ranked(cls, queryset, search: str):
+        """Filters the queryset by the search string and orders it by relevance first."""
+        return get_search_backend().search_ranked(cls, queryset, search)
+
+
+def initialize_search(using=DEFAULT_DB_ALIAS, **kwargs):
+    """Brings the search schema in sync with the registered models. Runs after migrations."""
+    return get_search_backend(using).install(FullTextSearchMixin.search_models)
+
+def uninstall_search(plan=None, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Drops the search schema of models whose tables are about to be migrated.
+
+    Search views, triggers and generated columns depend on the columns of these tables,
+    which prevents altering them. The schema is rebuilt by initialize_search afterwards.
+    """
+    migrated = {
+        (migration.app_label, getattr(operation, "model_name_lower", None) or getattr(operation, "name_lower", None))
+        for [migration, backwards] in plan or [] for operation in migration.operations
+    }
+    models = [cls for cls in FullTextSearchMixin.search_models
+              if any((jcls._meta.app_label, jcls._meta.model_name) in migrated for [jcls, fields, fk_name] in cls.get_search_field_defs())]
+    if models:
+        get_search_backend(using).uninstall(models)
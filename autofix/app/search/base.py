@@ -0,0 +1,208 @@
+import hashlib
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from .cache import search_cache
+
+
+class SearchBackend:
+    """
+    Full-text search over the models registered with FullTextSearchMixin.
+
+    Backends maintain the search schema of every model and bump its generation
+    in app_search_index whenever a row is reindexed, which keys the search cache.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.connection = connections[using]
+
+    def get_schema(self, cls) -> list[str]:
+        """Statements creating the search schema of the model."""
+        raise NotImplementedError
+
+    def drop_schema(self, cursor, cls):
+        raise NotImplementedError
+
+    # Whether reindexing several models at once is faster than one by one
+    parallel_reindex = True
+
+    def reindex(self, cls, chunk_size: int, shadow=False, progress=None) -> int:
+        """
+        Rebuilds the search index of the model without holding the database for the whole run.
+
+        With shadow, the index is built aside while the current one keeps serving searches,
+        and is swapped in at the end. progress is called with the number of rows indexed so far.
+        Returns the number of indexed rows.
+        """
+        raise NotImplementedError
+
+    def filter(self, cls, search: str, prefix=False) -> Q:
+        """Filter matching the search string, evaluated in the database. With prefix, terms also match beginnings of tokens."""
+        raise NotImplementedError
+
+    def filter_latest(self, cls, search: str, prefix=False, fields=None) -> Q:
+        """
+        Filter matching the search string, which may leave out matches older than the latest top_candidates.
+
+        Cheaper than filter for common terms when only the latest rows are taken.
+        With fields, only these fields of the model itself are matched.
+        """
+        raise NotImplementedError
+
+    def rank(self, cls, queryset, search: str):
+        """Filters the queryset by the search string and orders it by relevance first."""
+        raise NotImplementedError
+
+    def identifier_subquery(self, cls, term: str) -> tuple[str, list]:
+        """Subquery of ids of rows whose search_identifiers contain the term."""
+        raise NotImplementedError
+
+    # Substrings shorter than a trigram can't be looked up in the index
+    min_identifier_length = 3
+
+    def get_identifier_subqueries(self, cls, term: str, latest=None) -> list[tuple[str, list]]:
+        """
+        Subqueries of ids of rows whose identifiers, or identifiers of joined rows, contain the term.
+
+        If latest is given, only that many of the latest joined rows with matching identifiers are looked up.
+        """
+        if len(term) < self.min_identifier_length:
+            return []
+        subqueries = []
+        for index, [jcls, fields, fk_name] in enumerate(cls.get_search_field_defs()):
+            if jcls.search_identifiers:
+                sql, params = self.identifier_subquery(jcls, term)
+                if index and latest:
+                    sql = f"{sql} ORDER BY 1 DESC LIMIT {latest}"
+                subqueries.append((f"SELECT id FROM {cls._meta.db_table} WHERE {fk_name}_id IN ({sql})" if index else sql, params))
+        return subqueries
+
+    def match_ids(self, cls, search: str, limit: int) -> list[int]:
+        return list(self.rank(cls, cls._default_manager.using(self.using).order_by(), search)
+                    .values_list("id", flat=True)[:limit])
+
+    # Only this many of the latest matches are ranked by top_ids, since ranking every match of a common term is slow
+    top_candidates = 1000
+
+    def rank_top(self, cls, queryset, search: str, limit: int) -> list[tuple[str, list]]:
+        """Queries of ids and ranks of the queryset, lower is better, whose union holds its best matches of the search."""
+        raise NotImplementedError
+
+    def top_ids(self, querysets, search: str, limit: int) -> list[list[int]]:
+        """
+        Ids of the best matches of every queryset, up to limit each, in relevance order.
+
+        Querysets of different models are ranked in a single round trip, as a union of their top matches.
+        """
+        if not search.split():
+            return [[] for queryset in querysets]
+        subqueries = [
+            (f"SELECT {index} AS search_index, id, search_rank FROM ({sql}) AS search_{index}_{subindex}", params)
+            for index, queryset in enumerate(querysets)
+            for subindex, [sql, params] in enumerate(self.rank_top(queryset.model, queryset.order_by(), search, limit))
+        ]
+        with self.connection.cursor() as cursor:
+            cursor.execute(" UNION ALL ".join([sql for sql, params in subqueries]),
+                           [param for sql, params in subqueries for param in params])
+            rows = cursor.fetchall()
+
+        ids = [[] for queryset in querysets]
+        for [index, id, rank] in sorted(rows, key=lambda row: row[2]):
+            if id not in ids[index] and len(ids[index]) < limit:
+                ids[index].append(id)
+        return ids
+
+    def get_fingerprint(self, cls):
+        return hashlib.sha1("\n".join(" ".join(stmt.split()) for stmt in self.get_schema(cls)).encode()).hexdigest()
+
+    def get_generation(self, cls):
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT generation FROM app_search_index WHERE name = %s;", [cls._meta.model_name])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_cached_ids(self, cls, search: str):
+        """
+        Ids matched by the search in relevance order, taken from the search cache.
+
+        Returns None when the search matches more than search_cache_max_ids rows
+        and has to be evaluated in the database instead.
+        """
+        # A generation bumped by an uncommitted transaction may be reused after its rollback
+        generation = self.get_generation(cls) if not self.connection.in_atomic_block else None
+        if generation is None:
+            return None
+
+        def compute():
+            ids = self.match_ids(cls, search, cls.search_cache_max_ids + 1)
+            return ids if len(ids) <= cls.search_cache_max_ids else False
+
+        terms = " ".join(sorted(set(search.lower().split())))
+        ids = search_cache.get(f"search:{self.using}:{cls._meta.model_name}:{generation}:{hashlib.sha1(terms.encode()).hexdigest()}", compute)
+        return ids if ids is not False else None
+
+    def search(self, cls, search: str) -> Q:
+        if not search.split():
+            return Q()
+        ids = self.get_cached_ids(cls, search)
+        if ids is not None:
+            return Q(id__in=ids)
+        return self.filter(cls, search)
+
+    def search_ranked(self, cls, queryset, search: str):
+        if not search.split():
+            return queryset
+        ids = self.get_cached_ids(cls, search)
+        if ids is not None:
+            return queryset.filter(id__in=ids).annotate(
+                search_rank=Case(*[When(id=id, then=Value(index)) for index, id in enumerate(ids)], output_field=IntegerField())
+            ).order_by("search_rank", *queryset.query.order_by)
+        return self.rank(cls, queryset, search)
+
+    def create_index_table(self, cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS app_search_index (
+                name TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                generation BIGINT NOT NULL DEFAULT 0
+            );
+        """)
+
+    def install(self, models):
+        """
+        Brings the search schema in sync with the models.
+
+        The schema of a model is rebuilt only when its fingerprint differs from
+        the one stored in app_search_index, so this is a no-op unless the set
+        of indexed fields has changed. Returns the list of rebuilt models.
+        """
+        rebuilt = []
+
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            self.create_index_table(cursor)
+            cursor.execute("SELECT name, fingerprint FROM app_search_index;")
+            fingerprints = dict(cursor.fetchall())
+
+            for cls in models:
+                fingerprint = self.get_fingerprint(cls)
+                if fingerprints.get(cls._meta.model_name) == fingerprint:
+                    continue
+
+                self.drop_schema(cursor, cls)
+                for stmt in self.get_schema(cls):
+                    cursor.execute(stmt)
+
+                cursor.execute("""
+                    INSERT INTO app_search_index (name, fingerprint) VALUES (%s, %s)
+                        ON CONFLICT (name) DO UPDATE SET fingerprint = excluded.fingerprint, generation = app_search_index.generation + 1;
+                """, [cls._meta.model_name, fingerprint])
+                rebuilt.append(cls)
+
+        return rebuilt
+
+    def uninstall(self, models):
+        """Drops the search schema of the models, leaving it to be rebuilt by the next install."""
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            self.create_index_table(cursor)
+            for cls in models:
+                self.drop_schema(cursor, cls)
+                cursor.execute("UPDATE app_search_index SET fingerprint = '' WHERE name = %s;", [cls._meta.model_name])
@@ -0,0 +1,52 @@
+import threading
+from django.core.cache import cache
+
+
+class SearchCache:
+    """
+    Caches ids matched by searches in the default cache.
+
+    Keys include the generation of the searched model, which search triggers
+    bump on every reindexed row, so entries never have to be invalidated explicitly.
+    Identical searches running concurrently in the process are coalesced.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.hits = self.misses = self.coalesced = 0
+
+    def get(self, key, compute):
+        result = cache.get(key)
+        if result is not None:
+            with self.lock:
+                self.hits += 1
+            return result
+
+        with self.lock:
+            event = self.pending.get(key)
+            is_leader = event is None
+            if is_leader:
+                event = self.pending[key] = threading.Event()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            event.wait()
+            result = cache.get(key)
+            return result if result is not None else compute()
+
+        try:
+            result = compute()
+            cache.set(key, result)
+            return result
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+    def info(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+search_cache = SearchCache()
@@ -0,0 +1,241 @@
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+from phonenumber_field.modelfields import PhoneNumberField
+from .base import SearchBackend
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Search on generated tsvector columns with GIN indexes.
+
+    Every model gets a search_vector column over its own fields. Fields of joined
+    models are matched against the vectors of their tables, which are searched
+    models themselves, so a repair order is found by its client and vehicle too.
+    """
+    config = "simple"
+
+    def get_vector(self, cls, fields=None):
+        columns = []
+        for field in [cls._meta.get_field(name) for name in fields or cls.get_search_field_defs()[0][1] if name != "id"]:
+            # Phone numbers are stored in E.164, whose leading plus the parser keeps in the token
+            columns.append(f"coalesce(ltrim({field.column}, '+'), '')" if isinstance(field, PhoneNumberField)
+                           else f"coalesce({field.column}, '')")
+        document = " || ' ' || ".join(columns) or "''"
+        return f"to_tsvector('{self.config}', {document})"
+
+    def get_schema(self, cls) -> list[str]:
+        """
+        Statements adding the search vector of the model and the triggers bumping its generation.
+
+        Vectors are generated columns, so PostgreSQL keeps them up to date by itself
+        and triggers are only needed to invalidate the search cache.
+        """
+        model_name = cls._meta.model_name
+        table = cls._meta.db_table
+        field_defs = cls.get_search_field_defs()
+
+        watched_columns = field_defs[0][1] + \
+            [f"{fk_name}_id" for [jcls, fields, fk_name] in field_defs[1:]] + \
+            (["deleted_at"] if hasattr(cls, "deleted_at") else [])
+        def make_changed_condition(columns):
+            return " OR ".join([f"OLD.{column} IS DISTINCT FROM NEW.{column}" for column in columns])
+
+        return [
+            f"""
+                ALTER TABLE {table} ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ({self.get_vector(cls)}) STORED;
+            """,
+            f"""
+                CREATE INDEX {table}_search_vector ON {table} USING GIN (search_vector);
+            """,
+            f"""
+                CREATE TRIGGER {table}_search_insert AFTER INSERT OR DELETE ON {table}
+                    FOR EACH ROW EXECUTE FUNCTION app_search_bump('{model_name}');
+            """,
+            f"""
+                CREATE TRIGGER {table}_search_update AFTER UPDATE OF {", ".join(watched_columns)} ON {table}
+                    FOR EACH ROW WHEN ({make_changed_condition(watched_columns)})
+                    EXECUTE FUNCTION app_search_bump('{model_name}');
+            """,
+            *[f"""
+                CREATE TRIGGER {table}_search_update_by_{fk_name} AFTER UPDATE OF {", ".join(fields)} ON {jcls._meta.db_table}
+                    FOR EACH ROW WHEN ({make_changed_condition(fields)})
+                    EXECUTE FUNCTION app_search_bump('{model_name}');
+            """ for [jcls, fields, fk_name] in field_defs[1:]],
+            *(self.get_identifier_schema(cls) if cls.search_identifiers else []),
+        ]
+
+    def get_identifier_schema(self, cls) -> list[str]:
+        """
+        Statements adding trigrams of the search identifiers of the model as an indexed array.
+
+        Built-in array GIN indexes are used instead of pg_trgm, which is an extension
+        that isn't guaranteed to be installed. Matches are rechecked with strpos.
+        """
+        table = cls._meta.db_table
+        trigrams = " || ".join([f"app_search_trigrams({cls._meta.get_field(name).column})" for name in cls.search_identifiers])
+        return [
+            f"""
+                ALTER TABLE {table} ADD COLUMN search_trigrams text[] GENERATED ALWAYS AS ({trigrams}) STORED;
+            """,
+            f"""
+                CREATE INDEX {table}_search_trigrams ON {table} USING GIN (search_trigrams);
+            """,
+        ]
+
+    def drop_schema(self, cursor, cls):
+        table = cls._meta.db_table
+        cursor.execute("SELECT tgname, tgrelid::regclass::text FROM pg_trigger WHERE tgname LIKE %s;", [f"{table}_search_%"])
+        for [trigger, trigger_table] in cursor.fetchall():
+            cursor.execute(f"DROP TRIGGER {trigger} ON {trigger_table};")
+        cursor.execute(f"ALTER TABLE IF EXISTS {table} DROP COLUMN IF EXISTS search_vector, DROP COLUMN IF EXISTS search_trigrams;")
+
+    def reindex(self, cls, chunk_size: int, shadow=False, progress=None) -> int:
+        """
+        Rebuilds the search indexes of the model, concurrently with shadow.
+
+        Vectors are generated columns, which PostgreSQL never lets go stale, so only
+        their indexes are rebuilt, by the database in a single pass instead of chunks.
+        Building concurrently can't happen inside a transaction.
+        """
+        table = cls._meta.db_table
+        with self.connection.cursor() as cursor:
+            for index in [f"{table}_search_vector"] + ([f"{table}_search_trigrams"] if cls.search_identifiers else []):
+                cursor.execute(f"REINDEX INDEX {'CONCURRENTLY ' if shadow else ''}{index};")
+            cursor.execute(f"SELECT count(*) FROM {table};")
+            [rows] = cursor.fetchone()
+        if progress:
+            progress(rows)
+        return rows
+
+    def create_index_table(self, cursor):
+        super().create_index_table(cursor)
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION app_search_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                -- Bumping once per transaction is enough to invalidate the search cache,
+                -- while bumping the same row for every written one slows down bulk writes
+                IF current_setting('app_search.bumped_' || TG_ARGV[0], true) IS DISTINCT FROM 'on' THEN
+                    UPDATE app_search_index SET generation = generation + 1 WHERE name = TG_ARGV[0];
+                    PERFORM set_config('app_search.bumped_' || TG_ARGV[0], 'on', true);
+                END IF;
+                RETURN NULL;
+            END;
+            $$;
+        """)
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION app_search_trigrams(value text) RETURNS text[] LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE AS $$
+            DECLARE
+                folded text := lower(value);
+                trigrams text[] := '{}';
+            BEGIN
+                FOR i IN 1 .. coalesce(length(folded), 0) - 2 LOOP
+                    trigrams := trigrams || substr(folded, i, 3);
+                END LOOP;
+                RETURN trigrams;
+            END;
+            $$;
+        """)
+
+    def identifier_condition(self, cls, term: str) -> tuple[str, list]:
+        table = cls._meta.db_table
+        matches = " OR ".join([f"strpos(lower({table}.{cls._meta.get_field(name).column}), lower(%s)) > 0" for name in cls.search_identifiers])
+        return f"{table}.search_trigrams @> app_search_trigrams(%s) AND ({matches})", [term] * (len(cls.search_identifiers) + 1)
+
+    def identifier_subquery(self, cls, term: str) -> tuple[str, list]:
+        sql, params = self.identifier_condition(cls, term)
+        return f"SELECT id FROM {cls._meta.db_table} WHERE {sql}", params
+
+    @staticmethod
+    def get_prefix_query(term: str):
+        return "'" + term.replace("\\", "\\\\").replace("'", "''") + "':*"
+
+    def filter(self, cls, search: str, prefix=False) -> Q:
+        table = cls._meta.db_table
+        # Unlike phraseto_tsquery, to_tsquery matches prefixes, but only of lexemes quoted in its syntax
+        match = f"search_vector @@ to_tsquery('{self.config}', %s)" if prefix else f"search_vector @@ phraseto_tsquery('{self.config}', %s)"
+
+        # Soft deleted rows are left out of the search like they are by FTS5 content views
+        filter = Q(deleted_at__isnull=True) if hasattr(cls, "deleted_at") else Q()
+        for term in search.split():
+            # Alternatives are united in a single subquery, which unlike an OR of them can use indexes
+            query = self.get_prefix_query(term) if prefix else term
+            subqueries = [(f"SELECT id FROM {table} WHERE {match}", [query])]
+            for [jcls, fields, fk_name] in cls.get_search_field_defs()[1:]:
+                subqueries.append((f"SELECT id FROM {table} WHERE {fk_name}_id IN (SELECT id FROM {jcls._meta.db_table} WHERE {match})", [query]))
+            # Ids are indexed as text by FTS5, so they are matched here as well
+            if term.isdecimal() and int(term) < 2 ** 63:
+                subqueries.append(("SELECT %s", [int(term)]))
+            subqueries += self.get_identifier_subqueries(cls, term)
+
+            filter &= Q(id__in=RawSQL(" UNION ".join([sql for sql, params in subqueries]),
+                                      [param for sql, params in subqueries for param in params]))
+        return filter
+
+    def rank(self, cls, queryset, search: str):
+        return self.rank_matches(cls, queryset.filter(self.filter(cls, search)), search)
+
+    def rank_matches(self, cls, queryset, search: str):
+        """Orders the queryset, which only has rows matching the search string, by relevance first."""
+        quote_name = self.connection.ops.quote_name
+        table = quote_name(cls._meta.db_table)
+        terms = search.split()
+        vector = " || ".join(
+            [f"{table}.search_vector"] +
+            [f"coalesce((SELECT search_vector FROM {quote_name(jcls._meta.db_table)} WHERE id = {table}.{quote_name(f'{fk_name}_id')}), '')"
+             for [jcls, fields, fk_name] in cls.get_search_field_defs()[1:]]
+        )
+        query = " && ".join([f"phraseto_tsquery('{self.config}', %s)"] * len(terms))
+        return queryset.annotate(search_rank=RawSQL(f"ts_rank({vector}, {query})", terms, output_field=FloatField())) \
+            .order_by("-search_rank", *queryset.query.order_by)
+
+    # Rows scanned by filter_latest before it looks up all matches with the indexes
+    latest_rows = 20000
+
+    def filter_latest(self, cls, search: str, prefix=False, fields=None) -> Q:
+        table = cls._meta.db_table
+        tsquery = f"to_tsquery('{self.config}', %s)" if prefix else f"phraseto_tsquery('{self.config}', %s)"
+        match = f"search_vector @@ {tsquery}"
+
+        conditions = [(f"{table}.deleted_at IS NULL", [])] if hasattr(cls, "deleted_at") else []
+        for term in search.split():
+            query = self.get_prefix_query(term) if prefix else term
+            if fields:
+                # Matches of the indexed vector are checked against the vector of the fields alone
+                conditions.append((f"{table}.{match} AND {self.get_vector(cls, fields)} @@ {tsquery}", [query, query]))
+                continue
+            alternatives = [(f"{table}.{match}", [query])]
+            for [jcls, jfields, fk_name] in cls.get_search_field_defs()[1:]:
+                alternatives.append((f"{table}.{fk_name}_id IN (SELECT id FROM {jcls._meta.db_table} WHERE {match})", [query]))
+                if jcls.search_identifiers and len(term) >= self.min_identifier_length:
+                    sql, params = self.identifier_subquery(jcls, term)
+                    alternatives.append((f"{table}.{fk_name}_id IN ({sql})", params))
+            if cls.search_identifiers and len(term) >= self.min_identifier_length:
+                alternatives.append(self.identifier_condition(cls, term))
+            if term.isdecimal() and int(term) < 2 ** 63:
+                alternatives.append((f"{table}.id = %s", [int(term)]))
+            conditions.append((" OR ".join([f"({sql})" for sql, params in alternatives]),
+                               [param for sql, params in alternatives for param in params]))
+        condition = " AND ".join([f"({sql})" for sql, params in conditions]) or "TRUE"
+        params = [param for sql, params in conditions for param in params]
+
+        # The planner can't tell common terms from rare ones, and would either look up all matches of a common term
+        # or scan the whole table backwards for a rare one. So the latest rows are checked first, and the indexes
+        # are used only when there are too few matches among them, which means there are few matches at all.
+        # OFFSET 0 keeps the planner from looking up the latest matches with the indexes as well
+        latest = f"""
+            SELECT id FROM (SELECT * FROM {table} WHERE id > (SELECT max(id) FROM {table}) - {self.latest_rows} OFFSET 0) AS {table}
+            WHERE {condition}
+        """
+        return Q(id__in=RawSQL(f"""
+            {latest}
+            UNION
+            SELECT id FROM {table}
+            WHERE (SELECT count(*) FROM ({latest} LIMIT {self.top_candidates}) AS latest) < {self.top_candidates} AND {condition}
+        """, params * 3))
+
+    def rank_top(self, cls, queryset, search: str, limit: int) -> list[tuple[str, list]]:
+        candidates = queryset.filter(self.filter_latest(cls, search)).order_by("-id").values("id")[:self.top_candidates]
+        # Candidates are selected by raw SQL, since tables of subqueries get aliased and conditions refer to them by name
+        sql, params = self.rank_matches(cls, queryset.filter(id__in=RawSQL(*candidates.query.sql_with_params())), search) \
+            .values_list("id", "search_rank")[:limit].query.sql_with_params()
+        return [(f"SELECT id, -search_rank AS search_rank FROM ({sql}) AS ranked", params)]
@@ -0,0 +1,417 @@
+from django.db import migrations, transaction
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+from .base import SearchBackend
+
+
+class SqliteRunSQL(migrations.RunSQL):
+    """RunSQL applied only on SQLite, for migrations of the FTS5 search tables."""
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "sqlite":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "sqlite":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class SqliteSearchBackend(SearchBackend):
+    """Search on external content FTS5 tables kept in sync by triggers."""
+    # There is a single writer, which starves the others when they take turns
+    parallel_reindex = False
+
+    def get_table(self, cls):
+        return f"app_{cls.__name__.lower()}_search"
+
+    @staticmethod
+    def get_query(search: str, prefix=False):
+        return " ".join(['"' + s.replace('"', '""') + '"' + ("*" if prefix else "") for s in search.split()])
+
+    @staticmethod
+    def get_columns(cls):
+        field_defs = cls.get_search_field_defs()
+        return field_defs[0][1] + [f"{fk_name}_{field}" for [jcls, fields, fk_name] in field_defs[1:] for field in fields]
+
+    @staticmethod
+    def get_watermark(cls):
+        return f"(SELECT watermark FROM app_search_reindex WHERE name = '{cls._meta.model_name}')"
+
+    def get_schema(self, cls, table=None, watermark=False) -> list[str]:
+        """
+        Statements creating and filling the search table of the model along with its triggers.
+
+        The search table is an external content FTS5 table over a view that joins
+        the indexed columns, so only the index itself is stored. Since its content
+        is not stored either, triggers have to pass the previously indexed values
+        to the 'delete' command, taking them from the old row where it changes.
+
+        With a watermark, the table is created empty under the given name, and triggers
+        maintain only rows up to the watermark in app_search_reindex, which is moved
+        forward as the table is filled by reindex.
+        """
+        model_name = cls.__name__.lower()
+        content = f"{self.get_table(cls)}_content"
+        table = table or self.get_table(cls)
+        field_defs = cls.get_search_field_defs()
+        columns = self.get_columns(cls)
+
+        def make_select(old_index = None):
+            def alias(index):
+                return "old" if index == old_index else f"app_{model_name}" if index == 0 else field_defs[index][2]
+            return f"""
+                SELECT {", ".join(
+                    [f"{alias(0)}.id"] +
+                    [f"{alias(index)}.{field}" for index, [jcls, fields, fk_name] in enumerate(field_defs) for field in fields]
+                )}
+                {"FROM " if old_index != 0 or len(field_defs) > 1 else ""}{", ".join(
+                    ([f"app_{model_name}"] if old_index != 0 else []) +
+                    [f"app_{jcls.__name__.lower()} {fk_name}" for index, [jcls, fields, fk_name] in enumerate(field_defs) if index and index != old_index]
+                )}
+                WHERE 1
+                    {" ".join([f"AND {alias(index)}.id = {alias(0)}.{fk_name}_id" for index, [jcls, fields, fk_name] in enumerate(field_defs) if index])}
+                    {f"AND {alias(0)}.deleted_at IS NULL" if hasattr(cls, "deleted_at") else ""}
+                    {f"AND {alias(0)}.id <= {self.get_watermark(cls)}" if watermark else ""}
+            """
+        # Updates reindex a row only when columns it is indexed by have actually changed
+        watched_columns = field_defs[0][1] + \
+            [f"{fk_name}_id" for [jcls, fields, fk_name] in field_defs[1:]] + \
+            (["deleted_at"] if hasattr(cls, "deleted_at") else [])
+        def make_changed_condition(columns):
+            return " OR ".join([f"old.{column} IS NOT new.{column}" for column in columns])
+
+        def make_bump_stmt():
+            return f"UPDATE app_search_index SET generation = generation + 1 WHERE name = '{model_name}';"
+
+        def make_insert_stmt(where):
+            return f"""
+                INSERT INTO {table} (rowid, {", ".join(columns)})
+                    SELECT id, {", ".join(columns)} FROM {content} WHERE {where}{f" AND id <= {self.get_watermark(cls)}" if watermark else ""};
+            """
+        def make_delete_stmt(old_index):
+            return f"""
+                INSERT INTO {table} ({table}, rowid, {", ".join(columns)})
+                    SELECT 'delete', * FROM ({make_select(old_index)});
+            """
+
+        return [
+            *([f"""
+                CREATE VIEW {content} AS
+                    SELECT {", ".join(
+                        [f"app_{model_name}.{field} AS {field}" for field in field_defs[0][1]] +
+                        [f"{fk_name}.{field} AS {fk_name}_{field}" for [jcls, fields, fk_name] in field_defs[1:] for field in fields]
+                    )}
+                    FROM app_{model_name}
+                    {" ".join([f"JOIN app_{jcls.__name__.lower()} {fk_name} ON {fk_name}.id = app_{model_name}.{fk_name}_id" for [jcls, fields, fk_name] in field_defs[1:]])}
+                    WHERE 1
+                        {f"AND app_{model_name}.deleted_at IS NULL" if hasattr(cls, "deleted_at") else ""};
+            """] if table == self.get_table(cls) else []),
+            f"""
+                CREATE VIRTUAL TABLE {table} USING FTS5({",".join(columns)}, content='{content}', content_rowid='id', prefix='1 2 3');
+            """,
+            *([f"""
+                INSERT INTO {table} ({table}) VALUES ('rebuild');
+            """] if not watermark else []),
+            f"""
+                CREATE TRIGGER {table}_insert AFTER INSERT ON app_{model_name} BEGIN
+                    {make_insert_stmt("id = new.id")}
+                    {make_bump_stmt()}
+                END;
+            """,
+            f"""
+                CREATE TRIGGER {table}_update AFTER UPDATE OF {", ".join(watched_columns)} ON app_{model_name}
+                    WHEN {make_changed_condition(watched_columns)}
+                BEGIN
+                    {make_delete_stmt(0)}
+                    {make_insert_stmt("id = new.id")}
+                    {make_bump_stmt()}
+                END;
+            """,
+            *[f"""
+                CREATE TRIGGER {table}_update_by_{fk_name} AFTER UPDATE OF {", ".join(fields)} ON app_{jcls.__name__.lower()}
+                    WHEN {make_changed_condition(fields)}
+                BEGIN
+                    {make_delete_stmt(index)}
+                    {make_insert_stmt(f"id IN (SELECT id FROM app_{model_name} WHERE {fk_name}_id = new.id)")}
+                    {make_bump_stmt()}
+                END;
+            """ for index, [jcls, fields, fk_name] in enumerate(field_defs) if index],
+            f"""
+                CREATE TRIGGER {table}_delete AFTER DELETE ON app_{model_name} BEGIN
+                    {make_delete_stmt(0)}
+                    {make_bump_stmt()}
+                END;
+            """,
+            *(self.get_identifier_schema(cls, f"{table}_trigram", watermark) if cls.search_identifiers else []),
+        ]
+
+    def get_identifier_schema(self, cls, table=None, watermark=False) -> list[str]:
+        """
+        Statements creating and filling the trigram table of the search identifiers of the model.
+
+        The table is contentless, since identifiers are short and only ids of matching rows are needed.
+        Generations are bumped by the triggers of the search table, which watch these columns too.
+        """
+        model_name = cls.__name__.lower()
+        table = table or f"{self.get_table(cls)}_trigram"
+        columns = cls.search_identifiers
+
+        def make_condition(row):
+            return " AND ".join(
+                ([f"{row}.deleted_at IS NULL"] if hasattr(cls, "deleted_at") else []) +
+                ([f"{row}.id <= {self.get_watermark(cls)}"] if watermark else [])
+            ) or "1"
+        def make_insert_stmt():
+            return f"""
+                INSERT INTO {table} (rowid, {", ".join(columns)})
+                    SELECT new.id, {", ".join([f"new.{column}" for column in columns])}
+                    WHERE {make_condition("new")};
+            """
+        def make_delete_stmt():
+            return f"""
+                INSERT INTO {table} ({table}, rowid, {", ".join(columns)})
+                    SELECT 'delete', old.id, {", ".join([f"old.{column}" for column in columns])}
+                    WHERE {make_condition("old")};
+            """
+        watched_columns = columns + (["deleted_at"] if hasattr(cls, "deleted_at") else [])
+
+        return [
+            f"""
+                CREATE VIRTUAL TABLE {table} USING FTS5({",".join(columns)}, content='', tokenize='trigram');
+            """,
+            *([f"""
+                INSERT INTO {table} (rowid, {", ".join(columns)})
+                    SELECT id, {", ".join(columns)} FROM app_{model_name} WHERE {make_condition(f"app_{model_name}")};
+            """] if not watermark else []),
+            f"""
+                CREATE TRIGGER {table}_insert AFTER INSERT ON app_{model_name} BEGIN
+                    {make_insert_stmt()}
+                END;
+            """,
+            f"""
+                CREATE TRIGGER {table}_update AFTER UPDATE OF {", ".join(watched_columns)} ON app_{model_name}
+                    WHEN {" OR ".join([f"old.{column} IS NOT new.{column}" for column in watched_columns])}
+                BEGIN
+                    {make_delete_stmt()}
+                    {make_insert_stmt()}
+                END;
+            """,
+            f"""
+                CREATE TRIGGER {table}_delete AFTER DELETE ON app_{model_name} BEGIN
+                    {make_delete_stmt()}
+                END;
+            """,
+        ]
+
+    def drop_schema(self, cursor, cls):
+        table = self.get_table(cls)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s;", [f"{table}_%"])
+        for [trigger] in cursor.fetchall():
+            cursor.execute(f"DROP TRIGGER {trigger};")
+        cursor.execute(f"DROP TABLE IF EXISTS {table};")
+        cursor.execute(f"DROP TABLE IF EXISTS {table}_trigram;")
+        cursor.execute(f"DROP VIEW IF EXISTS {table}_content;")
+
+    def reindex(self, cls, chunk_size: int, shadow=False, progress=None) -> int:
+        """
+        Rebuilds the search table in transactions of chunk_size rows in id order.
+
+        Triggers of the new table maintain rows up to the watermark, which is moved past each chunk,
+        so concurrent writes are indexed either by them or by a later chunk. The last chunk is
+        taken along with replacing the old table and triggers, in a transaction of its own.
+        """
+        model_name = cls._meta.model_name
+        table = self.get_table(cls)
+
+        with self.connection.cursor() as cursor:
+            self.create_index_table(cursor)
+            cursor.execute("CREATE TABLE IF NOT EXISTS app_search_reindex (name TEXT PRIMARY KEY, watermark INTEGER NOT NULL);")
+
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO app_search_reindex (name, watermark) VALUES (%s, 0)
+                    ON CONFLICT (name) DO UPDATE SET watermark = 0;
+            """, [model_name])
+            # The shadow table is built over the current content view, which has to be rebuilt when outdated
+            cursor.execute("SELECT fingerprint FROM app_search_index WHERE name = %s;", [model_name])
+            shadow = shadow and cursor.fetchone() == (self.get_fingerprint(cls),)
+            target = f"{table}_shadow" if shadow else table
+            if shadow:
+                # Leftovers of an interrupted run
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s;", [f"{target}_%"])
+                for [trigger] in cursor.fetchall():
+                    cursor.execute(f"DROP TRIGGER {trigger};")
+                cursor.execute(f"DROP TABLE IF EXISTS {target};")
+                cursor.execute(f"DROP TABLE IF EXISTS {target}_trigram;")
+            else:
+                self.drop_schema(cursor, cls)
+            for stmt in self.get_schema(cls, target, watermark=True):
+                cursor.execute(stmt)
+
+        rows = 0
+        while True:
+            with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+                count = self.reindex_chunk(cursor, cls, target, chunk_size)
+            if not count:
+                break
+            rows += count
+            if progress:
+                progress(rows)
+
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            rows += self.reindex_chunk(cursor, cls, target, -1)
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s;", [f"{table}_%"])
+            for [trigger] in cursor.fetchall():
+                cursor.execute(f"DROP TRIGGER {trigger};")
+            if shadow:
+                cursor.execute(f"DROP TABLE IF EXISTS {table};")
+                cursor.execute(f"ALTER TABLE {target} RENAME TO {table};")
+                if cls.search_identifiers:
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}_trigram;")
+                    cursor.execute(f"ALTER TABLE {target}_trigram RENAME TO {table}_trigram;")
+            for stmt in self.get_schema(cls):
+                if stmt.split()[:2] == ["CREATE", "TRIGGER"]:
+                    cursor.execute(stmt)
+            cursor.execute("DELETE FROM app_search_reindex WHERE name = %s;", [model_name])
+            cursor.execute("""
+                INSERT INTO app_search_index (name, fingerprint) VALUES (%s, %s)
+                    ON CONFLICT (name) DO UPDATE SET fingerprint = excluded.fingerprint, generation = app_search_index.generation + 1;
+            """, [model_name, self.get_fingerprint(cls)])
+        if progress:
+            progress(rows)
+        return rows
+
+    def reindex_chunk(self, cursor, cls, table, chunk_size: int) -> int:
+        """Indexes up to chunk_size rows past the watermark into the table and moves the watermark past them."""
+        model_name = cls._meta.model_name
+        # Transactions of reindex write first to take the write lock before reading,
+        # so that concurrent writers wait for them instead of failing to upgrade their read locks
+        cursor.execute("UPDATE app_search_reindex SET watermark = watermark WHERE name = %s;", [model_name])
+        cursor.execute("SELECT watermark FROM app_search_reindex WHERE name = %s;", [model_name])
+        [watermark] = cursor.fetchone()
+        cursor.execute(f"""
+            SELECT max(id), count(*) FROM (SELECT id FROM {self.get_table(cls)}_content WHERE id > %s ORDER BY id LIMIT %s);
+        """, [watermark, chunk_size])
+        [last, count] = cursor.fetchone()
+        if not count:
+            return 0
+
+        columns = self.get_columns(cls)
+        cursor.execute(f"""
+            INSERT INTO {table} (rowid, {", ".join(columns)})
+                SELECT id, {", ".join(columns)} FROM {self.get_table(cls)}_content WHERE id > %s AND id <= %s;
+        """, [watermark, last])
+        if cls.search_identifiers:
+            cursor.execute(f"""
+                INSERT INTO {table}_trigram (rowid, {", ".join(cls.search_identifiers)})
+                    SELECT id, {", ".join(cls.search_identifiers)} FROM {cls._meta.db_table}
+                    WHERE id > %s AND id <= %s {"AND deleted_at IS NULL" if hasattr(cls, "deleted_at") else ""};
+            """, [watermark, last])
+        cursor.execute("UPDATE app_search_reindex SET watermark = %s WHERE name = %s;", [last, model_name])
+        return count
+
+    def create_index_table(self, cursor):
+        super().create_index_table(cursor)
+        cursor.execute("SELECT 1 FROM pragma_table_info('app_search_index') WHERE name = 'generation';")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE app_search_index ADD COLUMN generation INTEGER NOT NULL DEFAULT 0;")
+
+    def identifier_subquery(self, cls, term: str) -> tuple[str, list]:
+        table = f"{self.get_table(cls)}_trigram"
+        return f"SELECT rowid FROM {table} WHERE {table} MATCH %s", [self.get_query(term)]
+
+    def filter(self, cls, search: str, prefix=False) -> Q:
+        table = self.get_table(cls)
+        if not any(self.get_identifier_subqueries(cls, term) for term in search.split()):
+            return Q(id__in=RawSQL(f"SELECT rowid FROM {table} WHERE {table} MATCH %s", [self.get_query(search, prefix)]))
+
+        return self.filter_terms(cls, search, prefix=prefix)
+
+    def filter_terms(self, cls, search: str, latest=None, latest_params=[], prefix=False) -> Q:
+        """
+        Filter matching every term either by a token or by a substring of an identifier.
+
+        If latest, an SQL expression, is given, only that many of the latest rows are taken for every alternative.
+        """
+        table = self.get_table(cls)
+        filter = Q()
+        for term in search.split():
+            subqueries = [(f"SELECT rowid FROM {table} WHERE {table} MATCH %s", [self.get_query(term, prefix)])] + \
+                self.get_identifier_subqueries(cls, term, self.top_candidates if latest else None)
+            if latest:
+                subqueries = [(f"SELECT * FROM ({sql} ORDER BY 1 DESC LIMIT {latest})", [*params, *latest_params])
+                              for sql, params in subqueries]
+            # Alternatives are united in a single subquery, since SQLite would scan the table for an OR of them
+            filter &= Q(id__in=RawSQL(" UNION ".join([sql for sql, params in subqueries]),
+                                      [param for sql, params in subqueries for param in params]))
+        return filter
+
+    def filter_latest(self, cls, search: str, prefix=False, fields=None) -> Q:
+        table = self.get_table(cls)
+        query = self.get_query(search, prefix)
+        if fields:
+            query = f"{{{' '.join(fields)}}} : ({query})"
+        # FTS5 yields the latest matches of all terms without reading the rest of them, unlike an IN subquery of all matches
+        subqueries = [(f"SELECT rowid FROM {table} WHERE {table} MATCH %s ORDER BY rowid DESC LIMIT {self.top_candidates}",
+                       [query])]
+        if not fields and any(self.get_identifier_subqueries(cls, term) for term in search.split()):
+            subqueries.append(cls._base_manager.filter(self.filter_terms(cls, search, self.top_candidates, prefix=prefix))
+                              .values("id").query.sql_with_params())
+        return Q(id__in=RawSQL(" UNION ".join([f"SELECT * FROM ({sql})" for sql, params in subqueries]),
+                               [param for sql, params in subqueries for param in params]))
+
+    def get_rank(self, cls, query: str, default=None):
+        """Relevance of rows of the model by the FTS5 query, lower is better, or the default for rows it doesn't match."""
+        table = self.connection.ops.quote_name(self.get_table(cls))
+        db_table = self.connection.ops.quote_name(cls._meta.db_table)
+        # The limit keeps SQLite from flattening the ranked matches into the lookup of every row,
+        # so they are ranked once instead of once per row
+        rank = f"(SELECT rank FROM (SELECT rowid, rank FROM {table} WHERE {table} MATCH %s LIMIT -1 OFFSET 0) AS ranked WHERE ranked.rowid = {db_table}.id)"
+        return RawSQL(rank if default is None else f"coalesce({rank}, {default})", [query], output_field=FloatField())
+
+    def rank(self, cls, queryset, search: str):
+        if any(self.get_identifier_subqueries(cls, term) for term in search.split()):
+            # Rows found by identifiers only may be missing from the search table, and rank after the rest
+            return queryset.filter(self.filter(cls, search)).annotate(
+                search_rank=self.get_rank(cls, " OR ".join(self.get_query(term) for term in search.split()), default=0)
+            ).order_by("search_rank", *queryset.query.order_by)
+        return self.rank_tokens(cls, queryset, search)
+
+    def rank_tokens(self, cls, queryset, search: str):
+        """Filters the queryset by rows whose tokens match every term, ordered by relevance first."""
+        table = self.connection.ops.quote_name(self.get_table(cls))
+        query = self.get_query(search)
+        return queryset.filter(id__in=RawSQL(f"SELECT rowid FROM {table} WHERE {table} MATCH %s", [query])) \
+            .annotate(search_rank=self.get_rank(cls, query)).order_by("search_rank", *queryset.query.order_by)
+
+    def rank_top(self, cls, queryset, search: str, limit: int) -> list[tuple[str, list]]:
+        table = self.connection.ops.quote_name(self.get_table(cls))
+        db_table = self.connection.ops.quote_name(cls._meta.db_table)
+        query = self.get_query(search)
+        # Rows of the queryset are checked one by one, which unlike an IN subquery doesn't read the whole table
+        exists_sql, exists_params = queryset.filter(id=RawSQL("candidates.rowid", [])).values("id").query.sql_with_params()
+        subqueries = [(f"""
+            SELECT candidates.rowid AS id, candidates.rank AS search_rank
+            FROM (SELECT rowid, rank FROM {table} WHERE {table} MATCH %s ORDER BY rowid DESC LIMIT {self.top_candidates}) AS candidates
+            WHERE EXISTS ({exists_sql})
+            ORDER BY search_rank LIMIT {limit}
+        """, [query, *exists_params])]
+
+        if any(self.get_identifier_subqueries(cls, term) for term in search.split()):
+            # Rows found by identifiers only rank after the rest, so the latest of them are looked up only when there
+            # are too few of those. A zero limit, unlike a false condition, stops the scan of alternatives right away
+            latest = f"{self.top_candidates} * ((SELECT count(*) FROM (SELECT 1 FROM {table} WHERE {table} MATCH %s LIMIT {limit})) < {limit})"
+            sql, params = queryset.filter(self.filter_terms(cls, search, latest, [query])) \
+                .filter(RawSQL(f"NOT EXISTS (SELECT 1 FROM {table} WHERE {table} MATCH %s AND rowid = {db_table}.id)", [query],
+                               output_field=BooleanField())) \
+                .order_by("-id").values("id")[:limit].query.sql_with_params()
+            subqueries.append((f"SELECT id, 0 AS search_rank FROM ({sql}) AS identified", params))
+        return subqueries
+
+    def match_ids(self, cls, search: str, limit: int) -> list[int]:
+        if any(self.get_identifier_subqueries(cls, term) for term in search.split()):
+            return super().match_ids(cls, search, limit)
+        table = self.get_table(cls)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"SELECT rowid FROM {table} WHERE {table} MATCH %s ORDER BY rank LIMIT %s;",
+                           [self.get_query(search), limit])
+            return [row[0] for row in cursor.fetchall()]
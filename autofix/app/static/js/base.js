@@ -1,2 +1,93 @@
 for (const element of document.querySelectorAll(".dateinput, .datetimeinput"))
     element.setAttribute("type", "date");
+
+
+for (const select of document.querySelectorAll("select[data-autocomplete-url]")) {
+    if (select.disabled)
+        continue;
+
+    const dropdown = document.createElement("div");
+    dropdown.className = "autocomplete dropdown";
+    const input = document.createElement("input");
+    input.className = "form-control";
+    input.type = "search";
+    input.placeholder = "Начните вводить для поиска";
+    input.value = select.value ? select.selectedOptions[0].text : "";
+    const menu = document.createElement("div");
+    menu.className = "dropdown-menu";
+    dropdown.append(input, menu);
+    select.classList.add("d-none");
+    select.after(dropdown);
+
+    let request = 0;
+    let timeout;
+    async function load(page) {
+        const current = ++request;
+        const url = `${select.dataset.autocompleteUrl}?search=${encodeURIComponent(input.value)}&page=${page}`;
+        const data = await (await fetch(url)).json();
+        if (current !== request)
+            return;
+
+        if (page === 1)
+            menu.replaceChildren();
+        menu.querySelector(".autocomplete-more")?.remove();
+        for (const result of data.results) {
+            const item = document.createElement("button");
+            item.type = "button";
+            item.className = "dropdown-item";
+            item.textContent = result.text;
+            item.addEventListener("mousedown", event => {
+                event.preventDefault();
+                select.replaceChildren(new Option(result.text, result.id, true, true));
+                input.value = result.text;
+                menu.classList.remove("show");
+            });
+            menu.append(item);
+        }
+        if (data.more) {
+            const more = document.createElement("button");
+            more.type = "button";
+            more.className = "dropdown-item text-secondary autocomplete-more";
+            more.textContent = "Показать ещё";
+            more.addEventListener("mousedown", event => {
+                event.preventDefault();
+                load(page + 1);
+            });
+            menu.append(more);
+        }
+        if (!menu.children.length)
+            menu.append(Object.assign(document.createElement("span"), {className: "dropdown-item-text", textContent: "Ничего не найдено."}));
+        menu.classList.add("show");
+    }
+
+    input.addEventListener("focus", () => load(1));
+    input.addEventListener("input", () => {
+        clearTimeout(timeout);
+        timeout = setTimeout(() => load(1), 250);
+    });
+    input.addEventListener("blur", () => {
+        request++;
+        menu.classList.remove("show");
+        if (!input.value)
+            select.replaceChildren(new Option("", "", true, true));
+        input.value = select.value ? select.selectedOptions[0].text : "";
+    });
+}
+
+
+// Handheld scanners type the barcode and press Enter, which adds the item to the order at once
+for (const form of document.querySelectorAll(".scan-form")) {
+    const input = form.querySelector("input[name=code]");
+    form.addEventListener("submit", async event => {
+        event.preventDefault();
+        const response = await fetch(form.action, {method: "POST", body: new FormData(form)});
+        if (response.ok) {
+            location.reload();
+            return;
+        }
+        form.querySelector(".invalid-feedback").textContent = (await response.json()).error;
+        input.classList.add("is-invalid");
+        input.select();
+    });
+    input.addEventListener("input", () => input.classList.remove("is-invalid"));
+}
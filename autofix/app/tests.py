@@ -1,8 +1,21 @@
-from datetime import timedelta
+import threading
+import time
+import unittest.mock
+from io import StringIO
+from unittest import skipUnless
+from datetime import datetime, timedelta
 from decimal import Decimal
-from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase
 from django import test
+from django.core.management import CommandError, call_command
+from django.db import connection, migrations, transaction
+from django.test.utils import CaptureQueriesContext
+from .forms import RepairOrderForm, ServiceHistoryForm, print_receipt_button
+from .pagination import KeysetPage
+from .permissions import can
 from .models import *
+from .search import get_search_backend, initialize_search, uninstall_search, search_cache, SearchCache
 from django.utils.dateparse import parse_datetime
 
 
@@ -301,7 +314,7 @@ class RepairOrderValidationTestCase(TestCase):
         )
 
         # Ensure the total cost is calculated correctly
-        self.assertEqual(repair_order.get_total_cost(), Decimal("125.00"))
+        self.assertEqual(repair_order.total, Decimal("125.00"))
 
 
 class EmployeeValidationTestCase(TestCase):
@@ -427,6 +440,740 @@ class WarehouseUseValidationTestCase(TestCase):
         self.assertEqual(context.exception.message_dict, expected_error_message)
 
 
+class WarehouseFixtureMixin:
+    """Logged in employee of the position, two items without stock, a provider and an order of the employee."""
+    position = Employee.Position.Administrator
+    item_fields = {}
+    other_item_fields = {}
+
+    def setUp(self):
+        self.user = Employee.objects.create(username="user1", position=self.position)
+        self.client.force_login(self.user)
+
+        self.item = WarehouseItem.objects.create(**{"name": "Фильтр", "type": "Масляный", "price": 10} | self.item_fields)
+        self.other_item = WarehouseItem.objects.create(**{"name": "Свеча", "type": "Зажигания", "price": 5} | self.other_item_fields)
+        self.provider = WarehouseProvider.objects.create(name="Поставщик")
+        self.order = self.add_order()
+
+    def add_order(self):
+        return RepairOrder.objects.create(master=self.user, client=Client.objects.create(full_name="Test Client"),
+                                          vehicle=Vehicle.objects.create(model="Test Model", year=2022),
+                                          vehicle_mileage=5000, is_cancelled=False)
+
+class WarehouseStockTestCase(WarehouseFixtureMixin, TestCase):
+    def assertStocks(self, stock, other_stock):
+        self.assertEqual(WarehouseItem.objects.get(id=self.item.id).stock, stock)
+        self.assertEqual(WarehouseItem.objects.get(id=self.other_item.id).stock, other_stock)
+
+    def test_stock_follows_restocks_and_uses(self):
+        restock = WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=10)
+        use = WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=3)
+        self.assertStocks(7, 0)
+
+        restock.amount = 12
+        restock.save()
+        self.assertStocks(9, 0)
+
+        use.item = self.other_item
+        with self.assertRaises(ValidationError):
+            use.save()
+        self.assertStocks(9, 0)
+
+        WarehouseRestock.objects.create(item=self.other_item, provider=self.provider, amount=5)
+        use.save()
+        self.assertStocks(12, 2)
+
+        use.delete()
+        self.assertStocks(12, 5)
+
+        # A stale item doesn't overwrite the stock
+        self.item.name = "Фильтр воздушный"
+        self.item.save()
+        self.item.delete()
+        self.assertEqual(WarehouseItem._base_manager.get(id=self.item.id).stock, 12)
+
+    def test_count_validation_of_edited_use(self):
+        WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=4)
+        use = WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=3)
+        use.amount = 4
+        use.clean()
+        use.amount = 5
+        with self.assertRaises(ValidationError):
+            use.clean()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_views_have_no_queries_per_item(self):
+        def add_rows():
+            item = WarehouseItem.objects.create(name="Расходник", type="Тип", price=1)
+            WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=5)
+            WarehouseRestock.objects.create(item=item, provider=self.provider, amount=5)
+            WarehouseUse.objects.create(repair_order=self.order, item=item, amount=1)
+
+        add_rows()
+        urls = ["/warehouse/items/", f"/warehouse/items/{self.item.id}/", f"/repair/orders/{self.order.id}/"]
+        queries = [self.count_queries(url) for url in urls]
+        for i in range(4):
+            add_rows()
+        self.assertEqual([self.count_queries(url) for url in urls], queries)
+        self.assertContains(self.client.get("/warehouse/items/"), "25 шт.")
+
+    def test_reconcile_command(self):
+        WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=10)
+        call_command("reconcile_stock", stdout=StringIO())
+
+        WarehouseItem.objects.filter(id=self.item.id).update(stock=3)
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command("reconcile_stock", stdout=out)
+        self.assertIn("stored 3 шт., ledger 10 шт.", out.getvalue())
+        self.assertStocks(3, 0)
+
+        call_command("reconcile_stock", fix=True, stdout=StringIO())
+        self.assertStocks(10, 0)
+
+class WarehouseLowStockTestCase(WarehouseFixtureMixin, TestCase):
+    position = Employee.Position.WarehouseManager
+    item_fields = {"reorder_threshold": 5}
+
+    def low_stock(self):
+        return list(WarehouseItem.objects.filter(is_low_stock=True).order_by("id"))
+
+    def test_low_stock_follows_stock(self):
+        self.assertEqual(self.low_stock(), [self.item])
+        restock = WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=5)
+        self.assertEqual(self.low_stock(), [])
+        use = WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=1)
+        self.assertEqual(self.low_stock(), [self.item])
+        use.delete()
+        self.assertEqual(self.low_stock(), [])
+
+        # A stale item doesn't overwrite the flag, and a changed threshold updates it
+        self.item.reorder_threshold = 6
+        self.item.save()
+        self.assertEqual(self.low_stock(), [self.item])
+        self.other_item.reorder_threshold = 1
+        self.other_item.save(update_fields=["reorder_threshold"])
+        self.assertEqual(self.low_stock(), [self.item, self.other_item])
+
+        restock.amount = 6
+        restock.save()
+        self.other_item.delete()
+        self.assertEqual(self.low_stock(), [])
+
+    def test_list_filter_and_badge(self):
+        response = self.client.get("/warehouse/items/?low_stock=1")
+        self.assertEqual(list(response.context["object_list"]), [self.item])
+        self.assertContains(response, '<span class="badge text-bg-danger" title="Заканчиваются">1</span>', html=True)
+        response = self.client.get("/warehouse/items/")
+        self.assertEqual(list(response.context["object_list"]), [self.other_item, self.item])
+
+        WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=5)
+        response = self.client.get("/warehouse/items/?low_stock=1")
+        self.assertEqual(list(response.context["object_list"]), [])
+        self.assertNotContains(response, "Заканчиваются")
+
+class WarehouseStockHistoryTestCase(WarehouseFixtureMixin, TestCase):
+    position = Employee.Position.WarehouseManager
+
+    def setUp(self):
+        super().setUp()
+        self.today = timezone.localdate()
+        self.days = [self.today - timedelta(days=days) for days in [5, 4, 3]]
+
+        self.move(self.days[0], WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=10))
+        self.move(self.days[0], WarehouseRestock.objects.create(item=self.other_item, provider=self.provider, amount=4))
+        self.move(self.days[1], WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=3))
+        self.use = self.move(self.days[2], WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=2))
+
+    def move(self, day, row):
+        WarehouseMovement.objects.filter(id=WarehouseMovement.objects.latest("id").id).update(
+            created_at=timezone.make_aware(datetime.combine(day, datetime.min.time())) + timedelta(hours=12)
+        )
+        return row
+
+    def stocks_at(self, day):
+        return list(WarehouseItem.objects.order_by("id").annotate(stock_at=WarehouseItem.get_stock_at(get_day_end(day)))
+                    .values_list("stock_at", flat=True))
+
+    def test_stock_at_date(self):
+        self.assertEqual(self.stocks_at(self.days[0] - timedelta(days=1)), [0, 0])
+        self.assertEqual([self.stocks_at(day) for day in self.days], [[10, 4], [7, 4], [5, 4]])
+
+        self.use.amount = 1
+        self.use.save()
+        self.assertEqual(self.stocks_at(self.days[2]), [5, 4])
+        self.assertEqual(self.stocks_at(self.today), [6, 4])
+
+    def test_snapshots(self):
+        out = StringIO()
+        call_command("snapshot_stock", f"--date={self.days[1]}", stdout=out)
+        self.assertIn("Took 2 stock snapshots", out.getvalue())
+        call_command("snapshot_stock", f"--date={self.days[1]}", stdout=out)
+        self.assertIn("Took 0 stock snapshots", out.getvalue())
+        call_command("snapshot_stock", stdout=out)
+        self.assertEqual(WarehouseStockSnapshot.objects.filter(item=self.item).count(), 2)
+
+        # Stocks are read from the snapshots, not from the movements before them
+        WarehouseMovement.objects.filter(created_at__lt=get_day_end(self.days[1])).delete()
+        self.assertEqual([self.stocks_at(day) for day in self.days[1:]], [[7, 4], [5, 4]])
+        with self.assertRaises(CommandError):
+            call_command("snapshot_stock", f"--date={self.today}", stdout=out)
+
+    def test_report(self):
+        response = self.client.get(f"/warehouse/report/?date={self.days[1].isoformat()}")
+        self.assertEqual([(item, item.stock_at) for item in response.context["object_list"]],
+                         [(self.other_item, 4), (self.item, 7)])
+        self.assertEqual(response.context["total"], 90)
+        self.assertContains(response, "90,00 руб.")
+
+        self.other_item.delete()
+        response = self.client.get("/warehouse/report/?date=invalid")
+        self.assertEqual(response.context["date"], self.today)
+        self.assertEqual(list(response.context["object_list"]), [self.other_item, self.item])
+        response = self.client.get(f"/warehouse/report/?date={self.days[0] - timedelta(days=1)}")
+        self.assertEqual(list(response.context["object_list"]), [self.item])
+
+        self.client.force_login(Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic))
+        self.assertEqual(self.client.get("/warehouse/report/").status_code, 302)
+
+class WarehouseRestockImportTestCase(WarehouseFixtureMixin, TestCase):
+    position = Employee.Position.WarehouseManager
+    other_item_fields = {"reorder_threshold": 3}
+
+    def setUp(self):
+        super().setUp()
+        self.url = f"/warehouse/providers/{self.provider.id}/import/"
+
+    def upload(self, text, encoding="utf-8", follow=True):
+        return self.client.post(self.url, {"file": SimpleUploadedFile("invoice.csv", text.encode(encoding))}, follow=follow)
+
+    def test_import(self):
+        response = self.upload(
+            "Код;Тип;Наименование;Количество;Цена закупки\n"
+            f"{self.item.id};;;5;8,50\n"
+            ";зажигания;СВЕЧА ;4;\n"
+            "\n"
+            ";Масляный;Фильтр;2;9\n",
+            "cp1251"
+        )
+        self.assertEqual(response.request["PATH_INFO"], f"/warehouse/providers/{self.provider.id}/")
+        self.assertContains(response, "Импортировано строк: 3")
+        self.assertEqual(WarehouseRestock.objects.filter(provider=self.provider).count(), 3)
+        self.assertEqual(list(WarehouseItem.objects.order_by("id").values_list("stock", "is_low_stock")), [(7, False), (4, False)])
+        self.assertEqual(WarehouseMovement.objects.count(), 2)
+        self.assertEqual(list(WarehouseRestock.objects.order_by("id").values_list("unit_cost", "remaining")),
+                         [(Decimal("8.5"), 5), (5, 4), (9, 2)])
+        call_command("reconcile_stock", stdout=StringIO())
+
+    def test_invalid_lines(self):
+        WarehouseItem.objects.create(name="Свеча", type="Зажигания", price=6)
+        response = self.upload("Наименование,Тип,Количество\nФильтр,Масляный,0\nСвеча,Зажигания,1\nДворник,Щетка,1\n")
+        self.assertContains(response, "Строка 2: количество должно быть целым положительным числом.")
+        self.assertContains(response, "Строка 3: несколько расходников с таким типом и наименованием, укажите код.")
+        self.assertContains(response, "Строка 4: расходник не найден.")
+        response = self.upload("Код\tКоличество\n999\t1\n")
+        self.assertContains(response, "Строка 2: нет расходника с кодом 999.")
+        response = self.upload(f"Код;Количество;Цена\n{self.item.id};1;-1\n{self.item.id};1;дорого\n")
+        self.assertContains(response, "Строка 2: цена закупки должна быть неотрицательным числом меньше 100000.")
+        self.assertContains(response, "Строка 3: цена закупки должна быть неотрицательным числом меньше 100000.")
+        response = self.upload("Наименование;Количество\nФильтр;1\n")
+        self.assertContains(response, "В первой строке должны быть столбцы")
+        self.assertFalse(WarehouseRestock.objects.exists())
+
+        self.client.force_login(Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic))
+        self.assertEqual(self.upload("Код;Количество\n1;1\n", follow=False).status_code, 302)
+        self.assertFalse(WarehouseRestock.objects.exists())
+
+    def test_large_invoice(self):
+        lines = 10000
+        items = WarehouseItem.objects.bulk_create([
+            WarehouseItem(name=f"Расходник {index}", type="Тип", price=1) for index in range(lines)
+        ])
+        text = "Тип;Наименование;Количество\n" + "".join(f"Тип;Расходник {index};{index % 7 + 1}\n" for index in range(lines))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.upload(text)
+        self.assertContains(response, f"Импортировано строк: {lines}")
+        self.assertLess(len(queries), 200)
+        self.assertEqual(WarehouseItem.objects.get(id=items[-1].id).stock, (lines - 1) % 7 + 1)
+        call_command("reconcile_stock", stdout=StringIO())
+
+class WarehouseScanTestCase(WarehouseFixtureMixin, TestCase):
+    position = Employee.Position.Mechanic
+    item_fields = {"sku": "4601234567890"}
+
+    def setUp(self):
+        super().setUp()
+        WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=2)
+        self.scan_url = f"/repair/orders/{self.order.id}/warehouse_uses/scan/"
+
+    def test_lookup(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/warehouse/items/scan/?code=4601234567890")
+        self.assertEqual(response.json(), {"id": self.item.id, "text": "Масляный Фильтр (2 шт.)", "stock": 2, "is_low_stock": False})
+        self.assertEqual(len([query for query in queries if "app_warehouseitem" in query["sql"]]), 1)
+
+        self.assertEqual(self.client.get("/warehouse/items/scan/?code=0000").status_code, 404)
+        self.client.force_login(Employee.objects.create(username="cashier", position=Employee.Position.Cashier))
+        self.assertEqual(self.client.get("/warehouse/items/scan/?code=4601234567890").status_code, 302)
+
+    def test_unique_sku(self):
+        self.client.force_login(Employee.objects.create(username="manager", position=Employee.Position.WarehouseManager))
+        data = {"name": "Фильтр", "type": "Воздушный", "price": 20, "reorder_threshold": 0, "sku": "4601234567890"}
+        self.assertContains(self.client.post("/warehouse/items/create/", data), "Расходник с таким штрихкодом уже есть.")
+
+        self.item.delete()
+        self.client.post("/warehouse/items/create/", data)
+        self.assertEqual(WarehouseItem.objects.get(sku="4601234567890").type, "Воздушный")
+        data["sku"] = ""
+        self.client.post("/warehouse/items/create/", data)
+        self.client.post("/warehouse/items/create/", data)
+        self.assertEqual(WarehouseItem.objects.filter(sku=None).exclude(id=self.other_item.id).count(), 2)
+
+    def test_scan_adds_use(self):
+        self.assertContains(self.client.get(f"/repair/orders/{self.order.id}/"), 'action="warehouse_uses/scan/"')
+
+        response = self.client.post(self.scan_url, {"code": "4601234567890"})
+        self.assertEqual(response.json()["stock"], 1)
+        response = self.client.post(self.scan_url, {"code": "4601234567890", "amount": "2"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Требуется еще 1 шт., имеется: 1 шт.", response.json()["error"])
+        self.assertEqual(self.client.post(self.scan_url, {"code": "0000"}).status_code, 404)
+        self.assertEqual(list(WarehouseUse.objects.values_list("repair_order", "item", "amount")), [(self.order.id, self.item.id, 1)])
+
+        self.order.master = Employee.objects.create(username="other", position=Employee.Position.Mechanic)
+        self.order.save()
+        self.assertEqual(self.client.post(self.scan_url, {"code": "4601234567890"}).status_code, 404)
+        self.client.force_login(Employee.objects.create(username="cashier", position=Employee.Position.Cashier))
+        self.assertEqual(self.client.post(self.scan_url, {"code": "4601234567890"}).status_code, 302)
+
+    def test_import_by_sku(self):
+        self.client.force_login(Employee.objects.create(username="manager", position=Employee.Position.WarehouseManager))
+        provider = WarehouseProvider.objects.get()
+        response = self.client.post(f"/warehouse/providers/{provider.id}/import/", {
+            "file": SimpleUploadedFile("invoice.csv", "Штрихкод;Количество\n4601234567890;3\n".encode())
+        }, follow=True)
+        self.assertContains(response, "Импортировано строк: 1")
+        self.assertEqual(WarehouseItem.objects.get(id=self.item.id).stock, 5)
+
+class WarehouseCostTestCase(WarehouseFixtureMixin, TestCase):
+    item_fields = {"price": 30}
+
+    def setUp(self):
+        super().setUp()
+        self.restocks = [
+            WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=5, unit_cost=10),
+            WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=5, unit_cost=20),
+        ]
+
+    def use(self, amount, item=None):
+        return WarehouseUse.objects.create(repair_order=self.order, item=item or self.item, amount=amount)
+
+    def assertLayers(self, remaining, costs):
+        self.assertEqual([restock.remaining for restock in WarehouseRestock.objects.filter(item=self.item).order_by("id")], remaining)
+        self.assertEqual([use.cost for use in WarehouseUse.objects.order_by("id")], costs)
+        for use in WarehouseUse.objects.all():
+            self.assertEqual(sum(consumption.amount * consumption.restock.unit_cost
+                                 for consumption in WarehouseConsumption.objects.filter(use=use)), use.cost)
+
+    def test_uses_take_oldest_restocks(self):
+        first = self.use(3)
+        second = self.use(4)
+        self.assertLayers([0, 3], [30, 60])
+
+        second.amount = 1
+        second.save()
+        self.assertLayers([1, 5], [30, 10])
+
+        first.delete()
+        self.assertLayers([4, 5], [10])
+        second.item = self.other_item
+        WarehouseRestock.objects.create(item=self.other_item, provider=self.provider, amount=1)
+        second.save()
+        self.assertLayers([5, 5], [5])
+
+    def test_restock_changes_rebalance_uses(self):
+        first = self.use(3)
+        second = self.use(4)
+        third = WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=5, unit_cost=40)
+
+        self.restocks[0].unit_cost = 12
+        self.restocks[0].save()
+        self.assertLayers([0, 3, 5], [36, 64])
+
+        # Units taken from the restock beyond its new amount move to the next one, the latest use first
+        self.restocks[0].amount = 2
+        self.restocks[0].save()
+        self.assertLayers([0, 0, 5], [2 * 12 + 20, 4 * 20])
+
+        self.restocks[1].delete()
+        self.assertLayers([0, 0], [2 * 12 + 40, 4 * 40])
+        self.assertEqual(WarehouseItem.objects.get(id=self.item.id).stock, 0)
+        call_command("reconcile_stock", stdout=StringIO())
+
+    def test_positional_save_arguments(self):
+        use = WarehouseUse(repair_order=self.order, item=self.item, amount=3)
+        use.save(True)
+        use.amount = 6
+        use.save(False, True)
+        self.restocks[1].unit_cost = 30
+        self.restocks[1].save(False, True)
+        self.assertLayers([0, 4], [80])
+
+    def test_bulk_create(self):
+        self.assertEqual(WarehouseRestock.objects.bulk_create([
+            WarehouseRestock(item=self.other_item, provider=self.provider, amount=2),
+        ])[0].unit_cost, 5)
+        uses = WarehouseUse.objects.bulk_create([
+            WarehouseUse(repair_order=self.order, item=self.item, amount=6),
+            WarehouseUse(repair_order=self.order, item=self.other_item, amount=1),
+        ])
+        self.assertEqual([use.cost for use in uses], [70, 5])
+        self.assertLayers([0, 4], [70, 5])
+
+    def test_margin_report(self):
+        service = Service.objects.create(name="Замена масла", price=500)
+        self.order.finish_date = timezone.localdate()
+        self.order.save()
+        ServiceHistory.objects.create(repair_order=self.order, service=service)
+        ServiceHistory.objects.create(repair_order=self.order, service=service)
+        self.use(3)
+        self.use(4)
+
+        response = self.client.get("/repair/orders/margin/")
+        self.assertEqual([(order.revenue, order.cost, order.margin) for order in response.context["object_list"]],
+                         [(1000 + 7 * 30, 90, 1120)])
+        self.assertContains(response, "1120,00 руб.")
+
+        self.order.is_warranty = True
+        self.order.save()
+        response = self.client.get(f"/repair/orders/margin/?start={timezone.localdate()}&end=invalid")
+        self.assertEqual([response.context[f"total_{key}"] for key in ["revenue", "cost", "margin"]], [0, 90, -90])
+        self.assertEqual(len(self.client.get(f"/repair/orders/margin/?end={timezone.localdate() - timedelta(days=1)}")
+                             .context["object_list"]), 0)
+
+        self.client.force_login(Employee.objects.create(username="cashier", position=Employee.Position.Cashier))
+        self.assertEqual(self.client.get("/repair/orders/margin/").status_code, 302)
+
+class RepairOrderTotalTestCase(WarehouseFixtureMixin, TestCase):
+    item_fields = {"price": 30}
+
+    def setUp(self):
+        super().setUp()
+        self.service = Service.objects.create(name="Замена масла", price=500)
+        WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=10)
+        self.orders = [self.order, self.add_order()]
+
+    def assertTotals(self, *totals):
+        self.assertEqual([order.total for order in RepairOrder.objects.order_by("id")], list(totals))
+
+    def test_lines_keep_prices(self):
+        history = ServiceHistory.objects.create(repair_order=self.orders[0], service=self.service)
+        use = WarehouseUse.objects.create(repair_order=self.orders[0], item=self.item, amount=2)
+        self.assertTotals(560, 0)
+
+        # Later prices apply to new lines only
+        self.service.price = 600
+        self.service.save()
+        self.item.price = 40
+        self.item.save()
+        use.amount = 3
+        use.save()
+        history.comments = "Готово"
+        history.save()
+        self.assertTotals(590, 0)
+        ServiceHistory.objects.create(repair_order=self.orders[0], service=self.service)
+        self.assertTotals(1190, 0)
+
+        history.service = Service.objects.create(name="Диагностика", price=100)
+        history.save()
+        use.repair_order = self.orders[1]
+        use.save()
+        self.assertTotals(700, 90)
+
+        # A stale order doesn't overwrite the total
+        self.orders[0].comments = "Комментарий"
+        self.orders[0].save()
+        history.delete()
+        use.delete()
+        self.assertTotals(600, 0)
+
+    def test_positional_save_arguments(self):
+        history = ServiceHistory(repair_order=self.orders[0], service=self.service)
+        history.save(True)
+        history.comments = "Готово"
+        history.save(False, True)
+        self.assertTotals(500, 0)
+
+    def test_bulk_create(self):
+        WarehouseUse.objects.bulk_create([
+            WarehouseUse(repair_order=self.orders[0], item=self.item, amount=2),
+            WarehouseUse(repair_order=self.orders[1], item=self.item, amount=1),
+        ])
+        self.assertTotals(60, 30)
+
+    def test_pages_read_stored_total(self):
+        ServiceHistory.objects.create(repair_order=self.orders[0], service=self.service)
+        WarehouseUse.objects.create(repair_order=self.orders[0], item=self.item, amount=2)
+        for url, text in [(f"/repair/orders/{self.orders[0].id}/", 'value="560.00"'),
+                          (f"/repair/orders/{self.orders[0].id}/receipt/", "560,00 руб."),
+                          ("/repair/orders/", "Итого: 560.00 руб.")]:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertContains(self.client.get(url), text)
+            self.assertFalse([query for query in queries if "SUM(" in query["sql"]])
+
+class RepairOrderStatusTestCase(TestCase):
+    def setUp(self):
+        self.user = Employee.objects.create(username="user1", position=Employee.Position.Administrator)
+        self.client.force_login(self.user)
+        self.today = timezone.localdate()
+
+        client = Client.objects.create(full_name="Test Client")
+        vehicle = Vehicle.objects.create(model="Test Model", year=2022)
+        def order(**kwargs):
+            return RepairOrder.objects.create(master=self.user, client=client, vehicle=vehicle, vehicle_mileage=5000,
+                                              start_date=self.today - timedelta(days=10), **({"is_cancelled": False} | kwargs))
+        self.orders = {
+            "OP": order(finish_until=self.today + timedelta(days=1)),
+            "OV": order(finish_until=self.today - timedelta(days=1)),
+            "TD": order(finish_until=self.today),
+            "UN": order(finish_date=self.today),
+            "PA": order(finish_date=self.today, is_paid=True),
+            "WA": order(finish_date=self.today, is_warranty=True, is_paid=True),
+            "CA": order(finish_date=self.today, is_cancelled=True),
+        }
+
+    def get_ids(self, query):
+        return [order.id for order in self.client.get(f"/repair/orders/?{query}").context["object_list"]]
+
+    def test_stored_status(self):
+        self.assertEqual({key: order.status for key, order in self.orders.items()},
+                         {"OP": "OP", "OV": "OP", "TD": "OP", "UN": "UN", "PA": "PA", "WA": "WA", "CA": "CA"})
+
+        order = self.orders["UN"]
+        order.is_paid = True
+        order.save(update_fields=["is_paid"])
+        self.assertEqual(RepairOrder.objects.get(id=order.id).status, RepairOrder.Status.Paid)
+
+    def test_filters(self):
+        for key, order in self.orders.items():
+            self.assertEqual(self.get_ids(f"status={key}"), [order.id])
+        # Open orders without a due date are neither overdue nor due today
+        order = RepairOrder.objects.create(master=self.user, client=self.orders["OP"].client, vehicle=self.orders["OP"].vehicle,
+                                           vehicle_mileage=5000, is_cancelled=False)
+        self.assertEqual(sorted(self.get_ids("status=OP")), [self.orders["OP"].id, order.id])
+        order.delete()
+        self.assertEqual(len(self.get_ids("")), 4)
+        self.assertEqual(len(self.get_ids("status=invalid&show_finished=1")), 7)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/repair/orders/?status=OV")
+        self.assertIn('"finish_until" < ', [query["sql"] for query in queries if '"status" = ' in query["sql"]][-1])
+
+    def test_sort(self):
+        self.assertEqual(self.get_ids("sort=status"), [self.orders[key].id for key in ["OV", "TD", "OP", "UN"]])
+        self.assertEqual(self.get_ids("sort=new&show_finished=1"), sorted(self.get_ids("show_finished=1"), reverse=True))
+
+        response = self.client.get("/repair/orders/?sort=status")
+        self.assertContains(response, '<span class="text-danger">Завершить до')
+        self.assertContains(response, '<span class="text-warning">Завершить до')
+
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        self.user = Employee.objects.create(username="user1", position=Employee.Position.Administrator)
+        self.client.force_login(self.user)
+        self.today = timezone.localdate()
+
+        client = Client.objects.create(full_name="Test Client")
+        vehicle = Vehicle.objects.create(model="Test Model", year=2022)
+        # Shared and missing due dates make rows tie on the first key
+        self.orders = [RepairOrder.objects.create(
+            master=self.user, client=client, vehicle=vehicle, vehicle_mileage=5000, is_cancelled=False,
+            start_date=self.today - timedelta(days=index % 4),
+            finish_until=None if index % 5 == 0 else self.today + timedelta(days=index % 3 - 1),
+            finish_date=self.today if index % 7 == 0 else None, is_paid=index % 7 == 0
+        ) for index in range(45)]
+
+    def walk(self, query):
+        pages, cursor = [], None
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/repair/orders/?" + query + (f"&cursor={cursor}" if cursor else ""))
+            self.assertFalse([query for query in queries if 'COUNT(*) AS "__count" FROM "app_repairorder"' in query["sql"]])
+            page = response.context["page_obj"]
+            pages.append([order.id for order in page])
+            if not page.has_next:
+                return pages, response
+            cursor = page.next_cursor
+
+    def test_pages_follow_ordering(self):
+        # Orders without a due date keep the placement of NULLs of the database, last on PostgreSQL and first on SQLite
+        def due(order):
+            return ((order.finish_until is None) == connection.features.nulls_order_largest, order.finish_until, order.id)
+        shown = [order for order in self.orders if order.finish_date is None]
+        for query, expected in [
+            ("show_finished=1", sorted(self.orders, key=due)),
+            ("", sorted(shown, key=due)),
+            ("sort=new&show_finished=1", sorted(self.orders, key=lambda order: (order.start_date, order.id), reverse=True)),
+        ]:
+            pages, response = self.walk(query)
+            self.assertEqual([len(page) for page in pages[:-1]], [20] * (len(pages) - 1))
+            self.assertEqual(sum(pages, []), [order.id for order in expected])
+
+            # Going back returns the same pages
+            page = response.context["page_obj"]
+            for previous in reversed(pages[:-1]):
+                page = self.client.get(f"/repair/orders/?{query}&cursor={page.previous_cursor}").context["page_obj"]
+                self.assertEqual([order.id for order in page], previous)
+            self.assertFalse(page.has_previous)
+
+        pages, response = self.walk("sort=status")
+        self.assertEqual(sorted(sum(pages, [])), [order.id for order in shown])
+        self.assertContains(response, "&lsaquo; Назад")
+
+    def test_database_null_placement(self):
+        # Pages follow the ordering of the database, with NULLs of any key where it puts them
+        for ordering in [["finish_until"], ["-finish_until"], ["finish_date", "-finish_until"], ["-finish_date", "finish_until"]]:
+            queryset = RepairOrder.objects.order_by(*ordering)
+            expected = list(queryset.order_by(*ordering, "id").values_list("id", flat=True))
+            pages, page = [], KeysetPage(queryset, 7, None)
+            while True:
+                pages.append([order.id for order in page])
+                if not page.has_next:
+                    break
+                page = KeysetPage(queryset, 7, page.next_cursor)
+            self.assertEqual(sum(pages, []), expected)
+            for previous in reversed(pages[:-1]):
+                page = KeysetPage(queryset, 7, page.previous_cursor)
+                self.assertEqual([order.id for order in page], previous)
+
+    def get_ids(self, query):
+        return [order.id for order in self.client.get(f"/repair/orders/?{query}").context["object_list"]]
+
+    def test_invalid_cursor(self):
+        cursor = self.client.get("/repair/orders/").context["page_obj"].next_cursor
+        self.assertEqual(self.get_ids("cursor=invalid"), self.get_ids(""))
+        self.assertEqual(self.get_ids("cursor=WyJ4Il0"), self.get_ids(""))
+        # A cursor of another ordering
+        self.assertEqual(self.get_ids(f"sort=new&cursor={cursor}"), self.get_ids("sort=new"))
+
+class CardQueryTestCase(WarehouseFixtureMixin, TestCase):
+    item_fields = {"price": 30}
+
+    def setUp(self):
+        super().setUp()
+        self.service = Service.objects.create(name="Замена масла", price=500)
+
+    def add_lines(self):
+        WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=10)
+        ServiceHistory.objects.create(repair_order=self.order, service=self.service)
+        WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=1)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_queries_do_not_grow_with_cards(self):
+        self.add_lines()
+        urls = ["/repair/orders/?show_finished=1", "/repair/orders/?sort=status", f"/repair/orders/{self.order.id}/",
+                f"/warehouse/items/{self.item.id}/", "/search/?search=Test"]
+        counts = [self.count_queries(url) for url in urls]
+        for i in range(4):
+            self.add_order()
+            self.add_lines()
+        self.assertEqual([self.count_queries(url) for url in urls], counts)
+
+    def test_card_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get("/repair/orders/"), f"№{self.order.id}: {self.order.vehicle}")
+        sql = [query["sql"] for query in queries if '"app_client"' in query["sql"]][-1]
+        self.assertNotIn('"complaints"', sql)
+        self.assertIn('"current_status"', sql)
+
+    def test_nested_lists_are_paginated(self):
+        WarehouseRestock.objects.bulk_create([WarehouseRestock(item=self.item, provider=self.provider, amount=1)
+                                              for i in range(25)])
+        ServiceHistory.objects.create(repair_order=self.order, service=self.service)
+        url = f"/warehouse/items/{self.item.id}/"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url + "?search=test")
+        [restocks] = response.context["extra_contexts"]
+        self.assertEqual(len(restocks["object_list"]), 20)
+        self.assertContains(response, "?search=test&restocks_page=2")
+        # The session and the user are loaded once, and the item isn't fetched again for the list
+        self.assertEqual(len([query for query in queries if '"django_session"' in query["sql"]]), 1)
+        self.assertEqual(len([query for query in queries if query["sql"].startswith('SELECT "app_warehouseitem"."id"')]), 1)
+
+        response = self.client.get(url + "?restocks_page=2")
+        self.assertEqual(len(response.context["extra_contexts"][0]["object_list"]), 5)
+        self.assertEqual(len(self.client.get(f"/repair/orders/{self.order.id}/?restocks_page=2")
+                             .context["extra_contexts"][0]["object_list"]), 1)
+
+class WarehouseStockConcurrencyTestCase(WarehouseFixtureMixin, TransactionTestCase):
+    position = Employee.Position.Mechanic
+    threads = 8
+    uses_per_thread = 25
+
+    def setUp(self):
+        super().setUp()
+        WarehouseRestock.objects.create(item=self.item, provider=self.provider, amount=100)
+
+    def test_concurrent_uses_do_not_oversell(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("In-memory SQLite fails concurrent writers instead of making them wait, set SQLITE_TEST_NAME to run it")
+        barrier = threading.Barrier(self.threads)
+        used = []
+        rejected = []
+
+        def use():
+            try:
+                barrier.wait()
+                for i in range(self.uses_per_thread):
+                    try:
+                        WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=1)
+                        used.append(1)
+                    except ValidationError:
+                        rejected.append(1)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=use) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual((len(used), len(rejected)), (100, self.threads * self.uses_per_thread - 100))
+        self.assertEqual(WarehouseItem.objects.get(id=self.item.id).stock, 0)
+        self.assertEqual(WarehouseUse.objects.count(), 100)
+        call_command("reconcile_stock", stdout=StringIO())
+
+    def test_use_of_taken_stock_is_shown_on_form(self):
+        self.client.force_login(self.order.master)
+        WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=99)
+        use = WarehouseUse.objects.create(repair_order=self.order, item=self.item, amount=1)
+
+        # The form is validated before the other use, and saved after it
+        def clean(self):
+            use.delete()
+            WarehouseUse.objects.create(repair_order=self.repair_order, item=self.item, amount=1)
+        with unittest.mock.patch.object(WarehouseUse, "clean", clean):
+            response = self.client.post(f"/repair/orders/{self.order.id}/warehouse_uses/create/",
+                                        {"item": self.item.id, "amount": 1})
+        self.assertContains(response, "Недостаточно единиц расходника. Требуется еще 1 шт., имеется: 0 шт.")
+        self.assertEqual(WarehouseUse.objects.count(), 2)
+
+        restock = WarehouseRestock.objects.get()
+        self.client.force_login(Employee.objects.create(username="warehouse", position=Employee.Position.WarehouseManager))
+        response = self.client.get(f"{restock.get_absolute_url()}?delete", HTTP_REFERER=restock.get_absolute_url(), follow=True)
+        self.assertContains(response, "Расходник уже использован")
+        self.assertTrue(WarehouseRestock.objects.filter(id=restock.id).exists())
+
 class ServiceHistoryValidationTestCase(TestCase):
     def setUp(self):
         # Set up necessary objects for testing
@@ -553,3 +1300,583 @@ class PermissionCheckTestCase(TestCase):
         self.client.force_login(self.warehouse_manager_user)
         response = self.client.get(reverse('order', args=[self.repair_order.id]))
         self.assertEqual(response.status_code, 302)
+
+    def test_mechanic_sees_own_orders(self):
+        other_order = RepairOrder.objects.create(
+            master=Employee.objects.create_user(username='other', position=Employee.Position.Mechanic),
+            client=self.repair_order.client, vehicle=self.repair_order.vehicle, vehicle_mileage=5000, is_cancelled=False
+        )
+        self.client.force_login(self.mechanic_user)
+        self.assertEqual(list(self.client.get(reverse('orders'), {"show_finished": 1}).context["object_list"]),
+                         [self.repair_order])
+        for url in [reverse('order', args=[other_order.id]), reverse('order_receipt', args=[other_order.id])]:
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.force_login(self.service_manager_user)
+        self.assertEqual(self.client.get(reverse('order', args=[other_order.id])).status_code, 200)
+
+    def test_permission_matrix(self):
+        self.assertTrue(can(Employee.Position.Administrator, Employee, "create"))
+        self.assertTrue(can(Employee.Position.Mechanic, WarehouseUse, "create"))
+        self.assertFalse(can(Employee.Position.Mechanic, RepairOrder, "create"))
+        self.assertFalse(can(None, RepairOrder, "edit"))
+        self.assertTrue(can(Employee.Position.ServiceManager, RepairOrder, "print"))
+        self.assertFalse(can(Employee.Position.ServiceManager, RepairOrder, "margin"))
+        self.assertTrue(can(Employee.Position.Administrator, RepairOrder, "margin"))
+
+        form = RepairOrderForm(instance=self.repair_order, initial={"position": Employee.Position.Mechanic})
+        self.assertEqual({name for name, field in form.fields.items() if not field.disabled},
+                         {"finish_date", "diagnostic_results", "comments", "total_cost"})
+        self.assertNotIn(print_receipt_button, form.helper.layout.fields)
+        form = RepairOrderForm(instance=self.repair_order, initial={"position": Employee.Position.ServiceManager})
+        self.assertIn(print_receipt_button, form.helper.layout.fields)
+        form = ServiceHistoryForm(instance=None, initial={"position": Employee.Position.Cashier, "order": self.repair_order.id})
+        self.assertTrue(all(field.disabled for field in form.fields.values()))
+
+    def test_object_is_fetched_once(self):
+        self.client.force_login(self.mechanic_user)
+        for method, status_code in [("get", 200), ("post", 302)]:
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, method)(reverse('order', args=[self.repair_order.id]))
+            self.assertEqual(response.status_code, status_code)
+            self.assertEqual(len([query for query in queries
+                                  if query["sql"].startswith('SELECT "app_repairorder"."id"')]), 1)
+
+
+class SearchAssertionsMixin:
+    def assertSearchConsistent(self, models=None):
+        # Compares the index with the content of every search table
+        if connection.vendor != "sqlite":
+            return
+        with connection.cursor() as cursor:
+            for model in models or FullTextSearchMixin.search_models:
+                table = get_search_backend().get_table(model)
+                for table in [table, f"{table}_trigram"] if model.search_identifiers else [table]:
+                    cursor.execute(f"INSERT INTO {table} ({table}, rank) VALUES ('integrity-check', 1);")
+
+
+class SearchIndexTestCase(SearchAssertionsMixin, TestCase):
+    def setUp(self):
+        self.client_obj = Client.objects.create(
+            full_name = "Иванов Иван Иванович",
+            phone_number = "+79955443322"
+        )
+        self.order = RepairOrder.objects.create(
+            master=Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic),
+            client=self.client_obj,
+            vehicle=Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=2022),
+            vehicle_mileage=5000,
+            is_cancelled=False,
+            complaints="Стучит подвеска"
+        )
+
+    def test_search_after_insert(self):
+        self.assertQuerySetEqual(Client.objects.filter(Client.search("Иванов")), [self.client_obj])
+
+    def test_search_after_update(self):
+        self.client_obj.full_name = "Петров Петр Петрович"
+        self.client_obj.save()
+        self.assertQuerySetEqual(Client.objects.filter(Client.search("Иванов")), [])
+        self.assertQuerySetEqual(Client.objects.filter(Client.search("Петров")), [self.client_obj])
+
+    def test_search_by_joined_fields(self):
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search("Иванов подвеска")), [self.order])
+
+        self.client_obj.full_name = "Петров Петр Петрович"
+        self.client_obj.save()
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search("Иванов подвеска")), [])
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search("Петров подвеска")), [self.order])
+        self.assertSearchConsistent()
+
+    def test_search_after_delete(self):
+        self.order.delete()
+        self.client_obj.delete()
+        self.assertQuerySetEqual(RepairOrder.objects.all_with_deleted().filter(RepairOrder.search("Иванов")), [])
+        self.assertQuerySetEqual(Client.objects.all_with_deleted().filter(Client.search("Иванов")), [])
+        self.assertSearchConsistent()
+
+    def count_changes(self, action):
+        # total_changes() includes rows written by triggers, FTS5 shadow tables among them
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT total_changes();")
+            [before] = cursor.fetchone()
+            action()
+            cursor.execute("SELECT total_changes();")
+            [after] = cursor.fetchone()
+        return after - before
+
+    @skipUnless(connection.vendor == "sqlite", "Counts rows written by FTS5 triggers")
+    def test_unindexed_update_does_not_reindex(self):
+        self.order.is_paid = True
+        self.assertEqual(self.count_changes(self.order.save), 1)
+        self.assertEqual(self.count_changes(self.client_obj.save), 1)
+
+    @skipUnless(connection.vendor == "sqlite", "Counts rows written by FTS5 triggers")
+    def test_indexed_update_reindexes(self):
+        self.client_obj.phone_number = "+79950000000"
+        self.assertGreater(self.count_changes(self.client_obj.save), 1)
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search("79950000000")), [self.order])
+        self.assertSearchConsistent()
+
+    def test_unchanged_index_is_not_rebuilt(self):
+        self.assertEqual(initialize_search(), [])
+
+
+class SearchIdentifierTestCase(SearchAssertionsMixin, TestCase):
+    def setUp(self):
+        self.vehicle = Vehicle.objects.create(manufacturer="Lada", model="Vesta", year=2021,
+                                              license_number="А123ВС77", vin="XTA21099012345678")
+        self.other_vehicle = Vehicle.objects.create(manufacturer="Lada", model="Granta", year=2020,
+                                                    license_number="В456ОР99", vin="XTA21099087654321")
+        self.order = RepairOrder.objects.create(
+            master=Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic),
+            client=Client.objects.create(full_name = "Иванов Иван Иванович", phone_number = "+79955443322"),
+            vehicle=self.vehicle,
+            vehicle_mileage=5000,
+            is_cancelled=False,
+            complaints="Стучит подвеска"
+        )
+
+    def test_search_by_partial_identifier(self):
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("34567")), [self.vehicle])
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("а123в")), [self.vehicle])
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("XTA2109")).order_by("id"),
+                                 [self.vehicle, self.other_vehicle])
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("23")), [])
+
+    def test_search_by_partial_identifier_of_joined_row(self):
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search("Иванов 34567")), [self.order])
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search("Петров 34567")), [])
+
+    def test_search_ranked_by_partial_identifier(self):
+        self.assertQuerySetEqual(Vehicle.search_ranked(Vehicle.objects.order_by("id"), "Granta XTA2109"), [self.other_vehicle])
+        self.assertQuerySetEqual(Vehicle.search_ranked(Vehicle.objects.order_by("id"), "34567"), [self.vehicle])
+
+    def test_search_after_identifier_update(self):
+        self.vehicle.vin = "XTA21099000000000"
+        self.vehicle.save()
+        self.other_vehicle.delete()
+        self.assertQuerySetEqual(Vehicle.objects.all_with_deleted().filter(Vehicle.search("34567")), [])
+        self.assertQuerySetEqual(Vehicle.objects.all_with_deleted().filter(Vehicle.search("XTA2109")), [self.vehicle])
+        self.assertSearchConsistent()
+
+
+class SearchIndexRebuildTestCase(TransactionTestCase):
+    # Rolling back the rebuild would leave FTS5 with stale cached structures, so it is committed here
+
+    def test_changed_index_is_rebuilt(self):
+        client = Client.objects.create(full_name = "Иванов Иван Иванович", phone_number = "+79955443322")
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE app_search_index SET fingerprint = '' WHERE name = 'client';")
+        self.assertEqual(initialize_search(), [Client])
+        self.assertQuerySetEqual(Client.objects.filter(Client.search("Иванов")), [client])
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO app_client_search (app_client_search, rank) VALUES ('integrity-check', 1);")
+
+    def test_migrated_models_are_rebuilt(self):
+        client = Client.objects.create(full_name = "Иванов Иван Иванович", phone_number = "+79955443322")
+        migration = migrations.Migration("0001_test", "app")
+        migration.operations = [migrations.AlterField("client", "full_name", models.CharField(max_length=100))]
+        uninstall_search(plan=[(migration, False)])
+        self.assertEqual(initialize_search(), [Client, RepairOrder])
+        self.assertQuerySetEqual(Client.objects.filter(Client.search("Иванов")), [client])
+
+
+class SearchReindexTestCase(SearchAssertionsMixin, TransactionTestCase):
+    def setUp(self):
+        self.vehicles = [
+            Vehicle.objects.create(manufacturer="Lada", model="Vesta", year=2021, license_number=f"А00{index}ВС77", vin=f"XTA2109901234567{index}")
+            for index in range(3)
+        ]
+        self.order = RepairOrder.objects.create(
+            master=Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic),
+            client=Client.objects.create(full_name = "Иванов Иван Иванович", phone_number = "+79955443322"),
+            vehicle=self.vehicles[0],
+            vehicle_mileage=5000,
+            is_cancelled=False,
+            complaints="Стучит подвеска"
+        )
+
+    def test_reindex_command(self):
+        out = StringIO()
+        call_command("reindex_search", "Vehicle", "repairorder", chunk_size=1, stdout=out)
+        self.assertIn("vehicle: reindexed 3 rows", out.getvalue())
+        self.assertIn("rows/s", out.getvalue())
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Vesta 002ВС")), [self.vehicles[2]])
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search("Иванов Vesta")), [self.order])
+        self.assertEqual(initialize_search(), [])
+        self.assertSearchConsistent()
+
+    def test_reindex_unknown_model(self):
+        with self.assertRaises(CommandError):
+            call_command("reindex_search", "car", stdout=StringIO())
+
+    def test_writes_during_reindex(self):
+        for shadow in [False, True]:
+            with self.subTest(shadow=shadow):
+                vehicles = [
+                    Vehicle.objects.create(manufacturer="Lada", model="Niva", year=2021, license_number=f"Е00{index}КХ77")
+                    for index in range(3)
+                ]
+
+                def write(rows):
+                    # Rows on both sides of the watermark change between chunks
+                    if len(vehicles) > 3:
+                        return
+                    vehicles[0].model = "Granta"
+                    vehicles[0].save()
+                    vehicles[1].delete()
+                    vehicles[2].license_number = "О999ОО99"
+                    vehicles[2].save()
+                    vehicles.append(Vehicle.objects.create(manufacturer="Lada", model="Niva", year=2022, license_number="Р555РР55"))
+
+                get_search_backend().reindex(Vehicle, 1, shadow, write)
+                self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Niva")).order_by("id"), [vehicles[2], vehicles[3]])
+                self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Granta")), [vehicles[0]])
+                self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("999ОО")), [vehicles[2]])
+                self.assertQuerySetEqual(Vehicle.objects.all_with_deleted().filter(Vehicle.search("001КХ")), [])
+                # Flushing tables between tests out of order leaves stale rows in the index of repair orders
+                self.assertSearchConsistent([Vehicle])
+                Vehicle.objects.filter(id__in=[vehicle.id for vehicle in vehicles]).delete()
+
+
+class SearchCacheTestCase(TransactionTestCase):
+    # Searches are cached only outside of transactions
+
+    def setUp(self):
+        self.vehicle = Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=2022,
+                                              license_number="А001АА", vin="12345678901234567")
+
+    def test_cache_invalidation(self):
+        info = search_cache.info()
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Camry")), [self.vehicle])
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("camry")), [self.vehicle])
+        self.assertEqual(search_cache.info()["misses"] - info["misses"], 1)
+        self.assertEqual(search_cache.info()["hits"] - info["hits"], 1)
+
+        self.vehicle.model = "Corolla"
+        self.vehicle.save()
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Camry")), [])
+        self.assertEqual(search_cache.info()["misses"] - info["misses"], 2)
+
+    def test_unindexed_update_keeps_cache(self):
+        Vehicle.objects.filter(Vehicle.search("Camry")).count()
+        generation = Vehicle.get_search_generation()
+        self.vehicle.year = 2023
+        self.vehicle.save()
+        self.assertEqual(Vehicle.get_search_generation(), generation)
+
+    def test_too_many_results(self):
+        Vehicle.search_cache_max_ids = 0
+        try:
+            self.assertIsNone(Vehicle.get_cached_search_ids("Camry"))
+            self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Camry")), [self.vehicle])
+        finally:
+            del Vehicle.search_cache_max_ids
+
+    def test_single_flight(self):
+        cache = SearchCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return [1]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("search:test:single_flight", compute)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while cache.info()["coalesced"] < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[1]] * 5)
+        self.assertEqual(cache.info(), {"hits": 0, "misses": 1, "coalesced": 4})
+
+
+class SearchQueryTestCase(TestCase):
+    def setUp(self):
+        self.user = Employee.objects.create(
+            last_name="Петров",
+            first_name="Сергей",
+            patronymic="Морозович",
+            position=Employee.Position.Administrator,
+            username="user1"
+        )
+        self.client.force_login(self.user)
+
+        self.vehicle_once = Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=2022,
+                                                   license_number="А001АА", vin="12345678901234567")
+        self.vehicle_twice = Vehicle.objects.create(manufacturer="Toyota", model="Toyota", year=2020,
+                                                    license_number="В002ВВ", vin="76543210987654321")
+        self.vehicle_other = Vehicle.objects.create(manufacturer="Lada", model="Vesta", year=2021,
+                                                    license_number="С003СС", vin="11111111111111111")
+
+    def test_search_is_lazy(self):
+        with self.assertNumQueries(0):
+            filter = Vehicle.search("Toyota")
+        self.assertIn({"sqlite": "MATCH", "postgresql": "@@"}[connection.vendor], str(Vehicle.objects.filter(filter).query))
+
+    def test_search_filter(self):
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Toyota")).order_by("id"),
+                                 [self.vehicle_once, self.vehicle_twice])
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("Toyota Vesta")), [])
+
+    def test_search_quotes(self):
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search('"Toyota')).order_by("id"),
+                                 [self.vehicle_once, self.vehicle_twice])
+        self.assertQuerySetEqual(Vehicle.objects.filter(Vehicle.search("  ")).order_by("id"),
+                                 [self.vehicle_once, self.vehicle_twice, self.vehicle_other])
+
+    def test_search_ranked(self):
+        self.assertQuerySetEqual(Vehicle.search_ranked(Vehicle.objects.order_by("id"), "Toyota"),
+                                 [self.vehicle_twice, self.vehicle_once])
+
+    def test_list_view(self):
+        # Session, user, count, page and the low stock count
+        with self.assertNumQueries(5):
+            response = self.client.get("/repair/vehicles/?search=Toyota")
+        self.assertQuerySetEqual(response.context['object_list'], [self.vehicle_twice, self.vehicle_once])
+
+
+class ClientPhoneLookupTestCase(TestCase):
+    def setUp(self):
+        self.user = Employee.objects.create(username="user1", position=Employee.Position.Administrator)
+        self.client.force_login(self.user)
+
+        self.client_obj = Client.objects.create(full_name = "Иванов Иван Иванович", phone_number = "+79955443322")
+        self.other_client = Client.objects.create(full_name = "Петров Петр Петрович", phone_number = "+79161234567")
+        self.order = RepairOrder.objects.create(
+            master=Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic),
+            client=self.client_obj,
+            vehicle=Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=2022),
+            vehicle_mileage=5000,
+            is_cancelled=False,
+            complaints="Стучит подвеска"
+        )
+
+    def lookup(self, search):
+        return Client.objects.filter(Client.get_phone_filter(search)).order_by("id")
+
+    def test_phone_digits(self):
+        self.assertEqual(self.client_obj.phone_digits, "79955443322")
+        self.assertEqual(self.client_obj.phone_digits_reversed, "22334455997")
+
+        [client] = Client.objects.bulk_create([Client(full_name = "Сидоров", phone_number = "+79001112233")])
+        self.assertEqual(Client.objects.get(id=client.id).phone_digits, "79001112233")
+
+        self.client_obj.phone_number = "+79990000000"
+        self.client_obj.save(update_fields=["phone_number"])
+        self.assertEqual(Client.objects.get(id=self.client_obj.id).phone_digits_reversed, "00000009997")
+
+    def test_phone_lookup(self):
+        self.assertQuerySetEqual(self.lookup("+7 (995) 544-33-22"), [self.client_obj])
+        self.assertQuerySetEqual(self.lookup("3322"), [self.client_obj])
+        self.assertQuerySetEqual(self.lookup("8 995 544"), [self.client_obj])
+        self.assertQuerySetEqual(self.lookup("916 123"), [self.other_client])
+        self.assertQuerySetEqual(self.lookup("7999"), [])
+        self.assertIsNone(Client.get_phone_filter("322"))
+        self.assertIsNone(Client.get_phone_filter("Иванов 3322"))
+
+    def test_phone_digits_are_not_in_search_index(self):
+        self.assertQuerySetEqual(Client.objects.filter(Client.search("22334455997")), [])
+
+    def test_list_views(self):
+        response = self.client.get("/repair/clients/?search=3322")
+        self.assertQuerySetEqual(response.context["object_list"], [self.client_obj])
+        response = self.client.get("/repair/orders/?search=8 995 544")
+        self.assertQuerySetEqual(response.context["object_list"], [self.order])
+        response = self.client.get(f"/repair/orders/?search={self.order.id}")
+        self.assertQuerySetEqual(response.context["object_list"], [self.order])
+
+
+class GlobalSearchTestCase(TestCase):
+    def setUp(self):
+        self.user = Employee.objects.create(username="user1", position=Employee.Position.Administrator)
+        self.mechanic = Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic)
+        self.client.force_login(self.user)
+
+        self.vehicle_once = Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=2022,
+                                                   license_number="А001АА", vin="12345678901234567")
+        self.vehicle_twice = Vehicle.objects.create(manufacturer="Toyota", model="Toyota", year=2020,
+                                                    license_number="В002ВВ", vin="76543210987654321")
+        self.vehicle_other = Vehicle.objects.create(manufacturer="Lada", model="Vesta", year=2021,
+                                                    license_number="С003СС", vin="11111111111111111")
+        client = Client.objects.create(full_name="Иванов Иван Иванович", phone_number="+79955443322")
+        self.order = RepairOrder.objects.create(master=self.user, client=client, vehicle=self.vehicle_other,
+                                                vehicle_mileage=5000, is_cancelled=False)
+        self.mechanic_order = RepairOrder.objects.create(master=self.mechanic, client=client, vehicle=self.vehicle_once,
+                                                         vehicle_mileage=5000, is_cancelled=False)
+
+    def test_top_ids(self):
+        backend = get_search_backend()
+        querysets = [Vehicle.objects.all(), Client.objects.all(), RepairOrder.objects.filter(master=self.user)]
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.top_ids(querysets, "Toyota", 5),
+                             [[self.vehicle_twice.id, self.vehicle_once.id], [], []])
+        self.assertEqual(backend.top_ids(querysets, "Toyota", 1), [[self.vehicle_twice.id], [], []])
+        self.assertEqual(backend.top_ids(querysets, "Иванов", 5), [[], [self.order.client_id], [self.order.id]])
+        self.assertEqual(backend.top_ids(querysets, "С003", 5), [[self.vehicle_other.id], [], [self.order.id]])
+        self.assertEqual(backend.top_ids(querysets, "Toyota Vesta", 5), [[], [], []])
+        self.assertEqual(backend.top_ids(querysets, "  ", 5), [[], [], []])
+
+    def test_search_view(self):
+        # Session, user, best matches, orders, vehicles and the low stock count
+        with self.assertNumQueries(6):
+            response = self.client.get("/search/?search=Toyota")
+        self.assertEqual([result["plural_name"] for result in response.context["results"]], ["Заявки на ремонт", "Автомобили"])
+        [orders, vehicles] = response.context["results"]
+        self.assertEqual(orders["object_list"], [self.mechanic_order])
+        self.assertEqual(vehicles["object_list"], [self.vehicle_twice, self.vehicle_once])
+        self.assertEqual(vehicles["url"], "/repair/vehicles/?search=Toyota")
+        self.assertContains(response, self.vehicle_twice.get_absolute_url())
+
+        response = self.client.get("/search/?search=Camry")
+        self.assertEqual(len(response.context["results"]), 2)
+        response = self.client.get("/search/?search=Nothing")
+        self.assertEqual(response.context["results"], [])
+        self.assertContains(response, "Ничего не найдено.")
+
+    def test_search_view_permissions(self):
+        self.client.force_login(self.mechanic)
+        response = self.client.get("/search/?search=Иванов")
+        [orders] = response.context["results"]
+        self.assertEqual(orders["object_list"], [self.mechanic_order])
+
+        self.client.force_login(Employee.objects.create(username="warehouse", position=Employee.Position.WarehouseManager))
+        response = self.client.get("/search/?search=Иванов")
+        self.assertEqual(response.context["results"], [])
+
+
+class AutocompleteTestCase(TestCase):
+    def setUp(self):
+        self.user = Employee.objects.create(username="user1", position=Employee.Position.Administrator)
+        self.client.force_login(self.user)
+
+        self.mechanic = Employee.objects.create(username="mechanic", last_name="Сидоров", position=Employee.Position.Mechanic)
+        Employee.objects.create(username="fired", last_name="Сидоренко", position=Employee.Position.Mechanic,
+                                end_date=timezone.now().date())
+        self.ivanov = Client.objects.create(full_name="Иванов Иван", phone_number="+79955443322")
+        self.ivanova = Client.objects.create(full_name="Иванова Мария", phone_number="+79955443323")
+        Client.objects.create(full_name="Петров Петр", phone_number="+79955443324")
+        Client.objects.create(full_name="Иванченко Олег", phone_number="+79955443325").delete()
+        self.order = RepairOrder.objects.create(
+            master=self.mechanic,
+            client=self.ivanov,
+            vehicle=Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=2022),
+            vehicle_mileage=5000,
+            is_cancelled=False
+        )
+
+    def autocomplete(self, url):
+        response = self.client.get(url)
+        return [result["text"] for result in response.json()["results"]], response.json()["more"]
+
+    def test_prefix_search(self):
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/client/?search=Иван"),
+                         ([str(self.ivanova), str(self.ivanov)], False))
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/client/?search=Мари Ив"), ([str(self.ivanova)], False))
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/vehicle/?search=toy"), ([str(self.order.vehicle)], False))
+
+    def test_limit_choices_to(self):
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/master/"), ([str(self.mechanic)], False))
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/master/?search=Сидор"), ([str(self.mechanic)], False))
+
+    def test_display_fields(self):
+        self.mechanic.passport_info = "4510 123456"
+        self.mechanic.save()
+        self.user.position = Employee.Position.Cashier
+        self.user.save()
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/master/?search=4510"), ([], False))
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/master/?search=4510 Сидор"), ([], False))
+        self.assertEqual(self.autocomplete("/autocomplete/repairorder/master/?search=Сидор"), ([str(self.mechanic)], False))
+
+    def test_pages(self):
+        Client.objects.bulk_create([Client(full_name=f"Клиент {i}", phone_number=f"+7900000{i:04}") for i in range(25)])
+        first, more = self.autocomplete("/autocomplete/repairorder/client/?search=Клиент")
+        self.assertEqual((len(first), more), (20, True))
+        second, more = self.autocomplete("/autocomplete/repairorder/client/?search=Клиент&page=2")
+        self.assertEqual((len(second), more), (5, False))
+        self.assertEqual(set(first) & set(second), set())
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.client.get("/autocomplete/repairorder/unknown/").status_code, 404)
+        self.assertEqual(self.client.get("/autocomplete/unknown/client/").status_code, 404)
+        self.assertEqual(self.client.get("/autocomplete/repairorder/complaints/").status_code, 404)
+        self.client.force_login(self.mechanic)
+        for url in ["/autocomplete/warehouserestock/provider/", "/autocomplete/warehouserestock/", "/autocomplete/"]:
+            self.assertEqual(self.client.get(url)["Location"], "..")
+
+    def test_form_fetches_only_chosen_rows(self):
+        form = RepairOrderForm(instance=self.order, initial={"position": Employee.Position.Administrator})
+        with self.assertNumQueries(1):
+            html = str(form["client"])
+        self.assertEqual(html.count("<option"), 2)
+        self.assertIn('data-autocomplete-url="/autocomplete/repairorder/client/"', html)
+        with self.assertNumQueries(1):
+            self.assertEqual(form.fields["client"].clean(str(self.ivanova.id)), self.ivanova)
+
+    def test_invalid_choice(self):
+        for value in ["abc", "1.5", "1;2"]:
+            response = self.client.post("/repair/orders/create/", {"master": value, "client": self.ivanov.id})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("master", response.context["form"].errors)
+            self.assertFalse(RepairOrder.objects.exclude(id=self.order.id).exists())
+
+
+@skipUnless(connection.vendor == "postgresql", "PostgreSQL search backend")
+class PostgresSearchTestCase(TestCase):
+    def setUp(self):
+        self.client_obj = Client.objects.create(full_name = "Иванов Иван Иванович", phone_number = "+79955443322")
+        self.order = RepairOrder.objects.create(
+            master=Employee.objects.create(username="mechanic", position=Employee.Position.Mechanic),
+            client=self.client_obj,
+            vehicle=Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=2022),
+            vehicle_mileage=5000,
+            is_cancelled=False,
+            complaints="Стучит подвеска"
+        )
+
+    def test_search_vector_is_indexed(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'app_repairorder_search_vector';")
+            [[indexdef]] = cursor.fetchall()
+        self.assertIn("gin (search_vector)", indexdef)
+
+    def test_search_by_phone_and_id(self):
+        self.assertQuerySetEqual(Client.objects.filter(Client.search("79955443322")), [self.client_obj])
+        self.assertQuerySetEqual(RepairOrder.objects.filter(RepairOrder.search(f"{self.order.id} Camry")), [self.order])
+
+    def test_ranked_by_joined_fields(self):
+        other = RepairOrder.objects.create(
+            master=self.order.master, client=self.client_obj, vehicle=self.order.vehicle,
+            vehicle_mileage=5000, is_cancelled=False, complaints="Иванов просит проверить подвеску"
+        )
+        self.assertQuerySetEqual(RepairOrder.search_ranked(RepairOrder.objects.order_by("id"), "Иванов"), [other, self.order])
+
+
+@skipUnless(connection.vendor == "postgresql", "PostgreSQL search backend")
+class PostgresSearchGenerationTestCase(TransactionTestCase):
+    def test_generation_is_bumped_once_per_transaction(self):
+        generation = Vehicle.get_search_generation()
+        with transaction.atomic():
+            for year in range(2020, 2023):
+                Vehicle.objects.create(manufacturer="Toyota", model="Camry", year=year)
+        self.assertEqual(Vehicle.get_search_generation(), generation + 1)
+
+        vehicle = Vehicle.objects.first()
+        vehicle.save()
+        self.assertEqual(Vehicle.get_search_generation(), generation + 1)
+        vehicle.model = "Corolla"
+        vehicle.save()
+        self.assertEqual(Vehicle.get_search_generation(), generation + 2)
@@ -6,16 +6,23 @@ handler404 = views.PageNotFoundView
 urlpatterns = [
     path('', views.HomePageView, name='home'),
 
+    path('search/', views.GlobalSearchView.as_view(), name='search'),
+    path('autocomplete/', views.RedirectUpView),
+    path('autocomplete/<str:model>/', views.RedirectUpView),
+    path('autocomplete/<str:model>/<str:field>/', views.AutocompleteView.as_view(), name='autocomplete'),
+
     path('repair/', views.RedirectUpView),
 
     path('repair/orders/', views.RepairOrderListView.as_view(), name='orders'),
     path('repair/orders/create/', views.RepairOrderCreateView.as_view(), name='order_create'),
+    path('repair/orders/margin/', views.RepairOrderMarginView.as_view(), name='order_margin'),
     path('repair/orders/<int:pk>/', views.RepairOrderUpdateView.as_view(), name='order'),
     path('repair/orders/<int:pk>/receipt/', views.RepairOrderReceiptView.as_view(), name='order_receipt'),
     path('repair/orders/<int:order>/history/', views.RedirectUpView),
     path('repair/orders/<int:order>/history/create/', views.ServiceHistoryCreateView.as_view(), name='service_history_create'),
     path('repair/orders/<int:order>/history/<int:pk>/', views.ServiceHistoryUpdateView.as_view(), name='service_history'),
     path('repair/orders/<int:order>/warehouse_uses/', views.RedirectUpView),
+    path('repair/orders/<int:order>/warehouse_uses/scan/', views.WarehouseUseScanView.as_view(), name='warehouse_use_scan'),
     path('repair/orders/<int:order>/warehouse_uses/create/', views.WarehouseUseCreateView.as_view(), name='warehouse_use_create'),
     path('repair/orders/<int:order>/warehouse_uses/<int:pk>/', views.WarehouseUseUpdateView.as_view(), name='warehouse_use'),
 
@@ -33,16 +40,19 @@ urlpatterns = [
 
     path('warehouse/items/', views.WarehouseItemListView.as_view(), name='items'),
     path('warehouse/items/create/', views.WarehouseItemCreateView.as_view(), name='item_create'),
+    path('warehouse/items/scan/', views.WarehouseItemScanView.as_view(), name='item_scan'),
     path('warehouse/items/<int:pk>/', views.WarehouseItemUpdateView.as_view(), name='item'),
     path('warehouse/items/<int:item>/restocks/', views.RedirectUpView),
     path('warehouse/items/<int:item>/restocks/create/', views.WarehouseRestockCreateView.as_view(), name='restock_create'),
     path('warehouse/items/<int:item>/restocks/<int:pk>/', views.WarehouseRestockUpdateView.as_view(), name='restock'),
 
     path('warehouse/', views.RedirectUpView),
+    path('warehouse/report/', views.WarehouseReportView.as_view(), name='warehouse_report'),
 
     path('warehouse/providers/', views.WarehouseProviderListView.as_view(), name='providers'),
     path('warehouse/providers/create/', views.WarehouseProviderCreateView.as_view(), name='provider_create'),
     path('warehouse/providers/<int:pk>/', views.WarehouseProviderUpdateView.as_view(), name='provider'),
+    path('warehouse/providers/<int:pk>/import/', views.WarehouseRestockImportView.as_view(), name='provider_import'),
 
     path('employees/', views.EmployeeListView.as_view(), name='employees'),
     path('employees/create/', views.EmployeeCreateView.as_view(), name='employee_create'),
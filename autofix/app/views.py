@@ -1,56 +1,113 @@
+import time
 from typing import Any
 from django.db.models.query import QuerySet
-from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
-from django.shortcuts import redirect, render
+from django.apps import apps
+from django.contrib import messages
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.http import Http404, HttpRequest, HttpResponse, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.views.generic import *
 from django.views.generic.edit import DeletionMixin
 from django.urls import *
 from django.contrib.auth.mixins import LoginRequiredMixin
 from .context_processors import nav_urls
-from django.db.models import Q
+from django.db import models
+from django.db.models import Case, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.functional import cached_property
+from django.utils.http import urlencode
+from .pagination import KeysetPage
+from .permissions import can, get_visible_rows
+from .search import FullTextSearchMixin, get_search_backend
 
 from .forms import *
 
 
 #region Permissions
 class CheckPermissionsMixin(LoginRequiredMixin):
+    # Views live for a single request, so the object and the permission decision are resolved once
+    # and shared by the checks, the handlers and the deletion
+    def get_object(self, queryset=None):
+        if queryset is not None:
+            return super().get_object(queryset)
+        if not hasattr(self, "_object"):
+            self._object = super().get_object()
+        return self._object
+
+    def has_permissions(self, request):
+        if not hasattr(self, "_has_permissions"):
+            self._has_permissions = self.check_permissions(request)
+        return self._has_permissions
+
     def get(self, request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
-        if not self.check_permissions(request):
+        if not self.has_permissions(request):
             return redirect("..")
-        return super().get(self, request, *args, **kwargs)
+        return super().get(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
-        if not self.check_permissions(request):
+        if not self.has_permissions(request):
             return redirect("..")
         return super().post(request, *args, **kwargs)
 
     def delete(self, request, *args, **kwargs):
-        if not self.check_permissions(request):
+        if not self.has_permissions(request):
             return redirect("..")
         return super().delete(request, *args, **kwargs)
 
 class CheckCreatePermissionsMixin(CheckPermissionsMixin):
     def check_permissions(self, request):
-        return request.user.position in ["AD", *self.model.create_allowed_to]
+        return can(request.user.position, self.model, "create")
 
 class CheckViewPermissionsMixin(CheckPermissionsMixin):
     def check_permissions(self, request):
-        try:
-            return self.parent.check_permissions(request)
-        except:
-            return request.user.position in ["AD", *self.model.edit_allowed_to]
+        return can(request.user.position, self.model, "edit")
+
+    def get_queryset(self):
+        return get_visible_rows(super().get_queryset(), self.request.user)
 #endregion
 
 #region Base
+def get_card_queryset(queryset):
+    """Loads the relations, columns and annotations declared by the model for its cards."""
+    model = queryset.model
+    if getattr(model, "card_select_related", None):
+        queryset = queryset.select_related(*model.card_select_related)
+    if getattr(model, "card_defer", None):
+        queryset = queryset.defer(*model.card_defer)
+    if hasattr(model, "get_card_annotations"):
+        queryset = queryset.annotate(**model.get_card_annotations())
+    return queryset
+
 class BaseListView(LoginRequiredMixin, ListView):
     template_name = "list.html"
 
-    def post(self, request, *args, **kwargs):
-        self.kwargs.update(request.resolver_match.kwargs)
-        return self.get(request, *args, **kwargs)
+    def get_queryset(self) -> QuerySet[Any]:
+        return get_card_queryset(super().get_queryset())
+
+    @cached_property
+    def can_create(self):
+        return can(self.request.user.position, self.model, "create")
+
+class NestedListView(BaseListView):
+    """List of the rows of a parent object, shown on the page of the parent."""
+    paginate_by = 20
+    parent_field = None
+
+    def get_queryset(self) -> QuerySet[Any]:
+        return super().get_queryset().filter(**{self.parent_field: self.kwargs["pk"]}).order_by("id")
+
+    def get_nested_context_data(self):
+        # Lists share the page of the parent, so each is paginated by its own parameter
+        self.object_list = self.get_queryset()
+        return self.get_context_data(page_kwarg=self.page_kwarg)
 
 class PaginatedListView(CheckViewPermissionsMixin, BaseListView):
     paginate_by = 20
+    order_by_search_rank = False
+    # Pages by a cursor of the last row instead of an offset, for long lists
+    keyset_pagination = False
 
     def get(self, request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
         self.search = request.GET.get("search", None)
@@ -59,10 +116,37 @@ class PaginatedListView(CheckViewPermissionsMixin, BaseListView):
     def get_queryset(self) -> QuerySet[Any]:
         queryset = super().get_queryset()
         if self.search:
-            queryset = queryset.filter(self.model.search(self.search))
+            queryset = self.search_queryset(queryset)
         return queryset
 
-class BaseCreateView(CheckCreatePermissionsMixin, LoginRequiredMixin, CreateView):
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
+        page = KeysetPage(queryset, page_size, self.request.GET.get("cursor"))
+        return None, page, page.object_list, page.has_other_pages()
+
+    def search_queryset(self, queryset):
+        backend = get_search_backend()
+        return backend.search_ranked(self.model, queryset, self.search) if self.order_by_search_rank \
+            else queryset.filter(backend.search(self.model, self.search))
+
+    def search_queryset_or(self, queryset, filter: Q):
+        """Searches the queryset, also matching rows by the filter."""
+        # A union lets the database use indexes of both alternatives, unlike an OR of them
+        rows = self.model._base_manager
+        return queryset.filter(id__in=rows.filter(get_search_backend().search(self.model, self.search)).values("id")
+                               .union(rows.filter(filter).values("id")))
+
+class SaveValidationMixin:
+    """Shows errors raised while saving, like the stock taken by a concurrent use, on the form."""
+    def form_valid(self, form):
+        try:
+            return super().form_valid(form)
+        except ValidationError as error:
+            form.add_error(None, error)
+            return self.form_invalid(form)
+
+class BaseCreateView(CheckCreatePermissionsMixin, LoginRequiredMixin, SaveValidationMixin, CreateView):
     template_name = "create.html"
     success_url = ".."
 
@@ -71,7 +155,7 @@ class BaseCreateView(CheckCreatePermissionsMixin, LoginRequiredMixin, CreateView
         kwargs["initial"]["position"] = self.request.user.position
         return kwargs
 
-class BaseUpdateView(CheckViewPermissionsMixin, UpdateView, DeletionMixin):
+class BaseUpdateView(CheckViewPermissionsMixin, SaveValidationMixin, UpdateView, DeletionMixin):
     template_name = "update.html"
     success_url = ".."
     extra_views = []
@@ -81,21 +165,25 @@ class BaseUpdateView(CheckViewPermissionsMixin, UpdateView, DeletionMixin):
         kwargs["initial"]["position"] = self.request.user.position
         return kwargs
 
-    def get_context_data(self, request = None, *args, **kwargs):
-        self.object = self.get_object()
+    def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["extra_contexts"] = []
 
+        # Nested lists are built for the object already fetched, instead of dispatching their views
         for extra_view in self.extra_views:
-            clsview = extra_view.as_view()
-            view = clsview(self.request, *args, **(kwargs | { "pk": self.object.id }))
-            context["extra_contexts"].append(view.context_data)
+            view = extra_view()
+            view.setup(self.request, pk=self.object.id)
+            context["extra_contexts"].append(view.get_nested_context_data())
 
         return context
 
     def get(self, request, *args, **kwargs):
         if request.GET.get("delete") is not None:
-            self.delete(request, *args, **kwargs)
+            try:
+                self.delete(request, *args, **kwargs)
+            except ValidationError as error:
+                messages.error(request, " ".join(error.messages))
+                return HttpResponseRedirect(request.META.get('HTTP_REFERER', request.path))
             if request.path in request.META.get('HTTP_REFERER'):
                 return HttpResponseRedirect(request.path + "../")
             return HttpResponseRedirect(request.META.get('HTTP_REFERER', self.get_success_url()))
@@ -108,6 +196,14 @@ class RepairOrderListView(PaginatedListView):
     plural_name = "Заявки на ремонт"
     model = RepairOrder
     template_name = "repair_order_list.html"
+    keyset_pagination = True
+    sort_options = {
+        "due": ("По сроку", ["finish_until", "id"]),
+        "status": ("По статусу", ["status_rank", "finish_until", "id"]),
+        "new": ("Сначала новые", ["-start_date", "-id"]),
+    }
+    # Statuses in the order of urgency
+    status_ranks = [RepairOrder.Status.Overdue, RepairOrder.Status.DueToday, RepairOrder.Status.Open, RepairOrder.Status.Unpaid]
 
     def get(self, request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
         try:
@@ -121,40 +217,78 @@ class RepairOrderListView(PaginatedListView):
                                                      if request.user.position != Employee.Position.Mechanic
                                                      else request.user.id).first()
         self.show_finished = request.GET.get("show_finished") == "1"
+        self.filter_status = request.GET.get("status") if request.GET.get("status") in RepairOrder.Status.values else None
+        self.sort = request.GET.get("sort") if request.GET.get("sort") in self.sort_options else "due"
+        self.statuses = RepairOrder.Status.choices
         return super().get(request, *args, **kwargs)
 
     def get_queryset(self):
+        today = timezone.localdate()
         filter = Q();
         if self.filter_master:
             filter &= Q(master_id = self.filter_master.id)
-        if not self.show_finished:
-            filter &= Q(finish_date__isnull = True) | Q(is_paid = False, is_cancelled = False)
-        return super().get_queryset().filter(filter).order_by("finish_until", "id")
+        if self.filter_status:
+            filter &= RepairOrder.get_current_status_filter(self.filter_status, today)
+        elif not self.show_finished:
+            filter &= Q(status__in=[RepairOrder.Status.Open, RepairOrder.Status.Unpaid])
+        queryset = super().get_queryset().filter(filter)
+        if self.sort == "status":
+            queryset = queryset.annotate(status_rank=Case(
+                *[When(current_status=status, then=Value(rank)) for rank, status in enumerate(self.status_ranks)],
+                default=Value(len(self.status_ranks))
+            ))
+        return queryset.order_by(*self.sort_options[self.sort][1])
+
+    def search_queryset(self, queryset):
+        phone_filter = Client.get_phone_filter(self.search)
+        if phone_filter is None:
+            return super().search_queryset(queryset)
+        return self.search_queryset_or(queryset, Q(client__in=Client._base_manager.filter(phone_filter)))
 
 class ServiceListView(PaginatedListView):
     plural_name = "Услуги"
     model = Service
     queryset = Service.objects.order_by("name")
+    order_by_search_rank = True
 
 class ClientListView(PaginatedListView):
     plural_name = "Клиенты"
     model = Client
     queryset = Client.objects.order_by("full_name", "phone_number")
+    order_by_search_rank = True
+
+    def search_queryset(self, queryset):
+        phone_filter = Client.get_phone_filter(self.search)
+        if phone_filter is None:
+            return super().search_queryset(queryset)
+        return self.search_queryset_or(queryset, phone_filter)
 
 class VehicleListView(PaginatedListView):
     plural_name = "Автомобили"
     model = Vehicle
     queryset = Vehicle.objects.order_by("manufacturer", "model", "year")
+    order_by_search_rank = True
 
 class WarehouseItemListView(PaginatedListView):
     plural_name = "Расходники"
     model = WarehouseItem
     queryset = WarehouseItem.objects.order_by("name")
+    order_by_search_rank = True
+    template_name = "warehouse_item_list.html"
+
+    def get(self, request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        self.low_stock = request.GET.get("low_stock", "0") == "1"
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return queryset.filter(is_low_stock=True) if self.low_stock else queryset
 
 class WarehouseProviderListView(PaginatedListView):
     plural_name = "Поставщики расходников"
     model = WarehouseProvider
     queryset = WarehouseProvider.objects.order_by("name")
+    order_by_search_rank = True
 
 class EmployeeListView(PaginatedListView):
     plural_name = "Сотрудники"
@@ -174,24 +308,25 @@ class EmployeeListView(PaginatedListView):
 #endregion
 
 #region Nested list
-class ServiceHistoryListView(BaseListView):
+class ServiceHistoryListView(NestedListView):
     plural_name = "Выполненные услуги"
     subdir = "history/"
     model = ServiceHistory
-    def get_queryset(self):
-        return ServiceHistory.objects.filter(repair_order_id = self.kwargs["pk"])
-class WarehouseUseListView(BaseListView):
+    parent_field = "repair_order_id"
+    page_kwarg = "history_page"
+class WarehouseUseListView(NestedListView):
     plural_name = "Использованные расходники"
     subdir = "warehouse_uses/"
+    list_template = "warehouse_use_base_list.html"
     model = WarehouseUse
-    def get_queryset(self):
-        return WarehouseUse.objects.filter(repair_order_id = self.kwargs["pk"])
-class WarehouseRestockListView(BaseListView):
+    parent_field = "repair_order_id"
+    page_kwarg = "uses_page"
+class WarehouseRestockListView(NestedListView):
     plural_name = "Пополнения"
     subdir = "restocks/"
     model = WarehouseRestock
-    def get_queryset(self):
-        return WarehouseRestock.objects.filter(item_id = self.kwargs["pk"])
+    parent_field = "item_id"
+    page_kwarg = "restocks_page"
 #endregion
 
 
@@ -203,16 +338,6 @@ class RepairOrderView:
         ServiceHistoryListView,
         WarehouseUseListView
     ]
-
-    def check_permissions(self, request):
-        if request.user.position == Employee.Position.Mechanic:
-            try:
-                if not request.user.id == self.get_object().master_id:
-                    return False
-            except:
-                return False
-
-        return super().check_permissions(request)
 class ServiceView:
     model = Service
     form_class = ServiceForm
@@ -273,8 +398,12 @@ class EmployeeUpdateView(CheckViewPermissionsMixin, EmployeeView, UpdateView):
 #endregion
 
 #region Repair order receipt
-class RepairOrderReceiptView(RepairOrderView, DetailView):
+class RepairOrderReceiptView(LoginRequiredMixin, RepairOrderView, DetailView):
     template_name = "repair_order_receipt.html"
+
+    def get_queryset(self):
+        return get_visible_rows(super().get_queryset(), self.request.user) \
+            .prefetch_related("servicehistory_set__service", "warehouseuse_set__item")
 #endregion
 
 
@@ -323,6 +452,208 @@ class WarehouseRestockUpdateView(WarehouseRestockView, BaseUpdateView):
     pass
 #endregion
 
+#region Import
+class WarehouseRestockImportView(CheckCreatePermissionsMixin, FormView):
+    model = WarehouseRestock
+    form_class = WarehouseRestockImportForm
+    template_name = "restock_import.html"
+    success_url = ".."
+
+    def post(self, request, *args, **kwargs):
+        self.started = time.monotonic()
+        return super().post(request, *args, **kwargs)
+
+    def get_form_kwargs(self):
+        return super().get_form_kwargs() | {"provider": get_object_or_404(WarehouseProvider, pk=self.kwargs["pk"])}
+
+    def form_valid(self, form):
+        WarehouseRestock.objects.bulk_create(form.restocks, batch_size=1000)
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        messages.success(self.request, f"Импортировано строк: {len(form.restocks)} за {elapsed:.2f} с, "
+                                       f"{len(form.restocks) / elapsed:.0f} строк/с.")
+        return super().form_valid(form)
+#endregion
+
+
+#region Reports
+class WarehouseReportView(LoginRequiredMixin, ListView):
+    """Stocks of warehouse items at the end of a day."""
+    template_name = "warehouse_report.html"
+    paginate_by = 50
+
+    def get(self, request, *args, **kwargs):
+        if not can(request.user.position, WarehouseItem, "edit"):
+            return redirect("..")
+        try:
+            self.date = parse_date(request.GET.get("date") or "")
+        except ValueError:
+            self.date = None
+        self.date = self.date or timezone.localdate()
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        # Items deleted since are still listed while they have stock at the date
+        return (WarehouseItem.objects.all_with_deleted()
+                .annotate(stock_at=WarehouseItem.get_stock_at(get_day_end(self.date)))
+                .filter(Q(deleted_at=None) | ~Q(stock_at=0))
+                .annotate(total_at=ExpressionWrapper(F("stock_at") * F("price"), output_field=models.DecimalField()))
+                .order_by("type", "name", "id"))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["date"] = self.date
+        context["total"] = self.object_list.aggregate(total=Sum("total_at"))["total"] or 0
+        return context
+
+class RepairOrderMarginView(LoginRequiredMixin, ListView):
+    """Stored totals of repair orders finished within the dates less the stored cost of the used items."""
+    template_name = "repair_order_margin.html"
+    paginate_by = 50
+
+    def get_date(self, name, default):
+        try:
+            return parse_date(self.request.GET.get(name) or "") or default
+        except ValueError:
+            return default
+
+    def get(self, request, *args, **kwargs):
+        if not can(request.user.position, RepairOrder, "margin"):
+            return redirect("..")
+        self.end = self.get_date("end", timezone.localdate())
+        self.start = self.get_date("start", self.end.replace(day=1))
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return (RepairOrder.objects.filter(finish_date__range=(self.start, self.end))
+                .select_related("vehicle")
+                .annotate(revenue=Case(When(Q(is_warranty=True) | Q(is_cancelled=True), then=Value(0)),
+                                       default=F("total"), output_field=models.DecimalField()),
+                          cost=Coalesce(Subquery(
+                              WarehouseUse.objects.filter(repair_order=OuterRef("pk")).order_by().values("repair_order")
+                                  .annotate(total=Sum("cost")).values("total")
+                          ), Value(0), output_field=models.DecimalField()))
+                .annotate(margin=ExpressionWrapper(F("revenue") - F("cost"), output_field=models.DecimalField()))
+                .order_by("finish_date", "id"))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["start"] = self.start
+        context["end"] = self.end
+        # Aggregates named as the annotations would replace them
+        context.update(self.object_list.aggregate(total_revenue=Sum("revenue"), total_cost=Sum("cost"), total_margin=Sum("margin")))
+        return context
+#endregion
+
+
+#region Search
+class GlobalSearchView(LoginRequiredMixin, TemplateView):
+    template_name = "search.html"
+    results_per_list = 5
+    list_views = {
+        "orders": RepairOrderListView,
+        "clients": ClientListView,
+        "vehicles": VehicleListView,
+        "services": ServiceListView,
+        "items": WarehouseItemListView,
+        "providers": WarehouseProviderListView,
+        "employees": EmployeeListView,
+    }
+
+    def get_queryset(self, view):
+        return get_visible_rows(view.model.objects.all(), self.request.user)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        search = self.request.GET.get("search", "")
+        views = {url_name: view for url_name, view in self.list_views.items()
+                 if can(self.request.user.position, view.model, "edit")}
+        querysets = [self.get_queryset(view) for view in views.values()]
+
+        # Best matches of all lists are found in a single query, then rows of every list are fetched at once
+        context["results"] = []
+        for [url_name, view], queryset, ids in zip(views.items(), querysets,
+                                                   get_search_backend().top_ids(querysets, search, self.results_per_list)):
+            if ids:
+                objects = get_card_queryset(queryset).in_bulk(ids)
+                context["results"].append({
+                    "plural_name": view.plural_name,
+                    "url": reverse(url_name) + "?" + urlencode({"search": search}),
+                    "object_list": [objects[id] for id in ids if id in objects],
+                })
+        return context
+#endregion
+
+
+#region Autocomplete
+class AutocompleteView(LoginRequiredMixin, View):
+    """Choices of a foreign key of a form whose tokens start with the search terms, from the latest matches."""
+    paginate_by = 20
+
+    def get(self, request, model, field):
+        try:
+            field = apps.get_model("app", model)._meta.get_field(field)
+        except (LookupError, FieldDoesNotExist):
+            raise Http404
+        if not field.many_to_one or field.related_model not in FullTextSearchMixin.search_models:
+            raise Http404
+        if not can(request.user.position, field.model, "edit"):
+            return redirect("..")
+
+        queryset = field.related_model._default_manager.complex_filter(field.get_limit_choices_to()).order_by("-id")
+        search = request.GET.get("search", "")
+        if search.split():
+            queryset = queryset.filter(get_search_backend().filter_latest(field.related_model, search, prefix=True,
+                                                                          fields=field.related_model.autocomplete_fields))
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+        except ValueError:
+            page = 1
+
+        # A row past the page tells whether there are more, without counting all of them
+        objects = list(queryset[(page - 1) * self.paginate_by:page * self.paginate_by + 1])
+        return JsonResponse({
+            "results": [{"id": obj.pk, "text": str(obj)} for obj in objects[:self.paginate_by]],
+            "more": len(objects) > self.paginate_by,
+        })
+#endregion
+
+
+#region Scan
+class WarehouseItemScanView(LoginRequiredMixin, View):
+    """Item with the scanned barcode and its stock, found by the unique index of barcodes."""
+    def get(self, request):
+        if not can(request.user.position, WarehouseItem, "edit") and not can(request.user.position, WarehouseUse, "create"):
+            return redirect("..")
+        code = request.GET.get("code", "").strip()
+        item = WarehouseItem.objects.filter(sku=code).first() if code else None
+        if item is None:
+            return JsonResponse({"error": f"Расходник со штрихкодом {code} не найден."}, status=404)
+        return JsonResponse(item.get_scan_result())
+
+class WarehouseUseScanView(LoginRequiredMixin, View):
+    """Adds the item with the scanned barcode to the used items of the order."""
+    def post(self, request, order):
+        if not can(request.user.position, WarehouseUse, "create"):
+            return redirect("..")
+        order = get_object_or_404(get_visible_rows(RepairOrder.objects, request.user), pk=order)
+
+        code = request.POST.get("code", "").strip()
+        item = WarehouseItem.objects.filter(sku=code).first() if code else None
+        if item is None:
+            return JsonResponse({"error": f"Расходник со штрихкодом {code} не найден."}, status=404)
+        amount = request.POST.get("amount", "1")
+        if not amount.isdigit() or int(amount) < 1:
+            return JsonResponse({"error": "Количество должно быть целым положительным числом."}, status=400)
+
+        use = WarehouseUse(repair_order=order, item=item, amount=int(amount))
+        try:
+            use.save()
+        except ValidationError as error:
+            return JsonResponse({"error": " ".join(error.messages)}, status=400)
+        item.refresh_from_db(fields=["stock", "is_low_stock"])
+        return JsonResponse({"use": use.pk, "amount": use.amount} | item.get_scan_result())
+#endregion
+
 
 #region Independent views
 def RedirectUpView(request, *args, **kwargs):